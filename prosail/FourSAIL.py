@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import threading
+from collections import OrderedDict, namedtuple
 from math import exp, radians
 
 try:
@@ -10,44 +12,10 @@ import numba
 import numpy as np
 
 
-@numba.jit("Tuple((f8, f8, f8, f8))(f8,f8,f8,f8)", nopython=True, cache=True)
-def volscatt(tts, tto, psi, ttl):
-    """Compute volume scattering functions and interception coefficients
-    for given solar zenith, viewing zenith, azimuth and leaf inclination angle.
-
-    Parameters
-    ----------
-    tts : float
-        Solar Zenith Angle (degrees).
-    tto : float
-        View Zenight Angle (degrees).
-    psi : float
-        View-Sun reliative azimuth angle (degrees).
-    ttl : float
-        leaf inclination angle (degrees).
-
-    Returns
-    -------
-    chi_s : float
-        Interception function  in the solar path.
-    chi_o : float
-        Interception function  in the view path.
-    frho : float
-        Function to be multiplied by leaf reflectance to obtain the volume scattering.
-    ftau : float
-        Function to be multiplied by leaf transmittance to obtain the volume scattering.
-
-    References
-    ----------
-    Wout Verhoef, april 2001, for CROMA.
-    """
-
-    cts = np.cos(np.radians(tts))
-    cto = np.cos(np.radians(tto))
-    sts = np.sin(np.radians(tts))
-    sto = np.sin(np.radians(tto))
-    cospsi = np.cos(np.radians(psi))
-    psir = np.radians(psi)
+@numba.jit(nopython=True, cache=True)
+def _volscatt_leaf(cts, cto, sts, sto, cospsi, psir, tto, ttl):
+    """:func:`volscatt` for one leaf inclination ``ttl`` (degrees), with the
+    cosines and sines of the sun-view geometry already computed."""
     cttl = np.cos(np.radians(ttl))
     sttl = np.sin(np.radians(ttl))
     cs = cttl * cts
@@ -109,12 +77,91 @@ def volscatt(tts, tto, psi, ttl):
     return (chi_s, chi_o, frho, ftau)
 
 
-@numba.jit(
-    "Tuple((f8, f8, f8, f8, f8))(f8[:], f8, f8, f8)",
-    nopython=True,
-    cache=True,
-)
-def weighted_sum_over_lidf(lidf, tts, tto, psi):
+@numba.jit("Tuple((f8, f8, f8, f8))(f8,f8,f8,f8)", nopython=True, cache=True)
+def volscatt(tts, tto, psi, ttl):
+    """Compute volume scattering functions and interception coefficients
+    for given solar zenith, viewing zenith, azimuth and leaf inclination angle.
+
+    Parameters
+    ----------
+    tts : float
+        Solar Zenith Angle (degrees).
+    tto : float
+        View Zenight Angle (degrees).
+    psi : float
+        View-Sun reliative azimuth angle (degrees).
+    ttl : float
+        leaf inclination angle (degrees).
+
+    Returns
+    -------
+    chi_s : float
+        Interception function  in the solar path.
+    chi_o : float
+        Interception function  in the view path.
+    frho : float
+        Function to be multiplied by leaf reflectance to obtain the volume scattering.
+    ftau : float
+        Function to be multiplied by leaf transmittance to obtain the volume scattering.
+
+    References
+    ----------
+    Wout Verhoef, april 2001, for CROMA.
+    """
+
+    cts = np.cos(np.radians(tts))
+    cto = np.cos(np.radians(tto))
+    sts = np.sin(np.radians(tts))
+    sto = np.sin(np.radians(tto))
+    cospsi = np.cos(np.radians(psi))
+    psir = np.radians(psi)
+    return _volscatt_leaf(cts, cto, sts, sto, cospsi, psir, tto, ttl)
+
+
+@numba.jit(nopython=True, cache=True)
+def volscatt_batch(tts, tto, psi, ttl):
+    """:func:`volscatt` for many sun-view geometries and leaf inclinations
+    at once. The trigonometry of each geometry is only computed once for
+    all the inclination bins.
+
+    Parameters
+    ----------
+    tts, tto, psi : array
+        ``(n_geom,)`` solar zenith, view zenith and relative azimuth angles
+        (degrees).
+    ttl : array
+        ``(n_angles,)`` leaf inclination angles (degrees).
+
+    Returns
+    -------
+    chi_s, chi_o, frho, ftau : array
+        ``(n_geom, n_angles)`` arrays, see :func:`volscatt`.
+    """
+    n_geom = len(tts)
+    n_angles = len(ttl)
+    chi_s = np.empty((n_geom, n_angles))
+    chi_o = np.empty((n_geom, n_angles))
+    frho = np.empty((n_geom, n_angles))
+    ftau = np.empty((n_geom, n_angles))
+    for i in range(n_geom):
+        cts = np.cos(np.radians(tts[i]))
+        cto = np.cos(np.radians(tto[i]))
+        sts = np.sin(np.radians(tts[i]))
+        sto = np.sin(np.radians(tto[i]))
+        cospsi = np.cos(np.radians(psi[i]))
+        psir = np.radians(psi[i])
+        for j in range(n_angles):
+            chi_s[i, j], chi_o[i, j], frho[i, j], ftau[i, j] = _volscatt_leaf(
+                cts, cto, sts, sto, cospsi, psir, tto[i], ttl[j]
+            )
+    return chi_s, chi_o, frho, ftau
+
+
+@numba.jit(nopython=True, cache=True)
+def weighted_sum_over_angles(lidf, litab, tts, tto, psi):
+    """:func:`weighted_sum_over_lidf` with the leaf inclination angles
+    ``litab`` (degrees) of the LIDF weights, e.g. the nodes of a
+    :func:`leaf_angle_quadrature`."""
     ks = 0.0
     ko = 0.0
     bf = 0.0
@@ -124,10 +171,6 @@ def weighted_sum_over_lidf(lidf, tts, tto, psi):
     cto = np.cos(np.radians(tto))
     ctscto = cts * cto
 
-    n_angles = len(lidf)
-    angle_step = float(90.0 / n_angles)
-    litab = np.arange(n_angles) * angle_step + (angle_step * 0.5)
-
     for i, ili in enumerate(litab):
         ttl = 1.0 * ili
         cttl = np.cos(np.radians(ttl))
@@ -148,6 +191,65 @@ def weighted_sum_over_lidf(lidf, tts, tto, psi):
     return ks, ko, bf, sob, sof
 
 
+@numba.jit(
+    "Tuple((f8, f8, f8, f8, f8))(f8[:], f8, f8, f8)",
+    nopython=True,
+    cache=True,
+)
+def weighted_sum_over_lidf(lidf, tts, tto, psi):
+    n_angles = len(lidf)
+    angle_step = float(90.0 / n_angles)
+    litab = np.arange(n_angles) * angle_step + (angle_step * 0.5)
+    return weighted_sum_over_angles(lidf, litab, tts, tto, psi)
+
+
+@numba.jit(nopython=True, cache=True)
+def weighted_sum_over_angles_batch(lidf, litab, tts, tto, psi):
+    """:func:`weighted_sum_over_lidf_batch` with the leaf inclination angles
+    ``litab`` (degrees) of the LIDF weights."""
+    n_geom, n_angles = lidf.shape
+    chi_s, chi_o, frho, ftau = volscatt_batch(tts, tto, psi, litab)
+    bfli = np.cos(np.radians(litab)) ** 2.0
+    ks = np.zeros(n_geom)
+    ko = np.zeros(n_geom)
+    bf = np.zeros(n_geom)
+    sob = np.zeros(n_geom)
+    sof = np.zeros(n_geom)
+    for i in range(n_geom):
+        cts = np.cos(np.radians(tts[i]))
+        cto = np.cos(np.radians(tto[i]))
+        ctscto = cts * cto
+        for j in range(n_angles):
+            ks[i] += chi_s[i, j] / cts * lidf[i, j]
+            ko[i] += chi_o[i, j] / cto * lidf[i, j]
+            bf[i] += bfli[j] * lidf[i, j]
+            sob[i] += frho[i, j] * np.pi / ctscto * lidf[i, j]
+            sof[i] += ftau[i, j] * np.pi / ctscto * lidf[i, j]
+    return ks, ko, bf, sob, sof
+
+
+@numba.jit(
+    "Tuple((f8[:], f8[:], f8[:], f8[:], f8[:]))(f8[:, :], f8[:], f8[:], f8[:])",
+    nopython=True,
+    cache=True,
+)
+def weighted_sum_over_lidf_batch(lidf, tts, tto, psi):
+    """:func:`weighted_sum_over_lidf` for ``n_geom`` canopies and sun-view
+    geometries, e.g. the pixels of a tile. ``lidf`` is a ``(n_geom,
+    n_angles)`` array, and the volume scattering terms of all the geometries
+    and inclination bins come from one :func:`volscatt_batch` call.
+
+    Returns
+    -------
+    ks, ko, bf, sob, sof : array
+        ``(n_geom,)`` arrays.
+    """
+    n_angles = lidf.shape[1]
+    angle_step = float(90.0 / n_angles)
+    litab = np.arange(n_angles) * angle_step + (angle_step * 0.5)
+    return weighted_sum_over_angles_batch(lidf, litab, tts, tto, psi)
+
+
 @lru_cache(maxsize=16)
 def define_geometric_constants(tts, tto, psi):
     cts = np.cos(np.radians(tts))
@@ -188,32 +290,17 @@ def hotspot_calculations(alf, lai, ko, ks):
 
 def Jfunc1(k, l, t):
     """J1 function with avoidance of singularity problem."""
-    try:
-        nb = len(l)
-    except TypeError:
-        nb = 1
     del_ = (k - l) * t
-    if nb > 1:
-        result = np.zeros(nb)
-        result[np.abs(del_) > 1e-3] = (
-            np.exp(-l[np.abs(del_) > 1e-3] * t) - np.exp(-k * t)
-        ) / (k - l[np.abs(del_) > 1e-3])
-        result[np.abs(del_) <= 1e-3] = (
-            0.5
-            * t
-            * (np.exp(-k * t) + np.exp(-l[np.abs(del_) <= 1e-3] * t))
-            * (1.0 - (del_[np.abs(del_) <= 1e-3] ** 2.0) / 12.0)
-        )
-    else:
-        if np.abs(del_) > 1e-3:
-            result = (np.exp(-l * t) - np.exp(-k * t)) / (k - l)
-        else:
-            result = (
-                0.5
-                * t
-                * (np.exp(-k * t) + np.exp(-l * t))
-                * (1.0 - (del_**2.0) / 12.0)
-            )
+    near = np.abs(del_) <= 1e-3
+    ekt = np.exp(-k * t)
+    elt = np.exp(-l * t)
+    # Safe denominator for the values that will take the series branch
+    k_minus_l = np.where(near, 1.0, k - l)
+    result = np.where(
+        near,
+        0.5 * t * (ekt + elt) * (1.0 - (del_**2.0) / 12.0),
+        (elt - ekt) / k_minus_l,
+    )
     return result
 
 
@@ -355,8 +442,462 @@ def campbell(alpha, n_elements=18):
     return lidf
 
 
+@numba.jit("f8[:, :](i8[:], f8[:], f8[:], i8)", nopython=True, cache=True)
+def lidf_batch(lidftype, lidfa, lidfb, n_elements):
+    """LIDFs of a batch of canopies, one row per sample: Verhoef's bimodal
+    for ``lidftype`` 1, Campbell's otherwise."""
+    lidf = np.empty((len(lidftype), n_elements))
+    for i in range(len(lidftype)):
+        if lidftype[i] == 1:
+            lidf[i] = verhoef_bimodal(lidfa[i], lidfb[i], n_elements)
+        else:
+            lidf[i] = campbell(lidfa[i], n_elements)
+    return lidf
+
+
+# Bimodal LIDFs with |a| + |b| above this get the Gauss weights of their
+# bin frequencies, see lidf_density_batch
+BIMODAL_SINGULAR_LIMIT = 0.95
+
+
+@numba.jit(nopython=True, cache=True)
+def verhoef_bimodal_density(a, b, angles):
+    """Probability density (per radian) of Verhoef's bimodal LIDF at the
+    leaf inclination ``angles`` (degrees). With the auxiliary angle ``x``
+    that solves ``x - a sin(x) - b/2 sin(2x) = 2 theta`` (the fixed point of
+    :func:`verhoef_bimodal`),
+
+        g(theta) = 2/pi * (2 / (1 - a cos(x) - b cos(2x)) - 1)
+
+    It is singular where ``|a| + |b| = 1`` (e.g. planophile), where
+    :func:`lidf_density_batch` uses :func:`verhoef_bimodal_cdf` instead.
+    """
+    density = np.empty(len(angles))
+    for i in range(len(angles)):
+        p = 2.0 * np.radians(angles[i])
+        x = p
+        delx = 1.0
+        while delx >= 1e-8:
+            y = a * np.sin(x) + 0.5 * b * np.sin(2.0 * x)
+            dx = 0.5 * (y - x + p)
+            x = x + dx
+            delx = abs(dx)
+        density[i] = (
+            2.0 / np.pi * (2.0 / (1.0 - a * np.cos(x) - b * np.cos(2.0 * x))
+                           - 1.0)
+        )
+    return density
+
+
+@numba.jit(nopython=True, cache=True)
+def verhoef_bimodal_cdf(a, b, angles):
+    """Fraction of the leaves of Verhoef's bimodal LIDF with an inclination
+    below ``angles`` (degrees), the cumulative distribution that
+    :func:`verhoef_bimodal` integrates over its bins."""
+    cdf = np.empty(len(angles))
+    for i in range(len(angles)):
+        p = 2.0 * np.radians(angles[i])
+        x = p
+        y = 0.0
+        delx = 1.0
+        while delx >= 1e-8:
+            y = a * np.sin(x) + 0.5 * b * np.sin(2.0 * x)
+            dx = 0.5 * (y - x + p)
+            x = x + dx
+            delx = abs(dx)
+        cdf[i] = (2.0 * y + p) / np.pi
+    return cdf
+
+
+@numba.jit(nopython=True, cache=True)
+def campbell_density(alpha, angles):
+    """Probability density (per radian) of the [Campbell1990] ellipsoidal
+    LIDF with mean leaf angle ``alpha`` at the leaf inclination ``angles``
+    (degrees),
+
+        g(theta) = 2 chi^3 sin(theta) / (L (cos^2 theta + chi^2 sin^2 theta)^2)
+
+    where ``chi`` is the eccentricity of :func:`campbell` and
+    ``L = chi + 1.774 (chi + 1.182)^-0.733`` its normalisation.
+    """
+    alpha = float(alpha)
+    excent = exp(
+        -1.6184e-5 * alpha**3.0
+        + 2.1145e-3 * alpha**2.0
+        - 1.2390e-1 * alpha
+        + 3.2491
+    )
+    norm = excent + 1.774 * (excent + 1.182) ** -0.733
+    theta = np.radians(angles)
+    return (
+        2.0 * excent**3.0 * np.sin(theta)
+        / (norm * (np.cos(theta) ** 2.0
+                   + excent**2.0 * np.sin(theta) ** 2.0) ** 2.0)
+    )
+
+
+@numba.jit(nopython=True, cache=True)
+def lidf_density_batch(lidftype, lidfa, lidfb, angles, weights):
+    """LIDF weights of a batch of canopies at the nodes ``angles`` of a Gauss
+    quadrature: the density (:func:`verhoef_bimodal_density` for
+    ``lidftype`` 1, :func:`campbell_density` otherwise) times the quadrature
+    ``weights``, normalised to add up to one. The bimodal densities are
+    (nearly) singular where ``|a| + |b|`` approaches 1, so above
+    ``BIMODAL_SINGULAR_LIMIT`` the weights are the LIDF frequencies of the
+    cells around the nodes instead (whose widths are the quadrature
+    ``weights``), as with the midpoint rule."""
+    edges = np.zeros(len(angles) + 1)
+    edges[1:] = np.cumsum(weights)
+    lidf = np.empty((len(lidftype), len(angles)))
+    for i in range(len(lidftype)):
+        if lidftype[i] != 1:
+            row = campbell_density(lidfa[i], angles) * weights
+        elif abs(lidfa[i]) + abs(lidfb[i]) > BIMODAL_SINGULAR_LIMIT:
+            row = np.diff(verhoef_bimodal_cdf(lidfa[i], lidfb[i], edges))
+        else:
+            density = verhoef_bimodal_density(lidfa[i], lidfb[i], angles)
+            row = density * weights
+        lidf[i] = row / np.sum(row)
+    return lidf
+
+
+Quadrature = namedtuple("Quadrature", "rule n_nodes angles weights")
+
+# Rules of the leaf inclination integral: the LIDF frequencies of uniform
+# bins at their midpoints (the 4SAIL default, with 18 bins), or Gauss-Legendre
+# nodes with the LIDF densities.
+QUADRATURE_RULES = ("midpoint", "gauss")
+
+
+def leaf_angle_quadrature(n_nodes=18, rule="midpoint"):
+    """The nodes and weights of the integrals over the leaf inclination,
+    built once per configuration and cached.
+
+    With the "midpoint" rule, the LIDF is integrated over ``n_nodes``
+    uniform bins (:func:`campbell` and :func:`verhoef_bimodal`), and the
+    scattering terms are evaluated at the bin centres: 18 bins are the
+    4SAIL default. With the "gauss" rule, the LIDF densities
+    (:func:`campbell_density` and :func:`verhoef_bimodal_density`) are
+    weighted at the ``n_nodes`` Gauss-Legendre nodes over 0 to 90 degrees,
+    which is about twice as accurate for the same number of nodes (the
+    volume scattering terms have kinks, so both rules converge as
+    ``1 / n_nodes^2``): e.g. 6 nodes for fast emulation, or 90 for
+    reference runs. Bimodal LIDFs with ``|a| + |b|`` close to 1 have
+    singular densities, so they are weighted by their bin frequencies
+    instead (see :func:`lidf_density_batch`), and are no more accurate
+    than with the midpoint rule. See :func:`quadrature_error` for an error
+    estimate.
+
+    Returns
+    -------
+    A ``Quadrature`` named tuple with the ``rule``, ``n_nodes``, and the
+    read-only ``angles`` (degrees) and ``weights`` (degrees, adding up to
+    90) of the nodes.
+    """
+    rule = rule.lower()
+    if rule not in QUADRATURE_RULES:
+        raise ValueError(
+            "rule must be one of %s" % ", ".join(QUADRATURE_RULES)
+        )
+    if int(n_nodes) < 1:
+        raise ValueError("n_nodes must be positive")
+    return _leaf_angle_quadrature(int(n_nodes), rule)
+
+
+@lru_cache(maxsize=32)
+def _leaf_angle_quadrature(n_nodes, rule):
+    if rule == "midpoint":
+        # As in weighted_sum_over_lidf
+        angle_step = float(90.0 / n_nodes)
+        angles = np.arange(n_nodes) * angle_step + (angle_step * 0.5)
+        weights = np.full(n_nodes, angle_step)
+    else:
+        nodes, weights = np.polynomial.legendre.leggauss(n_nodes)
+        angles = 45.0 * (nodes + 1.0)
+        weights = 45.0 * weights
+    angles.setflags(write=False)
+    weights.setflags(write=False)
+    return Quadrature(rule, n_nodes, angles, weights)
+
+
+def quadrature_lidf(lidftype, lidfa, lidfb, quadrature):
+    """LIDF weights of a batch of canopies at the nodes of ``quadrature``,
+    as a ``(n_samples, n_nodes)`` array."""
+    lidftype = np.asarray(lidftype, dtype=np.int64)
+    lidfa = np.asarray(lidfa, dtype=np.float64)
+    lidfb = np.asarray(lidfb, dtype=np.float64)
+    if quadrature.rule == "midpoint":
+        return lidf_batch(lidftype, lidfa, lidfb, quadrature.n_nodes)
+    return lidf_density_batch(
+        lidftype, lidfa, lidfb, quadrature.angles, quadrature.weights
+    )
+
+
+def _campbell_table(resolution, quadrature):
+    """Campbell LIDFs for ``lidfa`` = 0 to 90 degrees, with ``resolution``
+    nodes per degree."""
+    n_nodes = 90 * resolution + 1
+    lidfa = np.arange(n_nodes) / resolution
+    return quadrature_lidf(
+        np.full(n_nodes, 2), lidfa, np.zeros(n_nodes), quadrature
+    )
+
+
+def _bimodal_table(resolution, quadrature):
+    """Verhoef bimodal LIDFs for ``a`` and ``b`` between -1 and 1, with
+    ``resolution`` nodes per unit. The nodes outside of ``|a| + |b| <= 1``
+    are NaN."""
+    n_nodes = 2 * resolution + 1
+    i, j = np.indices((n_nodes, n_nodes)) - resolution
+    valid = np.abs(i) + np.abs(j) <= resolution
+    table = np.full((n_nodes, n_nodes, quadrature.n_nodes), np.nan)
+    table[valid] = quadrature_lidf(
+        np.ones(np.count_nonzero(valid)),
+        i[valid] / resolution,
+        j[valid] / resolution,
+        quadrature,
+    )
+    return table
+
+
+def _interpolation_error(table, axis):
+    """Bound of the linear interpolation error of the cells of ``table``
+    along ``axis``, from the second differences at the nodes: ``h^2 |f''|
+    / 8``, with the largest second difference at either end of the cell
+    and over the angle bins."""
+    second = np.abs(np.diff(table, n=2, axis=axis)).max(axis=-1) / 8.0
+    pad = [(0, 0)] * second.ndim
+    pad[axis] = (1, 1)
+    second = np.pad(second, pad, mode="edge")
+    lower = [slice(None)] * second.ndim
+    upper = [slice(None)] * second.ndim
+    lower[axis] = slice(None, -1)
+    upper[axis] = slice(1, None)
+    error = np.maximum(second[tuple(lower)], second[tuple(upper)])
+    # NaN (cells touching the nodes with |a| + |b| > 1) is never accepted
+    return np.where(np.isnan(error), np.inf, error)
+
+
+class LIDFTable(object):
+    """Precomputed leaf inclination distribution functions.
+
+    Campbell's LIDF is tabulated every ``1 / campbell_resolution`` degrees
+    of ``lidfa``, and Verhoef's bimodal LIDF every ``1 / bimodal_resolution``
+    of ``a`` and ``b``. The tables are built the first time that they are
+    needed, and shared by all the callers in the process (see
+    :data:`lidf_table`). Parameters on the nodes (e.g. ``lidfa=57.0``) get
+    the tabulated LIDF, which is exactly what :func:`campbell` and
+    :func:`verhoef_bimodal` return. Parameters between the nodes are
+    recomputed, unless ``tolerance`` is given: the LIDF is then linearly
+    interpolated between the nodes if the interpolation error bound of the
+    cell is below ``tolerance``. There is one table per LIDF type and
+    :func:`leaf_angle_quadrature`, and ``quadrature`` is the one used by
+    4SAIL in this process.
+
+    Parameters
+    ----------
+    campbell_resolution : int, optional
+        Nodes per degree of the Campbell table.
+    bimodal_resolution : int, optional
+        Nodes per unit of ``a`` and ``b`` of the bimodal table.
+    tolerance : float or None, optional
+        Largest interpolation error accepted in each of the LIDF bins. By
+        default, off-node LIDFs are recomputed exactly. It can be changed
+        at any time.
+    quadrature : Quadrature, optional
+        The default quadrature of the leaf inclination integrals, see
+        :func:`leaf_angle_quadrature`. By default, 18 midpoint bins. It can
+        be changed at any time.
+    max_nodes : int, optional
+        Quadratures with more nodes than this (e.g. reference runs) are not
+        tabulated, and their LIDFs are always computed. By default, only
+        the 4SAIL quadrature and smaller ones are tabulated.
+    """
+
+    def __init__(
+        self,
+        campbell_resolution=100,
+        bimodal_resolution=100,
+        tolerance=None,
+        quadrature=None,
+        max_nodes=18,
+    ):
+        self._lock = threading.Lock()
+        self.campbell_resolution = int(campbell_resolution)
+        self.bimodal_resolution = int(bimodal_resolution)
+        self.tolerance = tolerance
+        if quadrature is None:
+            quadrature = leaf_angle_quadrature()
+        self.quadrature = quadrature
+        self.max_nodes = max_nodes
+        self._tables = {}
+
+    def _table(self, kind, quadrature):
+        # The tables (and their interpolation error bounds) are only built
+        # for the LIDF types and quadratures that are used
+        key = (kind, quadrature.rule, quadrature.n_nodes)
+        with self._lock:
+            if key in self._tables:
+                return self._tables[key]
+            if kind == "bimodal":
+                table = _bimodal_table(self.bimodal_resolution, quadrature)
+                error_a = _interpolation_error(table, 0)
+                error_b = _interpolation_error(table, 1)
+                error = np.maximum(
+                    error_a[:, :-1], error_a[:, 1:]
+                ) + np.maximum(error_b[:-1], error_b[1:])
+            else:
+                table = _campbell_table(self.campbell_resolution, quadrature)
+                error = _interpolation_error(table, 0)
+            table.setflags(write=False)
+            self._tables[key] = (table, error)
+            return table, error
+
+    def __call__(self, lidftype, lidfa, lidfb=0.0, quadrature=None):
+        """The LIDF of one canopy."""
+        lidf = self.batch(
+            np.array([lidftype], dtype=np.int64),
+            np.array([lidfa], dtype=np.float64),
+            np.array([lidfb], dtype=np.float64),
+            quadrature=quadrature,
+        )
+        return lidf[0]
+
+    def batch(self, lidftype, lidfa, lidfb, quadrature=None):
+        """The LIDFs of a batch of canopies at the nodes of ``quadrature``
+        (by default, :attr:`quadrature`), as a ``(n_samples, n_nodes)``
+        array."""
+        if quadrature is None:
+            quadrature = self.quadrature
+        lidftype = np.asarray(lidftype, dtype=np.int64)
+        lidfa = np.asarray(lidfa, dtype=np.float64)
+        lidfb = np.asarray(lidfb, dtype=np.float64)
+        lidf = np.empty((len(lidftype), quadrature.n_nodes))
+        todo = np.ones(len(lidftype), dtype=bool)
+        bimodal = lidftype == 1
+        if quadrature.n_nodes <= self.max_nodes:
+            if np.any(~bimodal):
+                self._lookup_campbell(
+                    lidfa, ~bimodal, lidf, todo, quadrature
+                )
+            if np.any(bimodal):
+                self._lookup_bimodal(
+                    lidfa, lidfb, bimodal, lidf, todo, quadrature
+                )
+        if np.any(todo):
+            lidf[todo] = quadrature_lidf(
+                lidftype[todo], lidfa[todo], lidfb[todo], quadrature
+            )
+        return lidf
+
+    def _lookup_campbell(self, lidfa, mask, lidf, todo, quadrature):
+        table, error = self._table("campbell", quadrature)
+        resolution = self.campbell_resolution
+        n_cells = table.shape[0] - 1
+        x = np.where(mask, lidfa * resolution, np.nan)
+        node = np.rint(x)
+        on_node = mask & (node / resolution == lidfa) & (node >= 0) & (
+            node <= n_cells
+        )
+        lidf[on_node] = table[node[on_node].astype(np.int64)]
+        todo[on_node] = False
+        if self.tolerance is None:
+            return
+        cell = np.floor(x)
+        inside = mask & ~on_node & (cell >= 0) & (cell < n_cells)
+        cell = np.where(inside, cell, 0).astype(np.int64)
+        inside &= error[cell] <= self.tolerance
+        weight = (x - cell)[inside, None]
+        cell = cell[inside]
+        lidf[inside] = (1.0 - weight) * table[cell] + weight * table[cell + 1]
+        todo[inside] = False
+
+    def _lookup_bimodal(self, lidfa, lidfb, mask, lidf, todo, quadrature):
+        table, error = self._table("bimodal", quadrature)
+        resolution = self.bimodal_resolution
+        n_cells = table.shape[0] - 1
+        x = np.where(mask, (lidfa + 1.0) * resolution, np.nan)
+        y = np.where(mask, (lidfb + 1.0) * resolution, np.nan)
+        node_a = np.rint(lidfa * resolution)
+        node_b = np.rint(lidfb * resolution)
+        on_node = (
+            mask
+            & (node_a / resolution == lidfa)
+            & (node_b / resolution == lidfb)
+            & (np.abs(node_a) + np.abs(node_b) <= resolution)
+        )
+        rows = (node_a[on_node] + resolution).astype(np.int64)
+        columns = (node_b[on_node] + resolution).astype(np.int64)
+        lidf[on_node] = table[rows, columns]
+        todo[on_node] = False
+        if self.tolerance is None:
+            return
+        cell_a = np.floor(x)
+        cell_b = np.floor(y)
+        inside = (
+            mask
+            & ~on_node
+            & (cell_a >= 0)
+            & (cell_a < n_cells)
+            & (cell_b >= 0)
+            & (cell_b < n_cells)
+        )
+        cell_a = np.where(inside, cell_a, 0).astype(np.int64)
+        cell_b = np.where(inside, cell_b, 0).astype(np.int64)
+        inside &= error[cell_a, cell_b] <= self.tolerance
+        wa = (x - cell_a)[inside, None]
+        wb = (y - cell_b)[inside, None]
+        i = cell_a[inside]
+        j = cell_b[inside]
+        lidf[inside] = (1.0 - wa) * (
+            (1.0 - wb) * table[i, j] + wb * table[i, j + 1]
+        ) + wa * ((1.0 - wb) * table[i + 1, j] + wb * table[i + 1, j + 1])
+        todo[inside] = False
+
+    def info(self):
+        """The size in bytes of the tables that are built, keyed by LIDF
+        type ("campbell" or "bimodal"), quadrature rule and number of
+        nodes."""
+        with self._lock:
+            return {
+                key: table.nbytes for key, (table, _) in self._tables.items()
+            }
+
+    def clear(self):
+        """Drops the tables, which are rebuilt when next needed."""
+        with self._lock:
+            self._tables.clear()
+
+
+# Shared by all the foursail calls in this process
+lidf_table = LIDFTable()
+
+
+def spectral_dtype(*spectra):
+    """Precision of the spectral terms of 4SAIL: float32 if the leaf and soil
+    ``spectra`` are all float32 arrays (or numpy scalars), float64
+    otherwise, including when any of them is a Python scalar. The
+    wavelength-independent terms are computed in float64, and cast to this
+    dtype before being combined with the spectra."""
+    return np.result_type(
+        np.float32, *[np.asarray(spectrum) for spectrum in spectra]
+    )
+
+
 def foursail(
-    rho, tau, lidfa, lidfb, lidftype, lai, hotspot, tts, tto, psi, rsoil
+    rho,
+    tau,
+    lidfa,
+    lidfb,
+    lidftype,
+    lai,
+    hotspot,
+    tts,
+    tto,
+    psi,
+    rsoil,
+    outputs=None,
+    out=None,
 ):
     """
     Parameters
@@ -383,9 +924,21 @@ def foursail(
         Relative Sensor-Sun Azimuth Angle (degrees).
     rsoil : array_like
         soil lambertian reflectance.
+    outputs : iterable of str, optional
+        Names of the terms to compute (see :data:`SAIL_TERMS`). Only the
+        intermediate quantities these terms depend on are evaluated, and the
+        terms that were not requested are returned as ``None``. By default,
+        all the terms are computed.
+    out : array_like, optional
+        ``(21,) + shape`` float array where the terms are written, e.g. a
+        buffer reused over many calls. ``shape`` is the broadcast shape of
+        ``rho``, ``tau`` and ``rsoil``. A new one is allocated if not given.
 
     Returns
     -------
+    A :class:`SailResult` with the following terms, all of them with the
+    shape of the spectra, also when there is no canopy:
+
     tss : array_like
         beam transmittance in the sun-target path.
     too : array_like
@@ -437,112 +990,1063 @@ def foursail(
         http://dx.doi.org/10.1109/TGRS.2007.895844 based on  in Verhoef et al. (2007).
     """
 
-    # Define some geometric constants.
-    cts, cto, ctscto, tants, tanto, cospsi, dso = define_geometric_constants(
-        tts, tto, psi
+    required = required_terms(outputs)
+    dtype = spectral_dtype(rho, tau, rsoil)
+    result = SailResult.empty(
+        np.broadcast(rho, tau, rsoil).shape, required[0], out, dtype
     )
-
-    # Calcualte leaf angle distribution
-    if lidftype == 1:
-        lidf = verhoef_bimodal(lidfa, lidfb, n_elements=18)
-    elif lidftype == 2:
-        lidf = campbell(lidfa, n_elements=18)
-    else:
-        raise ValueError(
-            "lidftype can only be 1 (Campbell) or 2 (ellipsoidal)"
+    ks, ko, bf, sob, sof, tss, too, tsstoo, sumint = [
+        dtype.type(term)
+        for term in canopy_structure(
+            lidfa, lidfb, lidftype, lai, hotspot, tts, tto, psi
         )
-    # Calculate geometric factors associated with extinction and scattering
-    # Initialise sums
-    ks = 0.0
-    ko = 0.0
-    bf = 0.0
-    sob = 0.0
-    sof = 0.0
-
-    ks, ko, bf, sob, sof = weighted_sum_over_lidf(lidf, tts, tto, psi)
-
-    # Geometric factors to be used later with rho and tau
-    sdb = 0.5 * (ks + bf)
-    sdf = 0.5 * (ks - bf)
-    dob = 0.5 * (ko + bf)
-    dof = 0.5 * (ko - bf)
-    ddb = 0.5 * (1.0 + bf)
-    ddf = 0.5 * (1.0 - bf)
-
-    sigb = ddb * rho + ddf * tau
-    sigf = ddf * rho + ddb * tau
-    try:
-        sigf[sigf == 0.0] = 1.0e-36
-        sigb[sigb == 0.0] = 1.0e-36
-    except TypeError:
-        sigf = max(1e-36, sigf)
-        sigb = max(1e-36, sigb)
-    att = 1.0 - sigf
-    m = np.sqrt(att**2.0 - sigb**2.0)
-    sb = sdb * rho + sdf * tau
-    sf = sdf * rho + sdb * tau
-    vb = dob * rho + dof * tau
-    vf = dof * rho + dob * tau
-    w = sob * rho + sof * tau
+    ]
 
     if lai <= 0:
         # No canopy...
-        tss = 1
-        too = 1
-        tsstoo = 1
-        rdd = 0
-        tdd = 1
-        rsd = 0
-        tsd = 0
-        rdo = 0
-        tdo = 0
-        rso = 0
-        rsos = 0
-        rsod = 0
-        rddt = rsoil
-        rsdt = rsoil
-        rdot = rsoil
-        rsodt = 0
-        rsost = rsoil
-        rsot = rsoil
-        gammasdf = 0
-        gammaso = 0
-        gammasdb = 0
-
-        return [
-            tss,
-            too,
-            tsstoo,
-            rdd,
-            tdd,
-            rsd,
-            tsd,
-            rdo,
-            tdo,
-            rso,
-            rsos,
-            rsod,
-            rddt,
-            rsdt,
-            rdot,
-            rsodt,
-            rsost,
-            rsot,
-            gammasdf,
-            gammasdb,
-            gammaso,
-        ]
+        result.fill_no_canopy(rsoil)
+        return result
 
-    e1 = np.exp(-m * lai)
-    e2 = e1**2.0
-    rinf = (att - m) / sigb
-    rinf2 = rinf**2.0
-    re = rinf * e1
+    terms = _sail_spectral(
+        rho,
+        tau,
+        rsoil,
+        dtype.type(lai),
+        ks,
+        ko,
+        bf,
+        sob,
+        sof,
+        tss,
+        too,
+        tsstoo,
+        sumint,
+        required,
+    )
+    result.fill(terms)
+    return result
+
+
+# Names of the terms returned by foursail, in order
+SAIL_TERMS = (
+    "tss",
+    "too",
+    "tsstoo",
+    "rdd",
+    "tdd",
+    "rsd",
+    "tsd",
+    "rdo",
+    "tdo",
+    "rso",
+    "rsos",
+    "rsod",
+    "rddt",
+    "rsdt",
+    "rdot",
+    "rsodt",
+    "rsost",
+    "rsot",
+    "gammasdf",
+    "gammasdb",
+    "gammaso",
+)
+
+# What each term needs, besides the terms that are always computed (tss,
+# too, tsstoo, rdd, tdd and the soil coupling denominator). "Jks" and "Jko"
+# stand for the J functions of the sun and view paths, "Pss" for the solar
+# source terms Pss and Qss, and "sod" for the g1, g2, Tv1 and Tv2 terms.
+_SAIL_DEPENDENCIES = {
+    "rsd": ("Pss",),
+    "tsd": ("Pss",),
+    "Pss": ("Jks",),
+    "rdo": ("Jko",),
+    "tdo": ("Jko",),
+    "sod": ("Jks", "Jko"),
+    "rso": ("rsos", "rsod"),
+    "rsod": ("rdo", "tdo", "Pss", "sod"),
+    "rsdt": ("rsd", "tsd"),
+    "rdot": ("rdo", "tdo"),
+    "rsodt": ("tsd", "tdo", "rsod"),
+    "rsost": ("rso",),
+    "rsot": ("rsost", "rsodt"),
+    "gammasdf": ("Jks",),
+    "gammasdb": ("Jks",),
+    "gammaso": ("rdo", "tdo", "sod"),
+}
+
+
+@lru_cache(maxsize=64)
+def _dependency_closure(outputs):
+    required = set()
+    pending = list(outputs)
+    while pending:
+        term = pending.pop()
+        if term not in required:
+            required.add(term)
+            pending.extend(_SAIL_DEPENDENCIES.get(term, ()))
+    return frozenset(outputs), frozenset(required)
+
+
+def required_terms(outputs=None):
+    """Resolves the terms requested from :func:`foursail` into the set of
+    quantities that need to be computed.
+
+    Parameters
+    ----------
+    outputs : iterable of str, optional
+        Names of the requested terms (see :data:`SAIL_TERMS`). ``None``
+        requests all of them.
+
+    Returns
+    -------
+    outputs : frozenset
+        The requested terms.
+    required : frozenset
+        The requested terms and all the intermediate quantities they depend
+        on.
+    """
+    if outputs is None:
+        outputs = SAIL_TERMS
+    elif isinstance(outputs, str):
+        outputs = (outputs,)
+    outputs = tuple(sorted(set(outputs)))
+    unknown = set(outputs).difference(SAIL_TERMS)
+    if unknown:
+        raise ValueError(
+            "Unknown SAIL outputs: %s" % ", ".join(sorted(unknown))
+        )
+    return _dependency_closure(outputs)
+
+
+ALL_TERMS = required_terms()
+
+
+# Values of the 4SAIL terms without a canopy. ``None`` stands for the soil
+# reflectance.
+_NO_CANOPY_TERMS = (
+    1.0, 1.0, 1.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+    None, None, None, 0.0, None, None, 0.0, 0.0, 0.0,
+)
+
+
+class SailResult(object):
+    """The terms computed by :func:`foursail` and friends, stored as the
+    rows of one contiguous ``(21,) + shape`` array. Each term is available
+    as a (view) attribute named as in :data:`SAIL_TERMS`, by position or by
+    name, and the result can be unpacked like the list of 21 terms that
+    :func:`foursail` used to return. Terms that were not requested are
+    ``None``, and their rows in :attr:`data` are left undefined.
+
+    Parameters
+    ----------
+    data : array_like
+        ``(21,) + shape`` float array with the terms.
+    outputs : iterable of str, optional
+        Names of the terms that were computed. All of them by default.
+    """
+
+    __slots__ = ("data", "outputs")
+
+    def __init__(self, data, outputs=None):
+        if data.shape[:1] != (len(SAIL_TERMS),):
+            raise ValueError(
+                "data must have %d rows, one per term" % len(SAIL_TERMS)
+            )
+        self.data = data
+        if outputs is None:
+            outputs = SAIL_TERMS
+        self.outputs = frozenset(outputs)
+
+    @classmethod
+    def empty(cls, shape, outputs=None, out=None, dtype=np.float64):
+        """Result with uninitialised terms of the given ``shape`` and
+        ``dtype``, written into ``out`` if given."""
+        shape = (len(SAIL_TERMS),) + tuple(shape)
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError(
+                "out has shape %s, but %s is needed" % (out.shape, shape)
+            )
+        return cls(out, outputs)
+
+    @property
+    def shape(self):
+        """Shape of each of the terms."""
+        return self.data.shape[1:]
+
+    def __len__(self):
+        return len(SAIL_TERMS)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(len(SAIL_TERMS))[key]]
+        if isinstance(key, str):
+            try:
+                key = SAIL_TERMS.index(key)
+            except ValueError:
+                raise KeyError(key)
+        if SAIL_TERMS[key] not in self.outputs:
+            return None
+        return self.data[key]
+
+    def __iter__(self):
+        for i in range(len(SAIL_TERMS)):
+            yield self[i]
+
+    def __repr__(self):
+        return "SailResult(shape=%s, outputs=%d/%d)" % (
+            self.shape,
+            len(self.outputs),
+            len(SAIL_TERMS),
+        )
+
+    def as_dict(self):
+        """The computed terms, keyed by name."""
+        return {
+            name: self.data[i]
+            for i, name in enumerate(SAIL_TERMS)
+            if name in self.outputs
+        }
+
+    def fill(self, terms, where=Ellipsis):
+        """Copies ``terms`` (in :data:`SAIL_TERMS` order) into the computed
+        rows, restricted to the ``where`` index of each term."""
+        for i, (name, term) in enumerate(zip(SAIL_TERMS, terms)):
+            if name in self.outputs and term is not None:
+                self.data[i, where] = term
+
+    def fill_no_canopy(self, rsoil, where=Ellipsis):
+        """Sets the terms (restricted to the ``where`` index) to their
+        values without a canopy, where the surface is just the soil."""
+        rsoil = np.broadcast_to(rsoil, self.shape)[where]
+        self.fill(
+            [rsoil if value is None else value for value in _NO_CANOPY_TERMS],
+            where,
+        )
+
+
+def _term_property(index, name):
+    def getter(self):
+        return self[index]
+
+    return property(getter, doc="The ``%s`` term." % name)
+
+
+for _index, _name in enumerate(SAIL_TERMS):
+    setattr(SailResult, _name, _term_property(_index, _name))
+del _index, _name
+
+
+def geometric_coefficients(
+    lidftype, lidfa, lidfb, tts, tto, psi, quadrature=None
+):
+    """Extinction and scattering coefficients weighted over the leaf
+    inclination distribution, and the hotspot distance term, for one
+    canopy LIDF and sun-view geometry. The integrals over the leaf
+    inclination use ``quadrature`` (by default, ``lidf_table.quadrature``),
+    see :func:`leaf_angle_quadrature`.
+
+    Returns
+    -------
+    ks, ko, bf, sob, sof, dso : float
+    """
+    # Define some geometric constants.
+    cts, cto, ctscto, tants, tanto, cospsi, dso = define_geometric_constants(
+        tts, tto, psi
+    )
+
+    # Calcualte leaf angle distribution
+    if lidftype not in (1, 2):
+        raise ValueError(
+            "lidftype can only be 1 (bimodal) or 2 (ellipsoidal)"
+        )
+    if quadrature is None:
+        quadrature = lidf_table.quadrature
+    # For one canopy, solving the LIDF is faster than the table lookup
+    if quadrature.rule == "midpoint" and lidftype == 1:
+        lidf = verhoef_bimodal(lidfa, lidfb, quadrature.n_nodes)
+    elif quadrature.rule == "midpoint":
+        lidf = campbell(lidfa, quadrature.n_nodes)
+    else:
+        lidf = quadrature_lidf([lidftype], [lidfa], [lidfb], quadrature)[0]
+    # Calculate geometric factors associated with extinction and scattering
+    ks, ko, bf, sob, sof = weighted_sum_over_angles(
+        lidf, quadrature.angles, tts, tto, psi
+    )
+    return ks, ko, bf, sob, sof, dso
+
+
+def quadrature_error(lidftype, lidfa, lidfb, tts, tto, psi, quadrature=None):
+    """Error estimate of the ``ks, ko, bf, sob, sof`` coefficients of
+    :func:`geometric_coefficients` with ``quadrature``, from their
+    difference with the same rule on twice as many nodes. Both rules
+    converge as ``1 / n_nodes^2``, so the error is about 4/3 of this
+    difference (Richardson extrapolation). This is an estimate, not a
+    bound: it is only reliable once the quadrature is in its asymptotic
+    regime, and can be too small, e.g. with very few nodes.
+
+    Returns
+    -------
+    A ``(5,)`` array with the absolute errors of ``ks, ko, bf, sob, sof``.
+    """
+    if quadrature is None:
+        quadrature = lidf_table.quadrature
+    finer = leaf_angle_quadrature(2 * quadrature.n_nodes, quadrature.rule)
+    coarse = geometric_coefficients(
+        lidftype, lidfa, lidfb, tts, tto, psi, quadrature=quadrature
+    )
+    fine = geometric_coefficients(
+        lidftype, lidfa, lidfb, tts, tto, psi, quadrature=finer
+    )
+    return 4.0 / 3.0 * np.abs(np.subtract(coarse[:5], fine[:5]))
+
+
+_unset = object()
+
+CacheInfo = namedtuple(
+    "CacheInfo", "hits misses evictions maxsize currsize policy"
+)
+
+
+class GeometryCache(object):
+    """Cache of :func:`geometric_coefficients`, keyed by
+    ``(lidftype, lidfa, lidfb, tts, tto, psi)``. Scenes where the same
+    canopy LIDF and geometry repeat over many pixels only compute the
+    LIDF and the 18 volume scattering terms once.
+
+    Parameters
+    ----------
+    maxsize : int or None, optional
+        Maximum number of entries. ``None`` means unbounded, and 0 disables
+        the cache.
+    policy : str, optional
+        What entry to evict when the cache is full: "lru" (least recently
+        used, the default) or "fifo" (oldest inserted).
+    """
+
+    _policies = ("lru", "fifo")
+
+    def __init__(self, maxsize=4096, policy="lru"):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.maxsize = maxsize
+        self.policy = "lru"
+        self.clear()
+        self.configure(maxsize=maxsize, policy=policy)
+
+    def configure(self, maxsize=_unset, policy=None):
+        """Changes the capacity and/or the eviction policy. Arguments that
+        are not given are left as they are. If the new capacity is smaller
+        than the current size, the entries that the policy would evict first
+        are dropped."""
+        if policy is not None:
+            policy = policy.lower()
+            if policy not in self._policies:
+                raise ValueError("policy can only be 'lru' or 'fifo'")
+            self.policy = policy
+        if maxsize is not _unset:
+            if maxsize is not None and maxsize < 0:
+                raise ValueError("maxsize can't be negative")
+            self.maxsize = maxsize
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        while self.maxsize is not None and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __call__(self, lidftype, lidfa, lidfb, tts, tto, psi,
+                 quadrature=None):
+        if lidftype == 2:
+            # lidfb is ignored by Campbell's LIDF
+            lidfb = 0.0
+        if quadrature is None:
+            quadrature = lidf_table.quadrature
+        key = (
+            lidftype, lidfa, lidfb, tts, tto, psi, quadrature.rule,
+            quadrature.n_nodes,
+        )
+        with self._lock:
+            try:
+                coefficients = self._entries[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if self.policy == "lru":
+                    self._entries.move_to_end(key)
+                return coefficients
+
+        coefficients = geometric_coefficients(
+            lidftype, lidfa, lidfb, tts, tto, psi, quadrature=quadrature
+        )
+        if self.maxsize != 0:
+            with self._lock:
+                self._entries[key] = coefficients
+                self._evict()
+        return coefficients
+
+    def info(self):
+        """Hit, miss and eviction counters, and the current configuration."""
+        return CacheInfo(
+            self.hits,
+            self.misses,
+            self.evictions,
+            self.maxsize,
+            len(self._entries),
+            self.policy,
+        )
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+# Shared by all the foursail calls in this process
+geometry_cache = GeometryCache()
+
+
+def canopy_structure(lidfa, lidfb, lidftype, lai, hotspot, tts, tto, psi):
+    """Wavelength-independent 4SAIL terms for one canopy and geometry.
+
+    Returns
+    -------
+    ks, ko, bf, sob, sof : float
+        Extinction and scattering coefficients weighted by the LIDF.
+    tss, too, tsstoo : float
+        Beam transmittances in the sun, view and sun-view paths.
+    sumint : float
+        Hotspot integral.
+    """
+    ks, ko, bf, sob, sof, dso = geometry_cache(
+        lidftype, lidfa, lidfb, tts, tto, psi
+    )
+    if lai <= 0:
+        return ks, ko, bf, sob, sof, 1.0, 1.0, 1.0, 0.0
+
+    tss = np.exp(-ks * lai)
+    too = np.exp(-ko * lai)
+    # Treatment of the hotspot-effect
+    alf = 1e36
+    # Apply correction 2/(K+k) suggested by F.-M. Breon
+    if hotspot > 0.0:
+        alf = (dso / hotspot) * 2.0 / (ks + ko)
+    if alf == 0.0:
+        # The pure hotspot
+        tsstoo = tss
+        sumint = (1.0 - tss) / (ks * lai)
+    else:
+        # Outside the hotspot
+        tsstoo, sumint = hotspot_calculations(alf, lai, ko, ks)
+    return ks, ko, bf, sob, sof, tss, too, tsstoo, sumint
+
+
+def _sail_spectral(
+    rho,
+    tau,
+    rsoil,
+    lai,
+    ks,
+    ko,
+    bf,
+    sob,
+    sof,
+    tss,
+    too,
+    tsstoo,
+    sumint,
+    required=ALL_TERMS,
+):
+    """Spectral part of 4SAIL. All the canopy structure and geometry terms
+    (``lai`` to ``sumint``) must broadcast against the leaf and soil spectra,
+    so they can either be scalars or ``(n_samples, 1)`` columns. ``required``
+    is the output of :func:`required_terms`."""
+    scattering = _sail_scattering(rho, tau, ks, bf)
+    view_scattering = _sail_view_scattering(rho, tau, ko, bf, sob, sof)
+    diffuse = _sail_view_independent(
+        scattering, rsoil, lai, ks, tss, required
+    )
+    return _sail_view_dependent(
+        diffuse, scattering, view_scattering, rsoil, lai, ks, ko, tss, too,
+        tsstoo, sumint, required,
+    )
+
+
+_ScatteringTerms = namedtuple("_ScatteringTerms", "sb sf m rinf rinf2")
+_ViewScatteringTerms = namedtuple("_ViewScatteringTerms", "vb vf w")
+_ViewIndependentTerms = namedtuple(
+    "_ViewIndependentTerms",
+    "re denom J1ks J2ks Pss Qss tdd rdd tsd rsd gammasdf gammasdb dn rddt "
+    "rsdt",
+)
+
+
+def _sail_scattering(rho, tau, ks, bf):
+    """Scattering and attenuation terms of the diffuse and solar fluxes.
+    They depend neither on LAI nor on the view direction."""
+    # Geometric factors to be used later with rho and tau
+    sdb = 0.5 * (ks + bf)
+    sdf = 0.5 * (ks - bf)
+    ddb = 0.5 * (1.0 + bf)
+    ddf = 0.5 * (1.0 - bf)
+
+    sigb = ddb * rho + ddf * tau
+    sigf = ddf * rho + ddb * tau
+    sigf = np.where(sigf == 0.0, 1.0e-36, sigf)
+    sigb = np.where(sigb == 0.0, 1.0e-36, sigb)
+    att = 1.0 - sigf
+    m = np.sqrt(att**2.0 - sigb**2.0)
+    sb = sdb * rho + sdf * tau
+    sf = sdf * rho + sdb * tau
+    rinf = (att - m) / sigb
+    rinf2 = rinf**2.0
+    return _ScatteringTerms(sb, sf, m, rinf, rinf2)
+
+
+def _sail_view_scattering(rho, tau, ko, bf, sob, sof):
+    """Scattering terms towards the view direction. They don't depend on
+    LAI."""
+    dob = 0.5 * (ko + bf)
+    dof = 0.5 * (ko - bf)
+    vb = dob * rho + dof * tau
+    vf = dof * rho + dob * tau
+    w = sob * rho + sof * tau
+    return _ViewScatteringTerms(vb, vf, w)
+
+
+def _sail_view_independent(
+    scattering, rsoil, lai, ks, tss, required=ALL_TERMS
+):
+    """Terms of the spectral part of 4SAIL that don't depend on the view
+    direction, and can be shared by many views of the same canopy. The
+    terms that are not in ``required`` are set to ``None``."""
+    required = required[1]
+    sb, sf, m, rinf, rinf2 = scattering
+    e1 = np.exp(-m * lai)
+    e2 = e1**2.0
+    re = rinf * e1
     denom = 1.0 - rinf2 * e2
-    J1ks = Jfunc1(ks, m, lai)
-    J2ks = Jfunc2(ks, m, lai)
-    J1ko = Jfunc1(ko, m, lai)
-    J2ko = Jfunc2(ko, m, lai)
+    J1ks = J2ks = Pss = Qss = tsd = rsd = gammasdf = gammasdb = None
+    rddt = rsdt = None
+    if "Jks" in required:
+        J1ks = Jfunc1(ks, m, lai)
+        J2ks = Jfunc2(ks, m, lai)
+    if "Pss" in required:
+        Pss = (sf + sb * rinf) * J1ks
+        Qss = (sf * rinf + sb) * J2ks
+    tdd = (1.0 - rinf2) * e1 / denom
+    rdd = rinf * (1.0 - e2) / denom
+    if "tsd" in required:
+        tsd = (Pss - re * Qss) / denom
+    if "rsd" in required:
+        rsd = (Qss - re * Pss) / denom
+    # Thermal "sd" quantities
+    if "gammasdf" in required:
+        gammasdf = (1.0 + rinf) * (J1ks - re * J2ks) / denom
+    if "gammasdb" in required:
+        gammasdb = (1.0 + rinf) * (-re * J1ks + J2ks) / denom
+    # Interaction with the soil
+    dn = 1.0 - rsoil * rdd
+    dn = np.where(dn < 1e-36, 1e-36, dn)
+    if "rddt" in required:
+        rddt = rdd + tdd * rsoil * tdd / dn
+    if "rsdt" in required:
+        rsdt = rsd + (tsd + tss) * rsoil * tdd / dn
+    return _ViewIndependentTerms(
+        re, denom, J1ks, J2ks, Pss, Qss, tdd, rdd, tsd, rsd, gammasdf,
+        gammasdb, dn, rddt, rsdt,
+    )
+
+
+def _sail_view_dependent(
+    diffuse,
+    scattering,
+    view_scattering,
+    rsoil,
+    lai,
+    ks,
+    ko,
+    tss,
+    too,
+    tsstoo,
+    sumint,
+    required=ALL_TERMS,
+):
+    """Completes the spectral part of 4SAIL for one or many view directions,
+    given the output of :func:`_sail_view_independent`. Returns the 21
+    terms of :func:`foursail`, with ``None`` in place of the ones that
+    ``required`` didn't need."""
+    sb, sf, m, rinf, rinf2 = scattering
+    vb, vf, w = view_scattering
+    (
+        re, denom, J1ks, J2ks, Pss, Qss, tdd, rdd, tsd, rsd, gammasdf,
+        gammasdb, dn, rddt, rsdt,
+    ) = diffuse
+    needed = required[1]
+    J1ko = J2ko = tdo = rdo = rsod = gammaso = None
+    rso = rsos = rdot = rsodt = rsost = rsot = None
+    if "Jko" in needed:
+        J1ko = Jfunc1(ko, m, lai)
+        J2ko = Jfunc2(ko, m, lai)
+        Pv = (vf + vb * rinf) * J1ko
+        Qv = (vf * rinf + vb) * J2ko
+        tdo = (Pv - re * Qv) / denom
+        rdo = (Qv - re * Pv) / denom
+    if "sod" in needed:
+        z = Jfunc2(ks, ko, lai)
+        g1 = (z - J1ks * too) / (ko + m)
+        g2 = (z - J1ko * tss) / (ks + m)
+        Tv1 = (vf * rinf + vb) * g1
+        Tv2 = (vf + vb * rinf) * g2
+    if "rsod" in needed:
+        T1 = Tv1 * (sf + sb * rinf)
+        T2 = Tv2 * (sf * rinf + sb)
+        T3 = (rdo * Qss + tdo * Pss) * rinf
+        # Multiple scattering contribution to bidirectional canopy
+        # reflectance
+        rsod = (T1 + T2 - T3) / (1.0 - rinf2)
+    if "gammaso" in needed:
+        # Thermal "sod" quantity
+        T4 = Tv1 * (1.0 + rinf)
+        T5 = Tv2 * (1.0 + rinf)
+        T6 = (rdo * J2ks + tdo * J1ks) * (1.0 + rinf) * rinf
+        gammasod = (T4 + T5 - T6) / (1.0 - rinf2)
+        gammasos = ko * lai * sumint
+        gammaso = gammasos + gammasod
+
+    # Bidirectional reflectance
+    # Single scattering contribution
+    if "rsos" in needed:
+        rsos = w * lai * sumint
+    # Total canopy contribution
+    if "rso" in needed:
+        rso = rsos + rsod
+    # Interaction with the soil
+    if "rdot" in needed:
+        rdot = rdo + tdd * rsoil * (tdo + too) / dn
+    if "rsodt" in needed:
+        rsodt = (
+            (tss + tsd) * tdo + (tsd + tss * rsoil * rdd) * too
+        ) * rsoil / dn + rsod
+    if "rsost" in needed:
+        rsost = rso + tsstoo * rsoil
+    if "rsot" in needed:
+        rsot = rsost + rsodt
+
+    terms = [
+        tss,
+        too,
+        tsstoo,
+        rdd,
+        tdd,
+        rsd,
+        tsd,
+        rdo,
+        tdo,
+        rso,
+        rsos,
+        rsod,
+        rddt,
+        rsdt,
+        rdot,
+        rsodt,
+        rsost,
+        rsot,
+        gammasdf,
+        gammasdb,
+        gammaso,
+    ]
+    return terms
+
+
+def foursail_multiview(
+    rho,
+    tau,
+    lidfa,
+    lidfb,
+    lidftype,
+    lai,
+    hotspot,
+    tts,
+    tto,
+    psi,
+    rsoil,
+    outputs=None,
+    out=None,
+):
+    """Runs 4SAIL for one canopy and sun position, and many view directions.
+    The terms that don't depend on the view direction (the diffuse and
+    sun-related fluxes, e.g. ``m``, ``rinf``, ``tdd``, ``rdd``, ``tsd``,
+    ``rsd``) are computed only once, and then the view-dependent ones are
+    computed in a loop over the views, reusing them. This makes BRDF
+    sampling and multi-angular sensor simulation much cheaper than calling
+    :func:`foursail` per view.
+
+    Parameters
+    ----------
+    rho, tau, lidfa, lidfb, lidftype, lai, hotspot, tts, rsoil, outputs
+        See :func:`foursail`.
+    out : array_like, optional
+        ``(21, n_views) + shape`` float array where the terms are written.
+    tto : array_like
+        View(sensor) Zenith Angles (degrees), ``(n_views,)``.
+    psi : array_like
+        Relative Sensor-Sun Azimuth Angles (degrees), ``(n_views,)``.
+
+    Returns
+    -------
+    A :class:`SailResult` with the 21 terms of :func:`foursail`, each of
+    them an ``(n_views, n_wl)`` array (or ``(n_views,)`` if the spectra are
+    scalars). ``rsot`` and ``rdot`` are the SDR and HDR of each view. The
+    terms that were not requested in ``outputs`` are ``None``.
+    """
+    required = required_terms(outputs)
+    tto, psi = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(tto, dtype=float)),
+        np.atleast_1d(np.asarray(psi, dtype=float)),
+    )
+    if tto.ndim != 1:
+        raise ValueError("tto and psi must be scalars or 1-D arrays")
+    n_views = len(tto)
+    structure = np.array(
+        [
+            canopy_structure(
+                lidfa, lidfb, lidftype, lai, hotspot, tts, tto_i, psi_i
+            )
+            for tto_i, psi_i in zip(tto, psi)
+        ]
+    )
+    dtype = spectral_dtype(rho, tau, rsoil)
+    ks, ko, bf, sob, sof, tss, too, tsstoo, sumint = structure.T.astype(dtype)
+    spectral_shape = np.broadcast(rho, tau, rsoil).shape
+    result = SailResult.empty(
+        (n_views,) + spectral_shape, required[0], out, dtype
+    )
+    if lai <= 0:
+        result.fill_no_canopy(rsoil)
+        return result
+    lai = dtype.type(lai)
+
+    # ks, bf and tss only depend on the sun position and the LIDF
+    scattering = _sail_scattering(rho, tau, ks[0], bf[0])
+    diffuse = _sail_view_independent(
+        scattering, rsoil, lai, ks[0], tss[0], required
+    )
+    # One view at a time, so that the temporaries stay in cache
+    for i in range(n_views):
+        view_scattering = _sail_view_scattering(
+            rho, tau, ko[i], bf[0], sob[i], sof[i]
+        )
+        view_terms = _sail_view_dependent(
+            diffuse, scattering, view_scattering, rsoil, lai, ks[0], ko[i],
+            tss[0], too[i], tsstoo[i], sumint[i], required,
+        )
+        result.fill(view_terms, i)
+    return result
+
+
+def foursail_multilai(
+    rho,
+    tau,
+    lidfa,
+    lidfb,
+    lidftype,
+    lai,
+    hotspot,
+    tts,
+    tto,
+    psi,
+    rsoil,
+    outputs=None,
+    out=None,
+):
+    """Runs 4SAIL for one leaf spectrum and geometry, and many LAI values.
+    The geometric coefficients and the scattering terms (``sigb``, ``sigf``,
+    ``m``, ``rinf``, ``sb``, ``sf``, ``vb``, ``vf`` and ``w``) don't depend
+    on LAI, so they are computed only once per wavelength in
+    :func:`multilai_spectral_loop`, and only the LAI-dependent terms
+    (extinction, J functions, hotspot...) are evaluated per LAI.
+
+    Parameters
+    ----------
+    rho, tau, lidfa, lidfb, lidftype, hotspot, tts, tto, psi, rsoil, outputs
+        See :func:`foursail`. The compiled kernel always evaluates all the
+        terms, but the ones that were not requested are returned as
+        ``None`` like in :func:`foursail`.
+    lai : array_like
+        Leaf Area Index values, ``(n_lai,)``.
+    out : array_like, optional
+        ``(21, n_lai, n_wl)`` float array where the terms are written.
+
+    Returns
+    -------
+    A :class:`SailResult` with the 21 terms of :func:`foursail`, each of
+    them an ``(n_lai, n_wl)`` array.
+    """
+    required = required_terms(outputs)
+    lai = np.atleast_1d(np.asarray(lai, dtype=float))
+    if lai.ndim != 1:
+        raise ValueError("lai must be a scalar or a 1-D array")
+    rho, tau, rsoil = np.broadcast_arrays(
+        np.atleast_1d(rho), np.atleast_1d(tau), np.atleast_1d(rsoil)
+    )
+    structure = np.array(
+        [
+            canopy_structure(
+                lidfa, lidfb, lidftype, lai_i, hotspot, tts, tto, psi
+            )
+            for lai_i in lai
+        ]
+    )
+    ks, ko, bf, sob, sof = structure[0, :5]
+    tss, too, tsstoo, sumint = structure[:, 5:].T.copy()
+    result = SailResult.empty(
+        (len(lai), rho.shape[0]),
+        required[0],
+        out,
+        spectral_dtype(rho, tau, rsoil),
+    )
+    multilai_spectral_loop(
+        rho,
+        tau,
+        rsoil,
+        lai,
+        ks,
+        ko,
+        bf,
+        sob,
+        sof,
+        tss,
+        too,
+        tsstoo,
+        sumint,
+        result.data,
+    )
+    no_canopy = lai <= 0
+    if np.any(no_canopy):
+        result.fill_no_canopy(rsoil, no_canopy)
+    return result
+
+
+@numba.jit(nopython=True, cache=True)
+def _canopy_structure_lidf(lidf, litab, lai, hotspot, tts, tto, psi):
+    n_samples = len(lai)
+    tss = np.ones(n_samples)
+    too = np.ones(n_samples)
+    tsstoo = np.ones(n_samples)
+    sumint = np.zeros(n_samples)
+    ks, ko, bf, sob, sof = weighted_sum_over_angles_batch(
+        lidf, litab, tts, tto, psi
+    )
+    for i in range(n_samples):
+        if lai[i] <= 0:
+            continue
+        tss[i] = np.exp(-ks[i] * lai[i])
+        too[i] = np.exp(-ko[i] * lai[i])
+        tants = np.tan(np.radians(tts[i]))
+        tanto = np.tan(np.radians(tto[i]))
+        cospsi = np.cos(np.radians(psi[i]))
+        dso = np.sqrt(tants**2.0 + tanto**2.0 - 2.0 * tants * tanto * cospsi)
+        alf = 1e36
+        if hotspot[i] > 0.0:
+            alf = (dso / hotspot[i]) * 2.0 / (ks[i] + ko[i])
+        if alf == 0.0:
+            tsstoo[i] = tss[i]
+            sumint[i] = (1.0 - tss[i]) / (ks[i] * lai[i])
+        else:
+            tsstoo[i], sumint[i] = hotspot_calculations(
+                alf, lai[i], ko[i], ks[i]
+            )
+    return ks, ko, bf, sob, sof, tss, too, tsstoo, sumint
+
+
+def canopy_structure_batch(
+    lidftype, lidfa, lidfb, lai, hotspot, tts, tto, psi, quadrature=None
+):
+    """Wavelength-independent 4SAIL terms for a batch of canopies. Returns
+    ks, ko, bf, sob, sof, tss, too, tsstoo and sumint, one value per
+    sample. Samples with ``lai <= 0`` get no-canopy transmittances. The
+    LIDFs come from :data:`lidf_table`, at the nodes of ``quadrature`` (by
+    default, ``lidf_table.quadrature``)."""
+    if quadrature is None:
+        quadrature = lidf_table.quadrature
+    return _canopy_structure_lidf(
+        lidf_table.batch(lidftype, lidfa, lidfb, quadrature=quadrature),
+        quadrature.angles,
+        np.asarray(lai, dtype=np.float64),
+        np.asarray(hotspot, dtype=np.float64),
+        np.asarray(tts, dtype=np.float64),
+        np.asarray(tto, dtype=np.float64),
+        np.asarray(psi, dtype=np.float64),
+    )
+
+
+def foursail_batch(
+    rho,
+    tau,
+    lidfa,
+    lidfb,
+    lidftype,
+    lai,
+    hotspot,
+    tts,
+    tto,
+    psi,
+    rsoil,
+    outputs=None,
+    out=None,
+):
+    """Batched version of :func:`foursail`. Runs 4SAIL for ``n_samples``
+    canopies at once. The canopy structure and geometry terms are computed
+    once per sample and then broadcast over wavelength, so that the
+    spectral calculations are done on ``(n_samples, n_wl)`` arrays in one go.
+
+    Parameters
+    ----------
+    rho : array_like
+        leaf lambertian reflectance, ``(n_samples, n_wl)`` or ``(n_wl,)``.
+    tau : array_like
+        leaf transmittance, ``(n_samples, n_wl)`` or ``(n_wl,)``.
+    lidfa : float or array_like
+        Leaf Inclination Distribution parameter a, ``(n_samples,)``.
+    lidfb : float or array_like
+        Leaf Inclination Distribution parameter b, ``(n_samples,)``.
+    lidftype : int or array_like
+        Leaf Inclination Distribution type (1 or 2), ``(n_samples,)``.
+    lai : float or array_like
+        Leaf Area Index, ``(n_samples,)``.
+    hotspot : float or array_like
+        Hotspot parameter, ``(n_samples,)``.
+    tts : float or array_like
+        Sun Zenith Angle (degrees), ``(n_samples,)``.
+    tto : float or array_like
+        View(sensor) Zenith Angle (degrees), ``(n_samples,)``.
+    psi : float or array_like
+        Relative Sensor-Sun Azimuth Angle (degrees), ``(n_samples,)``.
+    rsoil : array_like
+        soil lambertian reflectance, ``(n_samples, n_wl)`` or ``(n_wl,)``.
+    outputs : iterable of str, optional
+        See :func:`foursail`.
+    out : array_like, optional
+        ``(21, n_samples, n_wl)`` float array where the terms are written.
+
+    Returns
+    -------
+    A :class:`SailResult` with the same 21 terms as :func:`foursail`, each
+    of them an ``(n_samples, n_wl)`` array.
+    """
+    required = required_terms(outputs)
+    rho = np.atleast_2d(rho)
+    tau = np.atleast_2d(tau)
+    rsoil = np.atleast_2d(rsoil)
+    params = [
+        np.atleast_1d(np.asarray(param, dtype=float))
+        for param in (lidfa, lidfb, lai, hotspot, tts, tto, psi)
+    ]
+    lidftype = np.atleast_1d(np.asarray(lidftype, dtype=np.int64))
+    n_samples = np.broadcast_shapes(
+        rho.shape[:1],
+        tau.shape[:1],
+        rsoil.shape[:1],
+        lidftype.shape,
+        *[param.shape for param in params],
+    )[0]
+    n_wl = np.broadcast_shapes(rho.shape, tau.shape, rsoil.shape)[1]
+    if not np.all((lidftype == 1) | (lidftype == 2)):
+        raise ValueError(
+            "lidftype can only be 1 (bimodal) or 2 (ellipsoidal)"
+        )
+    lidftype = np.array(np.broadcast_to(lidftype, (n_samples,)))
+    lidfa, lidfb, lai, hotspot, tts, tto, psi = [
+        np.array(np.broadcast_to(param, (n_samples,)))
+        for param in params
+    ]
+
+    ks, ko, bf, sob, sof, tss, too, tsstoo, sumint = canopy_structure_batch(
+        lidftype, lidfa, lidfb, lai, hotspot, tts, tto, psi
+    )
+    no_canopy = lai <= 0
+    lai = np.where(no_canopy, 0.0, lai)
+    dtype = spectral_dtype(rho, tau, rsoil)
+    terms = _sail_spectral(
+        rho,
+        tau,
+        rsoil,
+        *[
+            term[:, None].astype(dtype)
+            for term in (lai, ks, ko, bf, sob, sof, tss, too, tsstoo, sumint)
+        ],
+        required=required
+    )
+    result = SailResult.empty((n_samples, n_wl), required[0], out, dtype)
+    result.fill(terms)
+    if np.any(no_canopy):
+        result.fill_no_canopy(rsoil, no_canopy)
+    return result
+
+
+@numba.jit(nopython=True, cache=True)
+def _scattering_point(rho, tau, ks, ko, bf, sob, sof):
+    """Scattering terms of 4SAIL for one wavelength. They depend neither on
+    LAI nor on the soil."""
+    sdb = 0.5 * (ks + bf)
+    sdf = 0.5 * (ks - bf)
+    dob = 0.5 * (ko + bf)
+    dof = 0.5 * (ko - bf)
+    ddb = 0.5 * (1.0 + bf)
+    ddf = 0.5 * (1.0 - bf)
+    sigb = ddb * rho + ddf * tau
+    sigf = ddf * rho + ddb * tau
+    if sigf == 0.0:
+        sigf = 1.0e-36
+    if sigb == 0.0:
+        sigb = 1.0e-36
+    att = 1.0 - sigf
+    m = np.sqrt(att**2.0 - sigb**2.0)
+    sb = sdb * rho + sdf * tau
+    sf = sdf * rho + sdb * tau
+    vb = dob * rho + dof * tau
+    vf = dof * rho + dob * tau
+    w = sob * rho + sof * tau
+    rinf = (att - m) / sigb
+    rinf2 = rinf**2.0
+    return sb, sf, vb, vf, w, m, rinf, rinf2
+
+
+@numba.jit(nopython=True, cache=True)
+def _canopy_point(
+    sb, sf, vb, vf, w, m, rinf, rinf2, rsoil, lai, ks, ko, eks, eko, ekso,
+    tss, too, tsstoo, sumint,
+):
+    """LAI-dependent part of 4SAIL for one wavelength, given the output of
+    :func:`_scattering_point`. ``eks``, ``eko`` and ``ekso`` are
+    ``exp(-ks * lai)``, ``exp(-ko * lai)`` and ``exp(-(ks + ko) * lai)``,
+    which don't depend on wavelength. Returns the 21 terms of
+    :func:`foursail`."""
+    e1 = np.exp(-m * lai)
+    e2 = e1**2.0
+    re = rinf * e1
+    denom = 1.0 - rinf2 * e2
+    # J functions, with avoidance of the singularity in J1
+    del_ = (ks - m) * lai
+    if np.abs(del_) > 1e-3:
+        J1ks = (e1 - eks) / (ks - m)
+    else:
+        J1ks = 0.5 * lai * (eks + e1) * (1.0 - (del_**2.0) / 12.0)
+    J2ks = (1.0 - eks * e1) / (ks + m)
+    del_ = (ko - m) * lai
+    if np.abs(del_) > 1e-3:
+        J1ko = (e1 - eko) / (ko - m)
+    else:
+        J1ko = 0.5 * lai * (eko + e1) * (1.0 - (del_**2.0) / 12.0)
+    J2ko = (1.0 - eko * e1) / (ko + m)
     Pss = (sf + sb * rinf) * J1ks
     Qss = (sf * rinf + sb) * J2ks
     Pv = (vf + vb * rinf) * J1ko
@@ -556,9 +2060,7 @@ def foursail(
     # Thermal "sd" quantities
     gammasdf = (1.0 + rinf) * (J1ks - re * J2ks) / denom
     gammasdb = (1.0 + rinf) * (-re * J1ks + J2ks) / denom
-    tss = np.exp(-ks * lai)
-    too = np.exp(-ko * lai)
-    z = Jfunc2(ks, ko, lai)
+    z = (1.0 - ekso) / (ks + ko)
     g1 = (z - J1ks * too) / (ko + m)
     g2 = (z - J1ko * tss) / (ks + m)
     Tv1 = (vf * rinf + vb) * g1
@@ -573,32 +2075,15 @@ def foursail(
     T5 = Tv2 * (1.0 + rinf)
     T6 = (rdo * J2ks + tdo * J1ks) * (1.0 + rinf) * rinf
     gammasod = (T4 + T5 - T6) / (1.0 - rinf2)
-    # Treatment of the hotspot-effect
-    alf = 1e36
-    # Apply correction 2/(K+k) suggested by F.-M. Breon
-    if hotspot > 0.0:
-        alf = (dso / hotspot) * 2.0 / (ks + ko)
-    if alf == 0.0:
-        # The pure hotspot
-        tsstoo = tss
-        sumint = (1.0 - tss) / (ks * lai)
-    else:
-        # Outside the hotspot
-        tsstoo, sumint = hotspot_calculations(alf, lai, ko, ks)
-
-    # Bidirectional reflectance
     # Single scattering contribution
     rsos = w * lai * sumint
     gammasos = ko * lai * sumint
-    # Total canopy contribution
     rso = rsos + rsod
     gammaso = gammasos + gammasod
     # Interaction with the soil
     dn = 1.0 - rsoil * rdd
-    try:
-        dn[dn < 1e-36] = 1e-36
-    except TypeError:
-        dn = max(1e-36, dn)
+    if dn < 1e-36:
+        dn = 1e-36
     rddt = rdd + tdd * rsoil * tdd / dn
     rsdt = rsd + (tsd + tss) * rsoil * tdd / dn
     rdot = rdo + tdd * rsoil * (tdo + too) / dn
@@ -607,8 +2092,7 @@ def foursail(
     ) * rsoil / dn + rsod
     rsost = rso + tsstoo * rsoil
     rsot = rsost + rsodt
-
-    return [
+    return (
         tss,
         too,
         tsstoo,
@@ -630,4 +2114,192 @@ def foursail(
         gammasdf,
         gammasdb,
         gammaso,
-    ]
+    )
+
+
+@numba.jit(nopython=True, cache=True)
+def foursail_spectral_loop(
+    rho, tau, rsoil, lai, ks, ko, bf, sob, sof, tss, too, tsstoo, sumint, out
+):
+    """Compiled, per-wavelength version of the spectral part of 4SAIL. All
+    the intermediate terms are scalars, and the 21 terms returned by
+    :func:`foursail` are written into the rows of ``out``, an
+    ``(21, n_wl)`` array."""
+    eks = np.exp(-ks * lai)
+    eko = np.exp(-ko * lai)
+    ekso = np.exp(-(ks + ko) * lai)
+    for i in range(rho.shape[0]):
+        sb, sf, vb, vf, w, m, rinf, rinf2 = _scattering_point(
+            rho[i], tau[i], ks, ko, bf, sob, sof
+        )
+        terms = _canopy_point(
+            sb, sf, vb, vf, w, m, rinf, rinf2, rsoil[i], lai, ks, ko, eks,
+            eko, ekso, tss, too, tsstoo, sumint,
+        )
+        for k in range(21):
+            out[k, i] = terms[k]
+
+
+@numba.jit(nopython=True, cache=True)
+def batch_spectral_loop(
+    rho,
+    tau,
+    rsoil,
+    lai,
+    ks,
+    ko,
+    bf,
+    sob,
+    sof,
+    tss,
+    too,
+    tsstoo,
+    sumint,
+    terms,
+    out,
+):
+    """Runs :func:`foursail_spectral_loop` for a batch of samples. ``rho``,
+    ``tau`` and ``rsoil`` are ``(n_samples, n_wl)`` arrays, the structure
+    terms (``lai`` to ``sumint``) are ``(n_samples,)`` arrays, and only the
+    terms whose indices (in :data:`SAIL_TERMS`) are in ``terms`` are copied
+    into ``out``, an ``(len(terms), n_samples, n_wl)`` array."""
+    buffer = np.empty((21, rho.shape[1]))
+    for i in range(rho.shape[0]):
+        foursail_spectral_loop(
+            rho[i],
+            tau[i],
+            rsoil[i],
+            lai[i],
+            ks[i],
+            ko[i],
+            bf[i],
+            sob[i],
+            sof[i],
+            tss[i],
+            too[i],
+            tsstoo[i],
+            sumint[i],
+            buffer,
+        )
+        for k in range(terms.shape[0]):
+            out[k, i] = buffer[terms[k]]
+
+
+@numba.jit(nopython=True, cache=True)
+def multilai_spectral_loop(
+    rho, tau, rsoil, lai, ks, ko, bf, sob, sof, tss, too, tsstoo, sumint, out
+):
+    """Same as :func:`foursail_spectral_loop` for many LAI values at once.
+    ``lai``, ``tss``, ``too``, ``tsstoo`` and ``sumint`` are ``(n_lai,)``
+    arrays, and ``out`` is ``(21, n_lai, n_wl)``. The scattering terms of
+    each wavelength are computed once and reused for all the LAI values."""
+    n_wl = rho.shape[0]
+    scattering = np.empty((8, n_wl))
+    for i in range(n_wl):
+        terms = _scattering_point(rho[i], tau[i], ks, ko, bf, sob, sof)
+        for k in range(8):
+            scattering[k, i] = terms[k]
+    for j in range(lai.shape[0]):
+        eks = np.exp(-ks * lai[j])
+        eko = np.exp(-ko * lai[j])
+        ekso = np.exp(-(ks + ko) * lai[j])
+        for i in range(n_wl):
+            terms = _canopy_point(
+                scattering[0, i],
+                scattering[1, i],
+                scattering[2, i],
+                scattering[3, i],
+                scattering[4, i],
+                scattering[5, i],
+                scattering[6, i],
+                scattering[7, i],
+                rsoil[i],
+                lai[j],
+                ks,
+                ko,
+                eks,
+                eko,
+                ekso,
+                tss[j],
+                too[j],
+                tsstoo[j],
+                sumint[j],
+            )
+            for k in range(21):
+                out[k, j, i] = terms[k]
+
+
+def foursail_fused(
+    rho,
+    tau,
+    lidfa,
+    lidfb,
+    lidftype,
+    lai,
+    hotspot,
+    tts,
+    tto,
+    psi,
+    rsoil,
+    out=None,
+):
+    """Same as :func:`foursail`, but the spectral calculations are done in
+    a single compiled loop over wavelength (:func:`foursail_spectral_loop`)
+    that writes the results into a preallocated array, instead of building
+    a few dozen temporary arrays. The results agree with :func:`foursail`
+    to within 1e-10.
+
+    Parameters
+    ----------
+    rho, tau, lidfa, lidfb, lidftype, lai, hotspot, tts, tto, psi, rsoil
+        See :func:`foursail`.
+    out : array, optional
+        C-contiguous ``(21, n_wl)`` array where the results are written,
+        with the dtype of the spectra (see :func:`spectral_dtype`). A new
+        one is allocated if not given.
+
+    Returns
+    -------
+    A :class:`SailResult` with the 21 terms of :func:`foursail`, as the
+    rows of ``out``.
+    """
+    rho, tau, rsoil = np.broadcast_arrays(
+        np.atleast_1d(rho), np.atleast_1d(tau), np.atleast_1d(rsoil)
+    )
+    dtype = spectral_dtype(rho, tau, rsoil)
+    if out is None:
+        out = np.empty((21,) + rho.shape, dtype=dtype)
+    elif (
+        not isinstance(out, np.ndarray)
+        or out.shape != (21,) + rho.shape
+        or out.dtype != dtype
+        or not out.flags.c_contiguous
+    ):
+        # The compiled loop writes into out without any checks
+        raise ValueError(
+            "out must be a C-contiguous %s array of shape %s"
+            % (dtype, (21,) + rho.shape)
+        )
+    ks, ko, bf, sob, sof, tss, too, tsstoo, sumint = canopy_structure(
+        lidfa, lidfb, lidftype, lai, hotspot, tts, tto, psi
+    )
+    if lai <= 0:
+        SailResult(out).fill_no_canopy(rsoil)
+    else:
+        foursail_spectral_loop(
+            rho,
+            tau,
+            rsoil,
+            float(lai),
+            ks,
+            ko,
+            bf,
+            sob,
+            sof,
+            float(tss),
+            float(too),
+            tsstoo,
+            sumint,
+            out,
+        )
+    return SailResult(out)
@@ -5,8 +5,8 @@ __version__ = "2.0.5"
 __license__ = "GPLv3"
 __email__ = "j.gomez-dans@ucl.ac.uk"
 
-from .spectral_library import get_spectra
+from .spectral_library import LazySpectra, get_spectra
 
-spectral_lib = get_spectra()
+spectral_lib = LazySpectra()
 from .prospect_d import run_prospect
 from .sail_model import run_prosail, run_sail, run_thermal_sail
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""Inversion of PROSAIL and ProGeoSAIL against observed spectra with a LUT.
+The simulated spectra are reduced to a set of bands (and optionally to their
+principal components), and the nearest neighbours of the observations are
+found with blocked matrix products."""
+
+import numba
+import numpy as np
+
+STATISTICS = {"mean": np.mean, "median": np.median}
+
+
+@numba.jit(nopython=True, cache=True)
+def _merge_top_k(products, sq_norms, offset, best_distance, best_index):
+    """Merges a block of LUT entries into the ``k`` best of each pixel.
+    ``products`` are the ``-2 x.y`` terms of the squared distances, and
+    ``best_distance`` is kept sorted (without the ``|x|^2`` term), so that
+    most of the entries are discarded with one comparison."""
+    k = best_distance.shape[1]
+    for i in range(products.shape[0]):
+        worst = best_distance[i, k - 1]
+        for j in range(products.shape[1]):
+            distance = products[i, j] + sq_norms[j]
+            if distance < worst:
+                position = k - 1
+                while position > 0:
+                    if best_distance[i, position - 1] <= distance:
+                        break
+                    best_distance[i, position] = best_distance[i, position - 1]
+                    best_index[i, position] = best_index[i, position - 1]
+                    position -= 1
+                best_distance[i, position] = distance
+                best_index[i, position] = offset + j
+                worst = best_distance[i, k - 1]
+
+
+class LUTIndex(object):
+    """Nearest-neighbour index over the spectra of a LUT.
+
+    The distance between two spectra is the Euclidean distance over the
+    ``bands`` or, with ``n_components``, over the first principal components
+    of the LUT spectra in those bands.
+
+    Parameters
+    ----------
+    spectra : 2D array
+        ``(n_entries, n_wl)`` simulated spectra. It can be memory-mapped
+        (e.g. ``LookupTable.spectra``): it is read ``block_size`` entries at
+        a time.
+    params : dict
+        One ``(n_entries,)`` array per parameter of the LUT entries.
+    wavelengths : array, optional
+        The wavelengths of ``spectra`` (nm). By default, 400 to 2500 nm.
+    bands : array, optional
+        The wavelengths (nm) used to compare the spectra. By default, all
+        of them.
+    n_components : int, optional
+        Number of principal components of the spectra that are kept. By
+        default, the spectra are not reduced.
+    block_size : int, optional
+        Number of LUT entries that are processed at a time.
+    """
+
+    def __init__(
+        self,
+        spectra,
+        params,
+        wavelengths=None,
+        bands=None,
+        n_components=None,
+        block_size=65536,
+    ):
+        if wavelengths is None:
+            wavelengths = np.arange(400, 2501)
+        wavelengths = np.asarray(wavelengths)
+        if spectra.ndim != 2 or spectra.shape[1] != wavelengths.size:
+            raise ValueError(
+                "spectra must be (n_entries, %d) arrays" % wavelengths.size
+            )
+        if bands is None:
+            self.band_index = np.arange(wavelengths.size)
+        else:
+            # The wavelengths need not be sorted, e.g. the band centres of
+            # a sensor
+            positions = {
+                wavelength: i for i, wavelength in enumerate(wavelengths)
+            }
+            try:
+                self.band_index = np.array(
+                    [positions[band] for band in np.atleast_1d(bands)],
+                    dtype=np.int64,
+                )
+            except KeyError:
+                raise ValueError("The bands must be in the wavelengths")
+        self.wavelengths = wavelengths
+        self.bands = wavelengths[self.band_index]
+        self.params = {
+            name: np.asarray(value, dtype=np.float64)
+            for name, value in params.items()
+        }
+        n_entries = spectra.shape[0]
+        for name, value in self.params.items():
+            if value.shape != (n_entries,):
+                raise ValueError(
+                    "Parameter %s must have %d values" % (name, n_entries)
+                )
+
+        # The features are centred, which keeps the float32 rounding errors
+        # of |x|^2 - 2 x.y + |y|^2 small. Without PCA, any shift works, so
+        # the mean of the first block is enough.
+        self.mean = np.mean(
+            np.asarray(spectra[:block_size])[:, self.band_index], axis=0
+        )
+        self.components = None
+        if n_components is not None:
+            if not 0 < n_components <= self.band_index.size:
+                raise ValueError(
+                    "n_components must be between 1 and %d"
+                    % self.band_index.size
+                )
+            self._fit_pca(spectra, n_components, block_size)
+        n_features = n_components or self.band_index.size
+        self.features = np.empty((n_entries, n_features), dtype=np.float32)
+        for start in range(0, n_entries, block_size):
+            rows = slice(start, start + block_size)
+            self.features[rows] = self._project(spectra[rows])
+        self.sq_norms = np.einsum("ij,ij->i", self.features, self.features)
+
+    @classmethod
+    def from_lut(cls, lut, **kwargs):
+        """Builds the index of a :class:`prosail.lut.LookupTable`."""
+        return cls(lut.spectra, lut.parameters(), lut.wavelengths, **kwargs)
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def __repr__(self):
+        return "LUTIndex(n_entries=%d, n_bands=%d, n_features=%d)" % (
+            len(self),
+            self.band_index.size,
+            self.features.shape[1],
+        )
+
+    def _fit_pca(self, spectra, n_components, block_size):
+        # The covariance matrix of the bands is accumulated block by block,
+        # so that the LUT does not need to fit in memory
+        n_bands = self.band_index.size
+        total = np.zeros(n_bands)
+        products = np.zeros((n_bands, n_bands))
+        for start in range(0, spectra.shape[0], block_size):
+            block = np.asarray(
+                spectra[start:start + block_size][:, self.band_index],
+                dtype=np.float64,
+            )
+            total += block.sum(axis=0)
+            products += block.T @ block
+        n_entries = spectra.shape[0]
+        self.mean = total / n_entries
+        covariance = products / n_entries - np.outer(self.mean, self.mean)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:n_components]
+        self.explained_variance = eigenvalues[order]
+        self.components = eigenvectors[:, order]
+
+    def _project(self, spectra):
+        spectra = np.asarray(spectra)[:, self.band_index] - self.mean
+        if self.components is None:
+            return spectra
+        return spectra @ self.components
+
+    def transform(self, spectra):
+        """The features of some spectra, observed over all the wavelengths
+        or over the bands of the index."""
+        spectra = np.atleast_2d(spectra)
+        if spectra.shape[-1] == self.band_index.size:
+            features = spectra - self.mean
+            if self.components is not None:
+                features = features @ self.components
+        elif spectra.shape[-1] == self.wavelengths.size:
+            features = self._project(spectra)
+        else:
+            raise ValueError(
+                "The spectra must have %d bands or %d wavelengths"
+                % (self.band_index.size, self.wavelengths.size)
+            )
+        return np.asarray(features, dtype=np.float32)
+
+    def query(self, spectra, k=10, block_size=1024, entry_block_size=65536):
+        """The ``k`` LUT entries nearest to each observed spectrum.
+
+        The squared distances are computed as ``|x|^2 - 2 x.y + |y|^2``,
+        with one matrix product per block of ``block_size`` pixels and
+        ``entry_block_size`` LUT entries, and the best ``k`` of each block
+        are merged into the running best of each pixel.
+
+        Parameters
+        ----------
+        spectra : array
+            ``(n_pixels, n_bands)`` or ``(n_pixels, n_wl)`` observations.
+        k : int, optional
+            Number of neighbours.
+        block_size : int, optional
+            Number of pixels per block.
+        entry_block_size : int, optional
+            Number of LUT entries per block.
+
+        Returns
+        -------
+        ``(n_pixels, k)`` distances and indices of the LUT entries, from the
+        nearest to the farthest.
+        """
+        features = self.transform(spectra)
+        n_pixels = features.shape[0]
+        k = min(k, len(self))
+        if k < 1:
+            raise ValueError("k must be positive")
+        distances = np.empty((n_pixels, k), dtype=np.float32)
+        indices = np.empty((n_pixels, k), dtype=np.int64)
+        for start in range(0, n_pixels, block_size):
+            pixels = slice(start, start + block_size)
+            distances[pixels], indices[pixels] = self._query_block(
+                features[pixels], k, entry_block_size
+            )
+        np.sqrt(np.maximum(distances, 0.0), out=distances)
+        return distances, indices
+
+    def _query_block(self, features, k, entry_block_size):
+        best_distance = np.full((features.shape[0], k), np.inf, np.float32)
+        best_index = np.full((features.shape[0], k), -1, np.int64)
+        scaled = -2.0 * features
+        for start in range(0, len(self), entry_block_size):
+            entries = slice(start, start + entry_block_size)
+            _merge_top_k(
+                scaled @ self.features[entries].T,
+                self.sq_norms[entries],
+                start,
+                best_distance,
+                best_index,
+            )
+        best_distance += np.einsum("ij,ij->i", features, features)[:, None]
+        return best_distance, best_index
+
+    def estimate(self, spectra, k=10, statistic="mean", parameters=None,
+                 **kwargs):
+        """Estimates the parameters of each observed spectrum from its ``k``
+        nearest LUT entries.
+
+        Parameters
+        ----------
+        spectra : array
+            ``(n_pixels, n_bands)`` or ``(n_pixels, n_wl)`` observations.
+        k : int, optional
+            Number of neighbours.
+        statistic : str, optional
+            "mean" or "median" of the parameters of the neighbours.
+        parameters : list, optional
+            The parameters to estimate. By default, all of them.
+        kwargs
+            Passed to :meth:`query`.
+
+        Returns
+        -------
+        A dictionary with one ``(n_pixels,)`` array per parameter.
+        """
+        try:
+            reduce = STATISTICS[statistic.lower()]
+        except KeyError:
+            raise ValueError(
+                "statistic must be one of %s" % ", ".join(STATISTICS)
+            )
+        if parameters is None:
+            parameters = list(self.params)
+        _, indices = self.query(spectra, k=k, **kwargs)
+        return {
+            name: reduce(self.params[name][indices], axis=1)
+            for name in parameters
+        }
@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+"""Generation of PROSAIL and ProGeoSAIL look-up tables (LUTs). The parameter
+table is split into chunks, that are simulated in parallel by a pool of
+worker processes, and written to disk as soon as they are ready, into a
+memory-mapped :class:`LookupTable`."""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from prosail import spectral_lib
+
+from .FourSAIL import (
+    _NO_CANOPY_TERMS,
+    SAIL_TERMS,
+    batch_spectral_loop,
+    canopy_structure_batch,
+    lidf_table,
+)
+from .prospect_d import run_prospect
+from .sail_model import (
+    _FACTOR_OUTPUTS,
+    _soil_reflectance,
+    geocone,
+    geocyli,
+)
+from .sensors import apply_srf, get_sensor
+from .spectral_library import get_wavelength_grid
+
+# Parameters that can change from one LUT entry to the next, and their
+# defaults (None means that the parameter is required)
+PROSAIL_PARAMETERS = (
+    ("n", None),
+    ("cab", None),
+    ("car", None),
+    ("cbrown", None),
+    ("cw", None),
+    ("cm", None),
+    ("lai", None),
+    ("lidfa", None),
+    ("hspot", None),
+    ("tts", None),
+    ("tto", None),
+    ("psi", None),
+    ("ant", 0.0),
+    ("typelidf", 2),
+    ("lidfb", 0.0),
+    ("rsoil", None),
+    ("psoil", None),
+)
+PROGEOSAIL_PARAMETERS = (("chw", None), ("ccover", None)) + PROSAIL_PARAMETERS
+
+_MODEL_PARAMETERS = {
+    "prosail": PROSAIL_PARAMETERS,
+    "progeosail": PROGEOSAIL_PARAMETERS,
+}
+
+
+def sample_parameters(spec, n_samples, seed=None):
+    """Builds a parameter table from a sampling specification.
+
+    Parameters
+    ----------
+    spec : dict
+        Maps each parameter name to either a constant, a ``(min, max)``
+        tuple (sampled uniformly) or an array with ``n_samples`` values.
+    n_samples : int
+        Number of LUT entries.
+    seed : int, optional
+        Seed of the random number generator.
+
+    Returns
+    -------
+    A dictionary with a ``(n_samples,)`` array per parameter.
+    """
+    rng = np.random.default_rng(seed)
+    params = {}
+    for name, value in spec.items():
+        if isinstance(value, tuple):
+            low, high = value
+            params[name] = rng.uniform(low, high, n_samples)
+        else:
+            params[name] = np.array(
+                np.broadcast_to(np.asarray(value, dtype=float), (n_samples,))
+            )
+    return params
+
+
+def parameter_table(params, model="prosail"):
+    """Checks a parameter table, and fills in the parameters with a default
+    value.
+
+    Parameters
+    ----------
+    params : dict or structured array
+        One ``(n_entries,)`` array (or scalar) per parameter.
+    model : str, optional
+        "prosail" or "progeosail".
+
+    Returns
+    -------
+    A dictionary with a float ``(n_entries,)`` array for every parameter of
+    the model, in the order of :data:`PROSAIL_PARAMETERS` or
+    :data:`PROGEOSAIL_PARAMETERS`. ``rsoil`` and ``psoil`` are left out if
+    they are not given.
+    """
+    try:
+        parameters = _MODEL_PARAMETERS[model.lower()]
+    except KeyError:
+        raise ValueError("model can only be 'prosail' or 'progeosail'")
+    if getattr(params, "dtype", None) is not None:
+        params = {name: params[name] for name in params.dtype.names}
+    known = [name for name, default in parameters]
+    unknown = set(params).difference(known)
+    if unknown:
+        raise ValueError(
+            "Unknown %s parameters: %s" % (model, ", ".join(sorted(unknown)))
+        )
+    names = []
+    values = []
+    for name, default in parameters:
+        if name in params:
+            value = params[name]
+        elif default is not None:
+            value = default
+        elif name in ("rsoil", "psoil"):
+            # Only needed when the soil spectrum isn't given
+            continue
+        else:
+            raise ValueError("The %s parameter is missing" % name)
+        names.append(name)
+        values.append(np.asarray(value, dtype=float))
+    values = np.broadcast_arrays(*values)
+    if values[0].ndim != 1:
+        raise ValueError("The parameters must be scalars or 1-D arrays")
+    return {name: np.array(value) for name, value in zip(names, values)}
+
+
+def run_lut_chunk(
+    params,
+    model="prosail",
+    factor="SDR",
+    prospect_version="5",
+    alpha=40.0,
+    cshp="cone",
+    rsoil0=None,
+    soil_spectrum1=None,
+    soil_spectrum2=None,
+    tau_method="numba",
+    block_size=128,
+    sensor=None,
+    wavelengths=None,
+    dtype=np.float64,
+    quadrature=None,
+):
+    """Runs the model for all the entries of a parameter table. The canopy
+    structure terms of all the entries are computed in one go, and the
+    leaf and canopy spectra in blocks of ``block_size`` entries, with
+    batched PROSPECT and the compiled 4SAIL kernel, so that the
+    temporaries stay in cache. Gives the same results as calling
+    :func:`~prosail.sail_model.run_prosail` or
+    :func:`~prosail.sail_model.run_progeosail` for each entry, to within
+    the accuracy of ``tau_method``.
+
+    Parameters
+    ----------
+    params : dict
+        Output of :func:`parameter_table`.
+    model : str, optional
+        "prosail" or "progeosail".
+    factor : str, optional
+        The reflectance factor simulated by PROSAIL, "SDR", "BHR", "DHR" or
+        "HDR". Ignored by ProGeoSAIL.
+    prospect_version, alpha, cshp, rsoil0, soil_spectrum1, soil_spectrum2
+        Settings shared by all the entries, see
+        :func:`~prosail.sail_model.run_progeosail`. If ``rsoil0`` is not
+        given, the soil spectrum of each entry is mixed from ``rsoil`` and
+        ``psoil``.
+    tau_method : str, optional
+        See :func:`~prosail.prospect_d.run_prospect`. The compiled
+        transmissivity is accurate to 2e-7, about the float32 resolution.
+    block_size : int, optional
+        Number of entries simulated at the same time.
+    sensor : str or Sensor, optional
+        If given, the spectra are returned in the bands of this sensor, see
+        :func:`prosail.sensors.get_sensor`.
+    wavelengths : array or WavelengthGrid, optional
+        Only simulate these wavelengths [nm], see
+        :func:`~prosail.spectral_library.get_wavelength_grid`.
+    dtype : numpy dtype, optional
+        Precision of the spectra. With ``np.float32``, PROSPECT, the
+        compiled 4SAIL kernel (specialised for float32 arrays) and the
+        crown mixing work on float32 spectra. The canopy structure terms,
+        which don't depend on wavelength, stay in float64.
+    quadrature : Quadrature, optional
+        The quadrature of the leaf inclination integrals, see
+        :func:`~prosail.FourSAIL.leaf_angle_quadrature`. By default, the
+        one of :data:`~prosail.FourSAIL.lidf_table` (18 midpoint bins).
+
+    Returns
+    -------
+    A ``(n_entries, n_wl)`` (or ``(n_entries, n_bands)``) array with the
+    simulated spectra.
+    """
+    factor = factor.upper()
+    if factor not in ("SDR", "BHR", "DHR", "HDR"):
+        raise ValueError("'factor' must be one of SDR, BHR, DHR or HDR")
+    model = model.lower()
+    if model == "progeosail":
+        if cshp.lower() == "cone":
+            mixer = geocone
+        elif cshp.lower() == "cylinder":
+            mixer = geocyli
+        else:
+            raise ValueError(
+                "The shape of the crown can be either cylinder or cone!"
+            )
+        outputs = ("rdo", "tdo", "rdd")
+    else:
+        outputs = _FACTOR_OUTPUTS[factor]
+    n_entries = len(params["n"])
+    grid = get_wavelength_grid(wavelengths)
+    if rsoil0 is None:
+        if "rsoil" not in params or "psoil" not in params:
+            raise ValueError(
+                "If rsoil0 isn't defined, then rsoil and psoil"
+                " must be defined!"
+            )
+        rsoil0 = _soil_reflectance(
+            None,
+            params["rsoil"][:, None],
+            params["psoil"][:, None],
+            soil_spectrum1,
+            soil_spectrum2,
+            grid,
+        )
+    else:
+        rsoil0 = np.broadcast_to(grid.take(rsoil0), (n_entries, len(grid)))
+    rsoil0 = rsoil0.astype(dtype, copy=False)
+
+    lai = params["lai"]
+    no_canopy = lai <= 0
+    lai = np.where(no_canopy, 0.0, lai)
+    structure = canopy_structure_batch(
+        params["typelidf"].astype(np.int64),
+        params["lidfa"],
+        params["lidfb"],
+        lai,
+        params["hspot"],
+        params["tts"],
+        params["tto"],
+        params["psi"],
+        quadrature=quadrature,
+    )
+    terms = np.array([SAIL_TERMS.index(name) for name in outputs])
+    sail = np.empty((len(outputs),) + rsoil0.shape, dtype=dtype)
+    for start in range(0, n_entries, block_size):
+        block = slice(start, start + block_size)
+        wv, refl, trans = run_prospect(
+            params["n"][block],
+            params["cab"][block],
+            params["car"][block],
+            params["cbrown"][block],
+            params["cw"][block],
+            params["cm"][block],
+            ant=params["ant"][block],
+            prospect_version=prospect_version,
+            alpha=alpha,
+            tau_method=tau_method,
+            wavelengths=grid,
+            dtype=dtype,
+        )
+        batch_spectral_loop(
+            refl,
+            trans,
+            rsoil0[block],
+            lai[block],
+            *[term[block] for term in structure],
+            terms,
+            sail[:, block]
+        )
+    if np.any(no_canopy):
+        for term, index in zip(sail, terms):
+            value = _NO_CANOPY_TERMS[index]
+            term[no_canopy] = rsoil0[no_canopy] if value is None else value
+
+    if model == "prosail":
+        spectra = sail[0]
+    else:
+        rdo, tdo, rdd = sail
+        spectra, gsfr = mixer(
+            params["chw"],
+            params["ccover"],
+            params["tts"],
+            rdo,
+            tdo,
+            rdd,
+            rsoil0,
+        )
+    if sensor is not None:
+        spectra = apply_srf(spectra, sensor, grid)
+    return spectra
+
+
+def _warm_up(model, options):
+    """Initialiser of the worker processes. Loads the spectral library and
+    the compiled kernels (from the numba cache) before the first chunk."""
+    warm_up_params = {
+        name: np.atleast_1d(default if default is not None else 1.0)
+        for name, default in _MODEL_PARAMETERS[model]
+    }
+    warm_up_params["ccover"] = np.array([0.5])
+    run_lut_chunk(warm_up_params, model=model, **options)
+
+
+LUT_FORMAT_VERSION = 1
+
+
+class LookupTable(object):
+    """A LUT stored on disk, in a directory with these files:
+
+    * ``metadata.json``: the model settings, the parameter names, the
+      wavelengths (or the band centres of the sensor) and a hash of the soil
+      spectra.
+    * ``params.npy``: ``(n_entries, n_parameters)`` float64 parameter
+      table, with one column per parameter.
+    * ``spectra.npy``: ``(n_entries, n_wl)`` float32 simulated spectra, or
+      ``(n_entries, n_bands)`` band reflectances.
+    * ``progress.npy``: which chunks of ``chunk_size`` entries have been
+      written.
+
+    The arrays are memory-mapped, so a LUT larger than the RAM can be
+    scanned (e.g. with :meth:`blocks`) without loading it.
+
+    Parameters
+    ----------
+    path : str
+        The LUT directory.
+    mode : str, optional
+        "r" (read-only, default) or "r+" (to write the spectra).
+    """
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        with open(os.path.join(path, "metadata.json")) as fp:
+            self.metadata = json.load(fp)
+        if self.metadata["format_version"] > LUT_FORMAT_VERSION:
+            raise IOError("Unsupported LUT format in %s" % path)
+        self.params = np.load(self._fname("params"), mmap_mode=mode)
+        self.spectra = np.load(self._fname("spectra"), mmap_mode=mode)
+        self.progress = np.load(self._fname("progress"), mmap_mode=mode)
+
+    def _fname(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+    @classmethod
+    def create(cls, path, params, wavelengths, chunk_size, metadata,
+               dtype=np.float32):
+        """Creates an empty LUT for the ``params`` table (the output of
+        :func:`parameter_table`), and opens it for writing."""
+        n_entries = len(next(iter(params.values())))
+        n_chunks = -(-n_entries // chunk_size)
+        os.makedirs(path, exist_ok=True)
+        table = np.lib.format.open_memmap(
+            os.path.join(path, "params.npy"),
+            mode="w+",
+            dtype=np.float64,
+            shape=(n_entries, len(params)),
+        )
+        for column, value in enumerate(params.values()):
+            table[:, column] = value
+        table.flush()
+        del table
+        spectra = np.lib.format.open_memmap(
+            os.path.join(path, "spectra.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(n_entries, len(wavelengths)),
+        )
+        del spectra
+        np.save(os.path.join(path, "progress.npy"), np.zeros(n_chunks, bool))
+        metadata = dict(
+            metadata,
+            format_version=LUT_FORMAT_VERSION,
+            parameters=list(params),
+            n_entries=n_entries,
+            chunk_size=chunk_size,
+            dtype=np.dtype(dtype).name,
+            wavelengths=np.asarray(wavelengths).tolist(),
+        )
+        # The metadata is written last, so that an existing metadata file
+        # means that the LUT arrays are all there
+        fname = os.path.join(path, "metadata.json")
+        with open(fname + ".tmp", "w") as fp:
+            json.dump(metadata, fp, indent=1)
+        os.replace(fname + ".tmp", fname)
+        return cls(path, mode="r+")
+
+    def __len__(self):
+        return self.metadata["n_entries"]
+
+    def __repr__(self):
+        return "LookupTable(%r, n_entries=%d, model=%s, complete=%s)" % (
+            self.path,
+            len(self),
+            self.metadata.get("model"),
+            self.complete,
+        )
+
+    @property
+    def parameter_names(self):
+        return self.metadata["parameters"]
+
+    @property
+    def wavelengths(self):
+        return np.array(self.metadata["wavelengths"])
+
+    @property
+    def chunk_size(self):
+        return self.metadata["chunk_size"]
+
+    @property
+    def complete(self):
+        """Whether all the chunks have been simulated."""
+        return bool(np.all(self.progress))
+
+    def parameter(self, name):
+        """The (memory-mapped) column of the parameter table of ``name``."""
+        return self.params[:, self.parameter_names.index(name)]
+
+    def parameters(self, rows=slice(None)):
+        """The parameter table (or some of its ``rows``) as a dictionary."""
+        table = np.asarray(self.params[rows])
+        return {
+            name: table[..., column]
+            for column, name in enumerate(self.parameter_names)
+        }
+
+    def chunk_rows(self, index):
+        """The rows of the LUT in chunk ``index``."""
+        start = index * self.chunk_size
+        return slice(start, min(start + self.chunk_size, len(self)))
+
+    def blocks(self, block_size=65536):
+        """Iterates over the LUT in blocks of ``block_size`` entries, so that
+        only one block is in memory at a time. Yields the rows (a slice),
+        the parameter table and the spectra of each block."""
+        for start in range(0, len(self), block_size):
+            rows = slice(start, min(start + block_size, len(self)))
+            yield rows, self.params[rows], self.spectra[rows]
+
+
+def open_lut(path, mode="r"):
+    """Opens a LUT written by :func:`generate_lut`. See
+    :class:`LookupTable`."""
+    return LookupTable(path, mode)
+
+
+def _soil_hash(rsoil0=None, soil_spectrum1=None, soil_spectrum2=None,
+               **options):
+    """SHA1 hash of the soil spectra used to simulate a LUT."""
+    if rsoil0 is not None:
+        spectra = [rsoil0]
+    else:
+        spectra = [
+            spectral_lib.soil.rsoil1 if soil_spectrum1 is None
+            else soil_spectrum1,
+            spectral_lib.soil.rsoil2 if soil_spectrum2 is None
+            else soil_spectrum2,
+        ]
+    sha1 = hashlib.sha1()
+    for spectrum in spectra:
+        sha1.update(np.ascontiguousarray(spectrum, dtype=np.float64).data)
+    return sha1.hexdigest()
+
+
+def _lut_metadata(model, options):
+    """The settings of a LUT simulated with ``options``."""
+    metadata = dict(
+        model=model,
+        prospect_version=str(options.get("prospect_version", "5")).upper(),
+        alpha=float(options.get("alpha", 40.0)),
+        precision=np.dtype(options.get("dtype", np.float64)).name,
+        soil_hash=_soil_hash(**options),
+    )
+    if model == "prosail":
+        metadata["factor"] = options.get("factor", "SDR").upper()
+    else:
+        metadata["cshp"] = options.get("cshp", "cone").lower()
+    if options.get("sensor") is not None:
+        metadata["sensor"] = get_sensor(options["sensor"]).name
+    quadrature = options["quadrature"]
+    metadata["quadrature"] = [quadrature.rule, quadrature.n_nodes]
+    return metadata
+
+
+def _run_chunk(path, index, model, options):
+    """Simulates chunk ``index`` of a LUT, and writes it in place."""
+    lut = LookupTable(path, mode="r+")
+    rows = lut.chunk_rows(index)
+    lut.spectra[rows] = run_lut_chunk(
+        lut.parameters(rows), model=model, **options
+    )
+    lut.spectra.flush()
+    return index
+
+
+def generate_lut(
+    params,
+    path,
+    model="prosail",
+    chunk_size=4096,
+    n_workers=None,
+    **options
+):
+    """Simulates a LUT in parallel, and stores it in ``path`` (see
+    :class:`LookupTable`). The parameter table is split into chunks of
+    ``chunk_size`` entries, that are run by a pool of ``n_workers``
+    processes with :func:`run_lut_chunk`. Each worker loads the spectral
+    library and the compiled kernels when it starts, and writes its chunks
+    straight into the memory-mapped spectra as soon as they are done, so
+    the throughput scales with the number of cores, and the memory use only
+    depends on the chunk size. If ``path`` already has the same LUT (e.g.
+    from an interrupted run), only the missing chunks are simulated.
+
+    Parameters
+    ----------
+    params : dict or structured array
+        One ``(n_entries,)`` array (or scalar) per parameter. See
+        :func:`parameter_table`.
+    path : str
+        Directory where the LUT is written.
+    model : str, optional
+        "prosail" or "progeosail".
+    chunk_size : int, optional
+        Number of LUT entries per chunk.
+    n_workers : int, optional
+        Number of worker processes. By default, the number of CPUs. With 1,
+        the LUT is simulated in this process.
+    options
+        Settings shared by all the entries, see :func:`run_lut_chunk`. The
+        default ``quadrature`` is the one of
+        :data:`~prosail.FourSAIL.lidf_table` in this process, and is stored
+        in the metadata with the other settings.
+
+    Returns
+    -------
+    The :class:`LookupTable`, opened read-only.
+    """
+    model = model.lower()
+    params = parameter_table(params, model)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    # Resolved once here, so that it is recorded in the metadata, and the
+    # workers don't depend on the settings that they inherit (or not)
+    if options.get("quadrature") is None:
+        options["quadrature"] = lidf_table.quadrature
+    metadata = _lut_metadata(model, options)
+    if options.get("sensor") is not None:
+        wavelengths = get_sensor(options["sensor"]).centres
+    else:
+        wavelengths = get_wavelength_grid(options.get("wavelengths"))
+        wavelengths = wavelengths.wavelengths
+    if os.path.exists(os.path.join(path, "metadata.json")):
+        lut = LookupTable(path, mode="r+")
+        stored = dict(
+            (name, lut.metadata.get(name)) for name in metadata
+        )
+        if (
+            stored != metadata
+            or lut.parameter_names != list(params)
+            or lut.chunk_size != chunk_size
+            or not np.array_equal(lut.wavelengths, wavelengths)
+            or not np.array_equal(
+                lut.params, np.column_stack(list(params.values()))
+            )
+        ):
+            raise ValueError(
+                "%s has a different LUT, choose another path" % path
+            )
+    else:
+        lut = LookupTable.create(
+            path, params, wavelengths, chunk_size, metadata
+        )
+    pending = [index for index, done in enumerate(lut.progress) if not done]
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(pending)))
+
+    if n_workers == 1:
+        for index in pending:
+            _run_chunk(path, index, model, options)
+            lut.progress[index] = True
+            lut.progress.flush()
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_warm_up,
+            initargs=(model, options),
+        ) as executor:
+            futures = [
+                executor.submit(_run_chunk, path, index, model, options)
+                for index in pending
+            ]
+            for future in as_completed(futures):
+                # Raises the exceptions of the workers
+                index = future.result()
+                lut.progress[index] = True
+                lut.progress.flush()
+    return LookupTable(path)
@@ -5,10 +5,13 @@ Versions 5, D and PRO
 Thanks for @jajberni for ProspectPRO implementation!
 
 """
+from collections import OrderedDict
+
+import numba
 import numpy as np
 from scipy.special import expi
 
-from prosail import spectral_lib
+from .spectral_library import get_wavelength_grid
 
 
 def run_prospect(
@@ -32,32 +35,41 @@ def run_prospect(
     kprot=None,
     kcbc=None,
     alpha=40.0,
+    tau_method="scipy",
+    wavelengths=None,
+    dtype=np.float64,
 ):
     """The PROSPECT model, versions 5, D and PRO.
     This function runs PROSPECT. You can select the version using the
     `prospect_version` argument, and you can also set some of the spectra
     used for model calculations.
 
+    All the leaf biochemical parameters (``n`` to ``cbc``) can also be given
+    as 1-D arrays of shape ``(n_samples,)`` (scalars are broadcast against
+    them). In that case, the model is evaluated for all the samples in one
+    go, and the reflectance and transmittance are returned as
+    ``(n_samples, n_wavelengths)`` arrays.
+
     Parameters
     -----------
-    n: float
+    n: float or array
         The number of leaf layers. Unitless [-].
-    cab: float
+    cab: float or array
         The chlorophyll a+b concentration. [ug cm^{-2}].
-    car: float
+    car: float or array
         Carotenoid concentration.  [ug cm^{-2}].
-    cbrown: float
+    cbrown: float or array
         The brown/senescent pigment. Unitless [-], often between 0 and 1
         but the literature on it is wide ranging!
-    cw: float
+    cw: float or array
         Equivalent leaf water. [cm]
-    cm: float
+    cm: float or array
         Dry matter [g cm^{-2}]
-    ant: float, optional
+    ant: float or array, optional
         Anthocyanins content. Used in Prospect-D and Prospect-PRO [ug cm^{-2}]
-    prot: float, optional
+    prot: float or array, optional
         Protein content. Used in Prospect-PRO. [g cm^{-2}]
-    cbc: float, optional
+    cbc: float or array, optional
         Carbon based constituents. Used in Prospect-PRO. [ug cm^{-2}]
     prospect_version: string, optiona, default "D".
         The version of PROSPECT, "5", "D" or "PRO".
@@ -82,19 +94,37 @@ def run_prospect(
         The specific absorption coefficient of carbon based constituents [cm^2 ug^{-1}].
     alpha: float, optional, default 40..
         Maximum incident angle relative to the normal of the leaf plane. [deg]
+    tau_method: str, optional, default "scipy"
+        How to evaluate the transmissivity of the elementary layer:
+        "scipy" uses ``scipy.special.expi``, "numba" uses the compiled
+        :func:`layer_transmissivity` kernel.
+    wavelengths: array or WavelengthGrid, optional
+        The wavelengths [nm] to simulate, see
+        :func:`~prosail.spectral_library.get_wavelength_grid`. By default,
+        400 to 2500 nm every nm. User-supplied spectra can be given on
+        these wavelengths or on the full 2101-element grid.
+    dtype: numpy dtype, optional, default float64
+        Precision of the computation and of the outputs. With
+        ``np.float32``, the spectra and the leaf parameters are cast to single
+        precision, which halves the memory traffic at an accuracy (about
+        1e-6) well within that of the model.
 
 
     Returns
     -------
 
-    3 arrays of the size 2101: the wavelengths in [nm], the leaf reflectance
-    and transmittance.
+    3 arrays of the size 2101 (or of the number of ``wavelengths``): the
+    wavelengths in [nm], the leaf reflectance and transmittance. If the leaf
+    parameters are arrays, the reflectance and transmittance have shape
+    ``(n_samples, n_wavelengths)``.
 
     """
 
+    grid = get_wavelength_grid(wavelengths)
     if prospect_version == "5":
         # Call the original PROSPECT-5. In case the user has supplied
         # spectra, use them.
+        library = grid.spectra("prospect5")
         wv, refl, trans = prospect_d(
             n,
             cab,
@@ -105,18 +135,22 @@ def run_prospect(
             0.0,
             0.0,
             0.0,
-            spectral_lib.prospect5.nr if nr is None else nr,
-            spectral_lib.prospect5.kab if kab is None else kab,
-            spectral_lib.prospect5.kcar if kcar is None else kcar,
-            spectral_lib.prospect5.kbrown if kbrown is None else kbrown,
-            spectral_lib.prospect5.kw if kw is None else kw,
-            spectral_lib.prospect5.km if km is None else km,
-            np.zeros_like(spectral_lib.prospect5.km),
-            np.zeros_like(spectral_lib.prospect5.km),
-            np.zeros_like(spectral_lib.prospect5.km),
+            library.nr if nr is None else grid.take(nr),
+            library.kab if kab is None else grid.take(kab),
+            library.kcar if kcar is None else grid.take(kcar),
+            library.kbrown if kbrown is None else grid.take(kbrown),
+            library.kw if kw is None else grid.take(kw),
+            library.km if km is None else grid.take(km),
+            np.zeros_like(library.km),
+            np.zeros_like(library.km),
+            np.zeros_like(library.km),
             alpha=alpha,
+            tau_method=tau_method,
+            wavelengths=grid,
+            dtype=dtype,
         )
     elif prospect_version.upper() == "D":
+        library = grid.spectra("prospectd")
         wv, refl, trans = prospect_d(
             n,
             cab,
@@ -127,18 +161,22 @@ def run_prospect(
             ant,
             0.0,
             0.0,
-            spectral_lib.prospectd.nr if nr is None else nr,
-            spectral_lib.prospectd.kab if kab is None else kab,
-            spectral_lib.prospectd.kcar if kcar is None else kcar,
-            spectral_lib.prospectd.kbrown if kbrown is None else kbrown,
-            spectral_lib.prospectd.kw if kw is None else kw,
-            spectral_lib.prospectd.km if km is None else km,
-            spectral_lib.prospectd.kant if kant is None else kant,
-            np.zeros_like(spectral_lib.prospect5.km),
-            np.zeros_like(spectral_lib.prospect5.km),
+            library.nr if nr is None else grid.take(nr),
+            library.kab if kab is None else grid.take(kab),
+            library.kcar if kcar is None else grid.take(kcar),
+            library.kbrown if kbrown is None else grid.take(kbrown),
+            library.kw if kw is None else grid.take(kw),
+            library.km if km is None else grid.take(km),
+            library.kant if kant is None else grid.take(kant),
+            np.zeros_like(library.km),
+            np.zeros_like(library.km),
             alpha=alpha,
+            tau_method=tau_method,
+            wavelengths=grid,
+            dtype=dtype,
         )
     elif prospect_version.upper() == "PRO":
+        library = grid.spectra("prospectpro")
         wv, refl, trans = prospect_d(
             n,
             cab,
@@ -149,16 +187,19 @@ def run_prospect(
             ant,
             prot,
             cbc,
-            spectral_lib.prospectpro.nr if nr is None else nr,
-            spectral_lib.prospectpro.kab if kab is None else kab,
-            spectral_lib.prospectpro.kcar if kcar is None else kcar,
-            spectral_lib.prospectpro.kbrown if kbrown is None else kbrown,
-            spectral_lib.prospectpro.kw if kw is None else kw,
-            spectral_lib.prospectpro.km if km is None else km,
-            spectral_lib.prospectpro.kant if kant is None else kant,
-            spectral_lib.prospectpro.kprot if kprot is None else kprot,
-            spectral_lib.prospectpro.kcbc if kcbc is None else kcbc,
+            library.nr if nr is None else grid.take(nr),
+            library.kab if kab is None else grid.take(kab),
+            library.kcar if kcar is None else grid.take(kcar),
+            library.kbrown if kbrown is None else grid.take(kbrown),
+            library.kw if kw is None else grid.take(kw),
+            library.km if km is None else grid.take(km),
+            library.kant if kant is None else grid.take(kant),
+            library.kprot if kprot is None else grid.take(kprot),
+            library.kcbc if kcbc is None else grid.take(kcbc),
             alpha=alpha,
+            tau_method=tau_method,
+            wavelengths=grid,
+            dtype=dtype,
         )
     else:
         raise ValueError("prospect_version can only be 5 or D!")
@@ -219,6 +260,95 @@ def calctav(alpha, nr):
     return tav
 
 
+@numba.vectorize(["f4(f4)", "f8(f8)"], nopython=True, cache=True)
+def layer_transmissivity(k):
+    """Transmissivity of an elementary PROSPECT layer with absorption
+    coefficient ``k``, ``(1 - k) exp(-k) + k^2 E1(k)``, fused with the
+    evaluation of the exponential integral E1 in a single compiled loop.
+
+    E1 is approximated with the polynomial 5.1.53 of Abramowitz & Stegun
+    for ``k <= 1`` (absolute error below 2e-7) and with the rational
+    function 5.1.56 otherwise (error on ``k exp(k) E1(k)`` below 2e-8), where
+    the ``exp(-k)`` factor is shared with the first term. The resulting
+    maximum absolute error on the transmissivity is 2e-7 for ``k <= 1`` and
+    1e-8 for ``k > 1``. Returns 1 for ``k <= 0``.
+
+    References
+    ----------
+    Abramowitz M., Stegun I.A. (1964), Handbook of Mathematical Functions,
+    National Bureau of Standards, Applied Mathematics Series 55, p. 231.
+    """
+    if k <= 0.0:
+        return 1.0
+    if k <= 1.0:
+        e1 = (
+            -np.log(k)
+            - 0.57721566
+            + k
+            * (
+                0.99999193
+                + k
+                * (
+                    -0.24991055
+                    + k * (0.05519968 + k * (-0.00976004 + k * 0.00107857))
+                )
+            )
+        )
+        return (1.0 - k) * np.exp(-k) + k * k * e1
+    # k exp(k) E1(k)
+    kek = (
+        k * (k * (k * (k + 8.5733287401) + 18.0590169730) + 8.6347608925)
+        + 0.2677737343
+    ) / (
+        k * (k * (k * (k + 9.5733223454) + 25.6329561486) + 21.0996530827)
+        + 3.9584969228
+    )
+    return np.exp(-k) * ((1.0 - k) + k * kek)
+
+
+# Interface terms for the most recently used (alpha, nr) pairs, keyed by
+# alpha and the identity of the nr array. The array itself is stored with the
+# terms, so that its id can't be reused by another array while cached.
+_INTERFACE_CACHE = OrderedDict()
+_INTERFACE_CACHE_SIZE = 32
+
+
+def interface_terms(alpha, nr):
+    """Reflectivity and transmissivity of the leaf surface for incident
+    angles up to ``alpha`` and isotropic light (90 degrees), which only
+    depend on the refractive index. They are memoized per ``alpha`` and
+    ``nr`` array, so that repeated runs with the same PROSPECT version only
+    evaluate :func:`calctav` once. ``nr`` must not be modified in place
+    after the first call.
+
+    Returns
+    -------
+    talf, ralf, t12, r12, t21, r21: read-only arrays
+    """
+    key = (float(alpha), id(nr))
+    try:
+        cached_nr, terms = _INTERFACE_CACHE[key]
+    except KeyError:
+        cached_nr = None
+    if cached_nr is nr:
+        _INTERFACE_CACHE.move_to_end(key)
+        return terms
+
+    talf = calctav(alpha, nr)
+    ralf = 1.0 - talf
+    t12 = calctav(90, nr)
+    r12 = 1.0 - t12
+    t21 = t12 / (nr * nr)
+    r21 = 1 - t21
+    terms = (talf, ralf, t12, r12, t21, r21)
+    for term in terms:
+        term.flags.writeable = False
+    _INTERFACE_CACHE[key] = (nr, terms)
+    if len(_INTERFACE_CACHE) > _INTERFACE_CACHE_SIZE:
+        _INTERFACE_CACHE.popitem(last=False)
+    return terms
+
+
 def refl_trans_one_layer(alpha, nr, tau):
     # ***********************************************************************
     # reflectance and transmittance of one layer
@@ -229,12 +359,10 @@ def refl_trans_one_layer(alpha, nr, tau):
     # ***********************************************************************
     # reflectivity and transmissivity at the interface
     # -------------------------------------------------
-    talf = calctav(alpha, nr)
-    ralf = 1.0 - talf
-    t12 = calctav(90, nr)
-    r12 = 1.0 - t12
-    t21 = t12 / (nr * nr)
-    r21 = 1 - t21
+    talf, ralf, t12, r12, t21, r21 = [
+        term.astype(tau.dtype, copy=False)
+        for term in interface_terms(alpha, nr)
+    ]
 
     # top surface side
     denom = 1.0 - r21 * r21 * tau * tau
@@ -268,9 +396,12 @@ def prospect_d(
     kprot,
     kcbc,
     alpha=40.0,
+    tau_method="scipy",
+    wavelengths=None,
+    dtype=np.float64,
 ):
 
-    lambdas = np.arange(400, 2501)  # wavelengths
+    lambdas = get_wavelength_grid(wavelengths).wavelengths.copy()
     n_lambdas = len(lambdas)
     n_elems_list = [
         len(spectrum)
@@ -279,21 +410,50 @@ def prospect_d(
     if not all(n_elems == n_lambdas for n_elems in n_elems_list):
         raise ValueError("Leaf spectra don't have the right shape!")
 
-    kall = (
-        cab * kab
-        + car * kcar
-        + ant * kant
-        + cbrown * kbrown
-        + cw * kw
-        + cm * km
-        + prot * kprot
-        + cbc * kcbc
-    ) / N
-    j = kall > 0
-    t1 = (1 - kall) * np.exp(-kall)
-    t2 = kall ** 2 * (-expi(-kall))
-    tau = np.ones_like(t1)
-    tau[j] = t1[j] + t2[j]
+    # Everything that multiplies the spectra is cast to dtype, so that the
+    # whole computation stays in that precision
+    dtype = np.dtype(dtype)
+    leaf_params = [
+        param.astype(dtype)
+        for param in np.broadcast_arrays(
+            N, cab, car, cbrown, cw, cm, ant, prot, cbc
+        )
+    ]
+    kab, kcar, kbrown, kw, km, kant, kprot, kcbc = [
+        np.asarray(spectrum, dtype=dtype)
+        for spectrum in [kab, kcar, kbrown, kw, km, kant, kprot, kcbc]
+    ]
+    if leaf_params[0].ndim > 1:
+        raise ValueError("Leaf parameters must be scalars or 1-D arrays!")
+    if leaf_params[0].ndim == 1:
+        # Batched mode: one row per sample, broadcast over wavelength. All
+        # the absorption spectra come from a single matrix product.
+        N = leaf_params[0][:, None]
+        concentrations = np.stack(leaf_params[1:], axis=1)
+        kmat = np.vstack([kab, kcar, kbrown, kw, km, kant, kprot, kcbc])
+        kall = (concentrations @ kmat) / N
+    else:
+        N, cab, car, cbrown, cw, cm, ant, prot, cbc = leaf_params
+        kall = (
+            cab * kab
+            + car * kcar
+            + ant * kant
+            + cbrown * kbrown
+            + cw * kw
+            + cm * km
+            + prot * kprot
+            + cbc * kcbc
+        ) / N
+    if tau_method == "scipy":
+        j = kall > 0
+        t1 = (1 - kall) * np.exp(-kall)
+        t2 = kall ** 2 * (-expi(-kall))
+        tau = np.ones_like(t1)
+        tau[j] = t1[j] + t2[j]
+    elif tau_method == "numba":
+        tau = layer_transmissivity(kall)
+    else:
+        raise ValueError("tau_method can only be 'scipy' or 'numba'!")
 
     r, t, Ra, Ta, denom = refl_trans_one_layer(alpha, nr, tau)
 
@@ -321,7 +481,8 @@ def prospect_d(
 
     # Case of zero absorption
     j = r + t >= 1.0
-    Tsub[j] = t[j] / (t[j] + (1 - t[j]) * (N - 1))
+    Nm1 = np.broadcast_to(N - 1, t.shape)
+    Tsub[j] = t[j] / (t[j] + (1 - t[j]) * Nm1[j])
     Rsub[j] = 1 - Tsub[j]
 
     # Reflectance and transmittance of the leaf: combine top layer with next N-1 layers
@@ -1,10 +1,94 @@
 #!/usr/bin/env python
+from collections import namedtuple
+
+try:
+    from functools import lru_cache
+except ImportError:
+    from backports.functools_lru_cache import lru_cache
+
 import numpy as np
 
-from prosail import spectral_lib
 
-from .FourSAIL import foursail
+from .FourSAIL import (
+    SailResult,
+    foursail,
+    foursail_multilai,
+    foursail_multiview,
+)
 from .prospect_d import run_prospect
+from .sensors import apply_srf
+from .spectral_library import get_wavelength_grid
+
+# The foursail terms needed by each of the reflectance factors
+_FACTOR_OUTPUTS = {
+    "SDR": ("rsot",),
+    "BHR": ("rddt",),
+    "DHR": ("rsdt",),
+    "HDR": ("rdot",),
+    "ALL": ("rsot", "rddt", "rsdt", "rdot"),
+    "ALLALL": None,
+}
+
+
+def _select_sail(lai, tto, psi):
+    """Picks the 4SAIL flavour for the given parameters: one LAI and one
+    view direction, many LAI values or many view directions."""
+    many_views = np.ndim(tto) > 0 or np.ndim(psi) > 0
+    if np.ndim(lai) > 0:
+        if many_views:
+            raise ValueError(
+                "'lai' and 'tto'/'psi' can't be arrays at the same time"
+            )
+        return foursail_multilai
+    return foursail_multiview if many_views else foursail
+
+def _soil_reflectance(rsoil0, rsoil, psoil, soil_spectrum1, soil_spectrum2,
+                      grid):
+    """The soil spectrum on the wavelength ``grid``: either ``rsoil0``, or
+    the mixture of the two soil spectra (by default, the dry and wet soils
+    of the library) given by the brightness ``rsoil`` and the moisture
+    ``psoil``."""
+    if rsoil0 is not None:
+        return grid.take(rsoil0)
+    if (rsoil is None) or (psoil is None):
+        raise ValueError(
+            "If rsoil0 isn't defined, then rsoil and psoil"
+            " must be defined!"
+        )
+    soil = grid.spectra("soil")
+    soil_spectrum1 = (
+        soil.rsoil1 if soil_spectrum1 is None else grid.take(soil_spectrum1)
+    )
+    soil_spectrum2 = (
+        soil.rsoil2 if soil_spectrum2 is None else grid.take(soil_spectrum2)
+    )
+    return rsoil * (psoil * soil_spectrum1 + (1.0 - psoil) * soil_spectrum2)
+
+def _factor_result(result, factor, sensor=None, grid=None):
+    """The reflectance factor(s) of a :class:`~prosail.FourSAIL.SailResult`
+    returned by ``run_prosail`` and ``run_sail``, in the bands of ``sensor``
+    if given."""
+    if factor == "ALLALL":
+        if sensor is not None:
+            result = SailResult(
+                apply_srf(result.data, sensor, grid), result.outputs
+            )
+        return result
+    spectra = [result[name] for name in _FACTOR_OUTPUTS[factor]]
+    if sensor is not None:
+        spectra = [apply_srf(spectrum, sensor, grid) for spectrum in spectra]
+    return spectra if factor == "ALL" else spectra[0]
+
+def _crown_geometry(chw, ccover, tts):
+    '''Broadcasts the crown geometry parameters against each other, and
+    returns them together with a copy of ``ccover`` with a trailing
+    wavelength axis, to mix crown and soil spectra.'''
+    chw, ccover, tts = np.broadcast_arrays(
+        np.asarray(chw, dtype=float),
+        np.asarray(ccover, dtype=float),
+        np.asarray(tts, dtype=float),
+    )
+    return chw, ccover, tts, ccover[..., None]
 
 def geocone(chw, ccover, tts, rc, tc, rch, rsoil0):
     '''
@@ -15,21 +99,27 @@ def geocone(chw, ccover, tts, rc, tc, rch, rsoil0):
     the shadowed crown is neglected, because it is assumed to be quantitatively 
     negligible with respect to the other components.
 
+    ``chw``, ``ccover`` and ``tts`` can be arrays, e.g. with the crown
+    geometry and sun angle of every pixel of an image. They broadcast
+    against each other, and the resulting geometry shape (plus a trailing
+    wavelength axis) broadcasts against the spectra, which can either be
+    ``(n_wl,)`` or ``(n_samples, n_wl)`` arrays.
+
     Parameters
     ----------
-    chw : float
+    chw : float or array
         canopy height-to-width ratio. Unitless [.]
-    ccover : float
+    ccover : float or array
         fraction of canopy cover. Unitless [.]
-    tts : float
+    tts : float or array
         sun zenith angle. [deg]
-    rc : float
+    rc : array
         nadir view reflectance of illuminated crown (outputted by SAIL).
-    tc : float
+    tc : array
         transmittance through crown (outputted by SAIL).
-    rch : float
+    rch : array
         hemispheric reflectance of illuminated crown (outputted by SAIL).
-    rsoil0 : float
+    rsoil0 : array
         background reflectance.
 
     Returns
@@ -40,52 +130,62 @@ def geocone(chw, ccover, tts, rc, tc, rch, rsoil0):
         fraction of radiation absorved by canopy from 400 to 2500nm.
 
     '''
-    caspa = np.arctan( ( 1. / (2.*chw) ) )
-    # Huemmrich implementation
-    if chw > ( 1. / (2.*np.tan( np.radians( tts ) ) ) ):
-        # if this condition is satisfied, the arccosine operation is well defined
-        beta = np.arccos( np.tan(caspa) / np.tan( np.radians(tts) ) )
-    else:
-        # we fall back to the no shade value
-        beta = 0.
+    chw, ccover, tts, ccover_wl = _crown_geometry(chw, ccover, tts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        caspa = np.arctan( ( 1. / (2.*chw) ) )
+        tan_tts = np.tan( np.radians( tts ) )
+        # Huemmrich implementation. Where this condition is satisfied, the
+        # arccosine operation is well defined, elsewhere we fall back to the
+        # no shade value
+        shaded = chw > ( 1. / (2.*tan_tts) )
+        beta = np.where(shaded, np.arccos(
+            np.where(shaded, np.tan(caspa) / tan_tts, 1.) ), 0.)
     eta = ( np.tan(beta) - beta ) / np.pi
-    fcsh = beta/np.pi
-    sfrac = 1.0 - ccover - (1.0 - ccover)**(eta + 1.0)
-    ilsoil = 1.0 - ccover - sfrac
+    fcsh = ( beta/np.pi )[..., None]
+    sfrac = ( 1.0 - ccover - (1.0 - ccover)**(eta + 1.0) )[..., None]
+    # The fractions are mixed in the precision of the spectra
+    dtype = np.result_type(rc, tc, rsoil0)
+    fcsh, sfrac, ccover_wl = [fraction.astype(dtype, copy=False)
+                              for fraction in (fcsh, sfrac, ccover_wl)]
+    ilsoil = 1.0 - ccover_wl - sfrac
     rcsh = tc*rc
     rssh = tc*rsoil0
     # Calculate scene reflectance (rsc) as the sum of the components in the scene
     # (illuminated crown, illuminated background, shadowed background)
     # weighted by their fractions in the scene
-    rsc = ccover*(1. - fcsh)*rc + (ccover*fcsh)*rcsh + sfrac*rssh + ilsoil*rsoil0
+    rsc = (ccover_wl*(1. - fcsh)*rc + (ccover_wl*fcsh)*rcsh + sfrac*rssh
+           + ilsoil*rsoil0)
     # !!! For now we do not implement the fraction of absorbed radiation
     gsfr = 0
     return rsc, gsfr
 
 def geocyli(chw, ccover, tts, rc, tc, rch, rsoil0):
     '''
-    Huemmrich-style Jasinski function for the ``cone`` shape.
+    Huemmrich-style Jasinski function for the ``cylinder`` shape.
     In the ``cone`` case, the scene reflectance is calculated as the sum of the 
     component reflectances of the illuminated and shadow portions of the 
     background and of the canopy. In the ``cylinder`` case, the contribution of
     the shadowed crown is neglected, because it is assumed to be quantitatively 
     negligible with respect to the other components.
 
+    ``chw``, ``ccover`` and ``tts`` can be arrays, which broadcast as in
+    :func:`geocone`.
+
     Parameters
     ----------
-    chw : float
+    chw : float or array
         canopy height-to-width ratio. Unitless [.]
-    ccover : float
+    ccover : float or array
         fraction of canopy cover. Unitless [.]
-    tts : float
+    tts : float or array
         sun zenith angle. [deg]
-    rc : float
+    rc : array
         nadir view reflectance of illuminated crown (outputted by SAIL).
-    tc : float
+    tc : array
         transmittance through crown (outputted by SAIL).
-    rch : float
+    rch : array
         hemispheric reflectance of illuminated crown (outputted by SAIL).
-    rsoil0 : float
+    rsoil0 : array
         background reflectance.
 
     Returns
@@ -96,19 +196,122 @@ def geocyli(chw, ccover, tts, rc, tc, rch, rsoil0):
         fraction of radiation absorved by canopy from 400 to 2500nm.
 
     '''
+    chw, ccover, tts, ccover_wl = _crown_geometry(chw, ccover, tts)
     # Calculate ETA, the ratio of canopy area to shadow area for an
     # individual crown
     eta = chw*np.tan(np.radians(tts))
     # Using ETA to calculate the fraction of the background that is shadowed (sfrac)
     # and illuminated (ilsoil)
-    sfrac = 1.0 - ccover - (1.0 - ccover)**(eta + 1.0)
-    ilsoil = 1.0 - ccover - sfrac
+    sfrac = ( 1.0 - ccover - (1.0 - ccover)**(eta + 1.0) )[..., None]
+    dtype = np.result_type(tc, rc, rsoil0)
+    sfrac, ccover_wl = [fraction.astype(dtype, copy=False)
+                        for fraction in (sfrac, ccover_wl)]
+    ilsoil = 1.0 - ccover_wl - sfrac
     # Reflectance of the shadowed background (rssh)
     rssh = tc*rsoil0
     # Calculate scene reflectance (rsc) as the sum of the components in the scene
     # (illuminated crown, illuminated background, shadowed background)
     # weighted by their fractions in the scene
-    rsc = ccover*rc + sfrac*rssh + ilsoil*rsoil0
+    rsc = ccover_wl*rc + sfrac*rssh + ilsoil*rsoil0
+    # !!! For now we do not implement the fraction of absorbed radiation
+    gsfr = 0
+    return rsc, gsfr
+
+# Jasinski mixing function of each crown shape
+_CROWN_MIXERS = {"cone": geocone, "cylinder": geocyli}
+
+CrownOptics = namedtuple("CrownOptics", "wv rdo tdo rdd tts")
+
+
+def run_crown_optics(n, cab, car, cbrown, cw, cm, lai, lidfa, hspot,
+                     tts, tto, psi, ant=0.0, alpha=40., prospect_version="5",
+                     typelidf=2, lidfb=0., wavelengths=None,
+                     dtype=np.float64):
+    """First stage of :func:`run_progeosail`: the optical properties of the
+    crowns, as simulated by PROSPECT and SAIL. They don't depend on the
+    crown geometry nor on the soil, so the results are cached, and a
+    GeoSAIL LUT over many crown shapes, covers and height-to-width ratios
+    only needs one SAIL run per leaf and canopy setting. All the parameters
+    (but ``wavelengths`` and ``dtype``) must be scalars, and are described
+    in :func:`run_progeosail`.
+
+    Returns
+    -------
+    A ``CrownOptics`` named tuple with the wavelengths ``wv``, the
+    hemispherical-directional reflectance ``rdo`` and transmittance ``tdo``
+    and the bi-hemispherical reflectance ``rdd`` of the crowns, and the sun
+    zenith angle ``tts``. The arrays are read-only, as they are shared by
+    all the callers.
+    """
+    return _crown_optics(
+        float(n), float(cab), float(car), float(cbrown), float(cw),
+        float(cm), float(lai), float(lidfa), float(hspot), float(tts),
+        float(tto), float(psi), float(ant), float(alpha),
+        str(prospect_version).upper(), int(typelidf), float(lidfb),
+        get_wavelength_grid(wavelengths), np.dtype(dtype).name,
+    )
+
+
+@lru_cache(maxsize=256)
+def _crown_optics(n, cab, car, cbrown, cw, cm, lai, lidfa, hspot, tts, tto,
+                  psi, ant, alpha, prospect_version, typelidf, lidfb,
+                  wavelengths, dtype):
+    wv, refl, trans = run_prospect(n, cab, car, cbrown, cw, cm, ant=ant,
+                                   prospect_version=prospect_version,
+                                   alpha=alpha, wavelengths=wavelengths,
+                                   dtype=dtype)
+    # rdo, tdo and rdd are canopy terms, so any soil will do
+    result = foursail(refl, trans, lidfa, lidfb, typelidf, lai, hspot,
+                      tts, tto, psi, np.zeros_like(refl),
+                      outputs=("rdo", "tdo", "rdd"))
+    result.data.setflags(write=False)
+    return CrownOptics(wv, result.rdo, result.tdo, result.rdd, tts)
+
+
+def mix_crowns(optics, chw, ccover, cshp, rsoil0):
+    """Second stage of :func:`run_progeosail`: mixes the crown optical
+    properties with the soil according to the Jasinski geometric model of
+    each crown geometry. ``chw``, ``ccover`` and ``cshp`` broadcast against
+    each other, so e.g. a grid of height-to-width ratios and crown covers
+    can be simulated in one call.
+
+    Parameters
+    ----------
+    optics: CrownOptics
+        Output of :func:`run_crown_optics`.
+    chw: float or array
+        height-to-width ratio of the crown. Unitless [-]
+    ccover: float or array
+        crown coverage, i.e. ratio of crown surface to soil surface. Unitless [-]
+    cshp: str or array of str
+        shape of the crowns. Currently supports 'cylinder' or 'cone'
+    rsoil0: array
+        The soil reflectance spectrum
+
+    Returns
+    --------
+    rsfc: array of float
+        scene reflectance factor between 400 and 2500 nm, with shape
+        ``np.broadcast(chw, ccover, cshp).shape + (n_wl,)``.
+    gsfr: array of float
+        fraction of radiation absorbed by the crown (not implemented yet,
+        always 0).
+    """
+    chw, ccover, cshp = np.broadcast_arrays(
+        np.asarray(chw, dtype=float),
+        np.asarray(ccover, dtype=float),
+        np.char.lower(np.asarray(cshp, dtype=str)),
+    )
+    if not set(np.unique(cshp)).issubset(_CROWN_MIXERS):
+        raise ValueError('The shape of the crown can be either cylinder or cone!')
+    spectral_shape = np.broadcast(optics.rdo, rsoil0).shape
+    rsc = np.empty(chw.shape + spectral_shape,
+                   dtype=np.result_type(optics.rdo, rsoil0))
+    for shape, mixer in _CROWN_MIXERS.items():
+        mask = cshp == shape
+        if np.any(mask):
+            rsc[mask] = mixer(chw[mask], ccover[mask], optics.tts,
+                              optics.rdo, optics.tdo, optics.rdd, rsoil0)[0]
     # !!! For now we do not implement the fraction of absorbed radiation
     gsfr = 0
     return rsc, gsfr
@@ -117,7 +320,8 @@ def run_prosail(n, cab, car,  cbrown, cw, cm, lai, lidfa, hspot,
                 tts, tto, psi, ant=0.0, alpha=40., prospect_version="5", 
                 typelidf=2, lidfb=0., factor="SDR",
                 rsoil0=None, rsoil=None, psoil=None,
-                soil_spectrum1=None, soil_spectrum2=None):
+                soil_spectrum1=None, soil_spectrum2=None, sensor=None,
+                wavelengths=None, dtype=np.float64):
     """Run the PROSPECT 5, D or PRO and SAILh radiative transfer models. The 
     soil model is a linear mixture model, where two spectra are combined 
     together as follows:
@@ -143,16 +347,21 @@ def run_prosail(n, cab, car,  cbrown, cw, cm, lai, lidfa, hspot,
         leaf water content in [g cm^{-2}] or equivalent water thickness in [cm]
     cm: float
         leaf dry matter. [g cm^{-2}].
-    lai: float
-        leaf area index (LAI). Unitless [-].
+    lai: float or array
+        leaf area index (LAI). Unitless [-]. If ``lai`` is a 1-D array, the
+        whole LAI sweep is simulated in one go, and the reflectance factors
+        have one row per LAI value. Can't be combined with arrays of view
+        angles.
     lidfa: float
         a parameter for leaf angle distribution. If typelidf=2, average
         leaf inclination angle.
     tts: float
         Solar zenith angle. [deg]
-    tto: float
-        Sensor zenith angle. [deg]
-    psi: float
+    tto: float or array
+        Sensor zenith angle. [deg] If ``tto`` and/or ``psi`` are 1-D arrays,
+        all the view directions are simulated in one go, and the reflectance
+        factors have one row per view.
+    psi: float or array
         Relative sensor-solar azimuth angle ( saa - vaa ). [deg].
     ant: float
         anthocyanins content. Used in Prospect-D and Prospect-PRO only. [ug cm^{-2}]
@@ -173,7 +382,8 @@ def run_prosail(n, cab, car,  cbrown, cw, cm, lai, lidfa, hspot,
         * "DHR": Directional-Hemispherical r. f. (directional illumination)
         * "HDR": Hemispherical-Directional r. f. (directional view)
         * "ALL": All of them
-        * "ALLALL": All of the terms calculated by SAIL, including the above
+        * "ALLALL": All of the terms calculated by SAIL, including the above,
+          as a :class:`~prosail.FourSAIL.SailResult`
     rsoil0: float, optional
         The soil reflectance spectrum
     rsoil: float, optional
@@ -184,10 +394,25 @@ def run_prosail(n, cab, car,  cbrown, cw, cm, lai, lidfa, hspot,
         First component of the soil spectrum
     soil_spectrum2: 2101-element array
         Second component of the soil spectrum
+    sensor: str or Sensor, optional
+        If given, the outputs are returned in the bands of this sensor
+        (e.g. "sentinel2a"), see :func:`prosail.sensors.get_sensor`.
+    wavelengths: array or WavelengthGrid, optional
+        Only simulate these wavelengths [nm] (e.g. the band centres of a
+        sensor, or a 10 nm grid), see
+        :func:`~prosail.spectral_library.get_wavelength_grid`. The soil
+        spectra can be given on these wavelengths or between 400 and 2500
+        nm. By default, 400 to 2500 nm every nm.
+    dtype: numpy dtype, optional
+        Floating point type of the spectral computations. With
+        ``np.float32``, the whole model chain runs (and returns) in single
+        precision, which halves the memory traffic at a cost of about 1e-6
+        in reflectance. By default, ``np.float64``.
     Returns
     --------
     rsfc: array of float
-        scene reflectance factor between 400 and 2500 nm.
+        scene reflectance factor between 400 and 2500 nm, or in the bands
+        of ``sensor``.
     gsfr: array of float
         fraction of radiation absorbed by the crown for each wavelenght between
         400 and 2500 nm. In PAR wavelengths this coincides with FAPAR.
@@ -199,58 +424,33 @@ def run_prosail(n, cab, car,  cbrown, cw, cm, lai, lidfa, hspot,
         raise ValueError(
             "'factor' must be one of SDR, BHR, DHR, HDR, ALL or ALLALL"
         )
-    if soil_spectrum1 is not None:
-        assert (len(soil_spectrum1) == 2101)
-    else:
-        soil_spectrum1 = spectral_lib.soil.rsoil1
-
-    if soil_spectrum2 is not None:
-        assert (len(soil_spectrum1) == 2101)
-    else:
-        soil_spectrum2 = spectral_lib.soil.rsoil2
-
-    if rsoil0 is None:
-        if (rsoil is None) or (psoil is None):
-            raise ValueError(
-                "If rsoil0 isn't defined, then rsoil and psoil"
-                " must be defined!"
-            )
-        rsoil0 = rsoil * (
-        psoil * soil_spectrum1 + (1. - psoil) * soil_spectrum2)
+    grid = get_wavelength_grid(wavelengths)
+    rsoil0 = _soil_reflectance(rsoil0, rsoil, psoil, soil_spectrum1,
+                               soil_spectrum2, grid)
+    rsoil0 = np.asarray(rsoil0, dtype=dtype)
 
     wv, refl, trans = run_prospect (n, cab, car,  cbrown, cw, cm, ant=ant, 
-                 prospect_version=prospect_version, alpha=alpha)
+                 prospect_version=prospect_version, alpha=alpha,
+                 wavelengths=grid, dtype=dtype)
     
-    [tss, too, tsstoo, rdd, tdd, rsd, tsd, rdo, tdo,
-         rso, rsos, rsod, rddt, rsdt, rdot, rsodt, rsost, rsot,
-         gammasdf, gammasdb, gammaso] = foursail (refl, trans,  
-                                                  lidfa, lidfb, typelidf, 
-                                                  lai, hspot, 
-                                                  tts, tto, psi, rsoil0)
-
-    if factor == "SDR":
-        return rsot
-    elif factor == "BHR":
-        return rddt
-    elif factor == "DHR":
-        return rsdt
-    elif factor == "HDR":
-        return rdot
-    elif factor == "ALL":
-        return [rsot, rddt, rsdt, rdot]
-    elif factor == "ALLALL":
-        return [tss, too, tsstoo, rdd, tdd, rsd, tsd, rdo, tdo,
-         rso, rsos, rsod, rddt, rsdt, rdot, rsodt, rsost, rsot,
-         gammasdf, gammasdb, gammaso]
+    sail = _select_sail(lai, tto, psi)
+    result = sail(refl, trans, lidfa, lidfb, typelidf, lai, hspot,
+                  tts, tto, psi, rsoil0, outputs=_FACTOR_OUTPUTS[factor])
+
+    return _factor_result(result, factor, sensor, grid)
 
 def run_progeosail(chw, ccover, cshp,
                    n, cab, car,  cbrown, cw, cm, lai, lidfa, hspot,
                    tts, tto, psi, ant=0.0, alpha=40., prospect_version="5", 
                    typelidf=2, lidfb=0., factor="SDR",
                    rsoil0=None, rsoil=None, psoil=None,
-                   soil_spectrum1=None, soil_spectrum2=None):
+                   soil_spectrum1=None, soil_spectrum2=None, sensor=None,
+                   wavelengths=None, dtype=np.float64):
     """Run the PROSPECT 5, D or PRO and SAILh radiative transfer models and the 
-    selected Jasinski geometric model. The soil model is a linear mixture model, 
+    selected Jasinski geometric model. This is done in two stages: the crown
+    optical properties are simulated (and cached) by :func:`run_crown_optics`,
+    and then mixed with the soil by :func:`mix_crowns`. Use these directly to
+    simulate many crown geometries at once. The soil model is a linear mixture model, 
     where two spectra are combined together as follows:
     
          rho_soil = rsoil*(psoil*soil_spectrum1+(1-psoil)*soil_spectrum2)
@@ -262,12 +462,13 @@ def run_progeosail(chw, ccover, cshp,
 
     Parameters
     ----------
-    chw: float
+    chw: float or array
         height-to-width ratio of the crown. Unitless [-]
-    ccover: float
+    ccover: float or array
         crown coverage, i.e. ratio of crown surface to soil surface. Unitless [-]
-    cshp: str
-        shape of the crowns. Currently supports 'cylinder' or 'cone'
+    cshp: str or array of str
+        shape of the crowns. Currently supports 'cylinder' or 'cone'. ``chw``,
+        ``ccover`` and ``cshp`` broadcast against each other.
     n: float
         number of leaf layers. Unitless [-].
     cab: float
@@ -321,10 +522,25 @@ def run_progeosail(chw, ccover, cshp,
         First component of the soil spectrum
     soil_spectrum2: 2101-element array
         Second component of the soil spectrum
+    sensor: str or Sensor, optional
+        If given, the outputs are returned in the bands of this sensor
+        (e.g. "sentinel2a"), see :func:`prosail.sensors.get_sensor`.
+    wavelengths: array or WavelengthGrid, optional
+        Only simulate these wavelengths [nm] (e.g. the band centres of a
+        sensor, or a 10 nm grid), see
+        :func:`~prosail.spectral_library.get_wavelength_grid`. The soil
+        spectra can be given on these wavelengths or between 400 and 2500
+        nm. By default, 400 to 2500 nm every nm.
+    dtype: numpy dtype, optional
+        Floating point type of the spectral computations. With
+        ``np.float32``, the whole model chain runs (and returns) in single
+        precision, which halves the memory traffic at a cost of about 1e-6
+        in reflectance. By default, ``np.float64``.
     Returns
     --------
     rsfc: array of float
-        scene reflectance factor between 400 and 2500 nm.
+        scene reflectance factor between 400 and 2500 nm, or in the bands
+        of ``sensor``.
     gsfr: array of float
         fraction of radiation absorbed by the crown for each wavelenght between
         400 and 2500 nm. In PAR wavelengths this coincides with FAPAR.
@@ -336,42 +552,19 @@ def run_progeosail(chw, ccover, cshp,
         raise ValueError(
             "'factor' must be one of SDR, BHR, DHR, HDR, ALL or ALLALL"
         )
-    if soil_spectrum1 is not None:
-        assert (len(soil_spectrum1) == 2101)
-    else:
-        soil_spectrum1 = spectral_lib.soil.rsoil1
-
-    if soil_spectrum2 is not None:
-        assert (len(soil_spectrum1) == 2101)
-    else:
-        soil_spectrum2 = spectral_lib.soil.rsoil2
-
-    if rsoil0 is None:
-        if (rsoil is None) or (psoil is None):
-            raise ValueError(
-                "If rsoil0 isn't defined, then rsoil and psoil"
-                " must be defined!"
-            )
-        rsoil0 = rsoil * (
-        psoil * soil_spectrum1 + (1. - psoil) * soil_spectrum2)
-
-    wv, refl, trans = run_prospect (n, cab, car,  cbrown, cw, cm, ant=ant, 
-                 prospect_version=prospect_version, alpha=alpha)
-    
-    [tss, too, tsstoo, rdd, tdd, rsd, tsd, rdo, tdo,
-         rso, rsos, rsod, rddt, rsdt, rdot, rsodt, rsost, rsot,
-         gammasdf, gammasdb, gammaso] = foursail (refl, trans,  
-                                                  lidfa, lidfb, typelidf, 
-                                                  lai, hspot, 
-                                                  tts, tto, psi, rsoil0)
-    if cshp.lower() == 'cone':
-        rsc, gsfr = geocone(chw, ccover, tts, rdo, tdo, rdd, rsoil0)
-        # rsc, gsfr = geocone(chw, ccover, tts, rso, tdo, rdo, rsoil0)
-    elif cshp.lower() == 'cylinder':
-        rsc, gsfr = geocyli(chw, ccover, tts, rdo, tdo, rdd, rsoil0)
-        # rsc, gsfr = geocyli(chw, ccover, tts, rso, tdo, rdo, rsoil0)
-    else:
-        raise ValueError('The shape of the crown can be either cylinder or cone!')
+    grid = get_wavelength_grid(wavelengths)
+    rsoil0 = _soil_reflectance(rsoil0, rsoil, psoil, soil_spectrum1,
+                               soil_spectrum2, grid)
+    rsoil0 = np.asarray(rsoil0, dtype=dtype)
+
+    optics = run_crown_optics(n, cab, car, cbrown, cw, cm, lai, lidfa, hspot,
+                              tts, tto, psi, ant=ant, alpha=alpha,
+                              prospect_version=prospect_version,
+                              typelidf=typelidf, lidfb=lidfb,
+                              wavelengths=grid, dtype=dtype)
+    rsc, gsfr = mix_crowns(optics, chw, ccover, cshp, rsoil0)
+    if sensor is not None:
+        rsc = apply_srf(rsc, sensor, grid)
     return rsc, gsfr
 
 def run_sail(
@@ -391,6 +584,9 @@ def run_sail(
     psoil=None,
     soil_spectrum1=None,
     soil_spectrum2=None,
+    sensor=None,
+    wavelengths=None,
+    dtype=np.float64,
 ):
     """Run the SAILh radiative transfer model. The soil model is a linear
     mixture model, where two spectra are combined together as
@@ -409,8 +605,10 @@ def run_sail(
         Leaf reflectance
     trans: 2101-element array
         leaf transmittance
-    lai: float
-        leaf area index
+    lai: float or array
+        leaf area index. If ``lai`` is a 1-D array, the whole LAI sweep is
+        simulated in one go, and the reflectance factors have one row per LAI
+        value. Can't be combined with arrays of view angles.
     lidfa: float
         a parameter for leaf angle distribution. If ``typliedf``=2, average
         leaf inclination angle.
@@ -418,9 +616,11 @@ def run_sail(
         The hotspot parameter
     tts: float
         Solar zenith angle
-    tto: float
-        Sensor zenith angle
-    psi: float
+    tto: float or array
+        Sensor zenith angle. If ``tto`` and/or ``psi`` are 1-D arrays, all
+        the view directions are simulated in one go, and the reflectance
+        factors have one row per view.
+    psi: float or array
         Relative sensor-solar azimuth angle ( saa - vaa )
     typelidf: int, optional
         The type of leaf angle distribution function to use. By default, is set
@@ -434,7 +634,8 @@ def run_sail(
         * "DHR": Directional-Hemispherical r. f. (directional illumination)
         * "HDR": Hemispherical-Directional r. f. (directional view)
         * "ALL": All of them
-        * "ALLALL": All of the terms calculated by SAIL, including the above
+        * "ALLALL": All of the terms calculated by SAIL, including the above,
+          as a :class:`~prosail.FourSAIL.SailResult`
     rsoil0: float, optional
         The soil reflectance spectrum
     rsoil: float, optional
@@ -445,10 +646,25 @@ def run_sail(
         First component of the soil spectrum
     soil_spectrum2: 2101-element array
         Second component of the soil spectrum
+    sensor: str or Sensor, optional
+        If given, the outputs are returned in the bands of this sensor
+        (e.g. "sentinel2a"), see :func:`prosail.sensors.get_sensor`.
+    wavelengths: array or WavelengthGrid, optional
+        Only simulate these wavelengths [nm] (e.g. the band centres of a
+        sensor, or a 10 nm grid), see
+        :func:`~prosail.spectral_library.get_wavelength_grid`. The soil
+        spectra can be given on these wavelengths or between 400 and 2500
+        nm. By default, 400 to 2500 nm every nm.
+    dtype: numpy dtype, optional
+        Floating point type of the spectral computations. With
+        ``np.float32``, the whole model chain runs (and returns) in single
+        precision, which halves the memory traffic at a cost of about 1e-6
+        in reflectance. By default, ``np.float64``.
 
     Returns
     --------
-    Directional surface reflectance between 400 and 2500 nm
+    Directional surface reflectance between 400 and 2500 nm, or in the bands
+    of ``sensor``
 
 
     """
@@ -458,87 +674,43 @@ def run_sail(
         raise ValueError(
             "'factor' must be one of SDR, BHR, DHR, HDR, ALL or ALLALL"
         )
-    if soil_spectrum1 is not None:
-        assert len(soil_spectrum1) == 2101
-    else:
-        soil_spectrum1 = spectral_lib.soil.rsoil1
-
-    if soil_spectrum2 is not None:
-        assert len(soil_spectrum1) == 2101
-    else:
-        soil_spectrum2 = spectral_lib.soil.rsoil2
-
-    if rsoil0 is None:
-        if (rsoil is None) or (psoil is None):
-            raise ValueError(
-                "If rsoil0 isn't define, then rsoil and psoil"
-                " need to be defined!"
-            )
-        else:
-            rsoil0 = rsoil * (
-                psoil * soil_spectrum1 + (1.0 - psoil) * soil_spectrum2
-            )
-
-    [
-        tss,
-        too,
-        tsstoo,
-        rdd,
-        tdd,
-        rsd,
-        tsd,
-        rdo,
-        tdo,
-        rso,
-        rsos,
-        rsod,
-        rddt,
-        rsdt,
-        rdot,
-        rsodt,
-        rsost,
-        rsot,
-        gammasdf,
-        gammasdb,
-        gammaso,
-    ] = foursail(
-        refl, trans, lidfa, lidfb, typelidf, lai, hspot, tts, tto, psi, rsoil0
+    grid = get_wavelength_grid(wavelengths)
+    rsoil0 = _soil_reflectance(rsoil0, rsoil, psoil, soil_spectrum1,
+                               soil_spectrum2, grid)
+    rsoil0 = np.asarray(rsoil0, dtype=dtype)
+
+    sail = _select_sail(lai, tto, psi)
+    result = sail(
+        np.asarray(refl, dtype=dtype),
+        np.asarray(trans, dtype=dtype),
+        lidfa,
+        lidfb,
+        typelidf,
+        lai,
+        hspot,
+        tts,
+        tto,
+        psi,
+        rsoil0,
+        outputs=_FACTOR_OUTPUTS[factor],
     )
 
-    if factor == "SDR":
-        return rsot
-    elif factor == "BHR":
-        return rddt
-    elif factor == "DHR":
-        return rsdt
-    elif factor == "HDR":
-        return rdot
-    elif factor == "ALL":
-        return [rsot, rddt, rsdt, rdot]
-    elif factor == "ALLALL":
-        return [
-            tss,
-            too,
-            tsstoo,
-            rdd,
-            tdd,
-            rsd,
-            tsd,
-            rdo,
-            tdo,
-            rso,
-            rsos,
-            rsod,
-            rddt,
-            rsdt,
-            rdot,
-            rsodt,
-            rsost,
-            rsot,
-            gammasdf,
-            gammasdb,
-            gammaso,
-        ]
+    return _factor_result(result, factor, sensor, grid)
+
+
+# The foursail terms used by run_thermal_sail
+_THERMAL_OUTPUTS = (
+    "tss",
+    "too",
+    "tsstoo",
+    "rdd",
+    "tdd",
+    "rdo",
+    "tdo",
+    "rdot",
+    "gammasdf",
+    "gammaso",
+)
 
 
 def run_thermal_sail(
@@ -561,16 +733,62 @@ def run_thermal_sail(
     typelidf=2,
     lidfb=0,
 ):
+    """Run the 4SAIL thermal model. The emitted radiance is a linear mixture
+    of the Planck emission of shaded and sunlit leaves and soil, and of the
+    sky, weighted by 4SAIL terms. These only depend on the emissivities and
+    on the canopy and view geometry, so they are computed once, and reused
+    for all the temperatures.
+
+    Parameters
+    ----------
+    lam: float or array
+        Wavelength(s). [um]
+    tveg, tsoil, tveg_sunlit, tsoil_sunlit, t_atm: float or array
+        Temperatures of the shaded leaves, shaded soil, sunlit leaves, sunlit
+        soil and sky. [K] They broadcast against each other and against the
+        shape of the 4SAIL terms, ``(n_views, n_lam)`` (leaving out the
+        axes of the scalar angles or wavelengths), so e.g. temperatures with
+        shape ``(n_temperatures, 1, 1)`` give ``(n_temperatures, n_views,
+        n_lam)`` outputs.
+    lai: float or array
+        leaf area index. If ``lai`` is an array, it replaces the view axis.
+    lidfa: float
+        a parameter for leaf angle distribution. If ``typelidf``=2, average
+        leaf inclination angle.
+    hspot: float
+        The hotspot parameter
+    tts: float
+        Solar zenith angle. [deg]
+    tto: float or array
+        Sensor zenith angle. [deg] If ``tto`` and/or ``psi`` are 1-D arrays,
+        the outputs have one row per view.
+    psi: float or array
+        Relative sensor-solar azimuth angle ( saa - vaa ). [deg]
+    rsoil: float or array, optional
+        Soil reflectance, ``1 - ems`` if not given.
+    refl: float or array, optional
+        Leaf reflectance, ``1 - emv`` if not given.
+    emv: float or array, optional
+        Leaf emissivity, ``1 - refl`` if not given.
+    ems: float or array, optional
+        Soil emissivity, ``1 - rsoil`` if not given.
+    typelidf: int, optional
+        The type of leaf angle distribution function to use. By default, is set
+        to 2.
+    lidfb: float, optional
+        b parameter for leaf angle distribution. If ``typelidf``=2, ignored
+
+    Returns
+    -------
+    Lw: float or array
+        Emitted longwave radiance.
+    Tbright: float or array
+        Brightness temperature. [K]
+    dir_em: float or array
+        Directional emissivity, with the shape of the 4SAIL terms.
+    """
     c1 = 3.741856e-16
     c2 = 14388.0
-    # Calculate the thermal emission from the different
-    # components using Planck's Law
-    top = (1.0e-6) * c1 * (lam * 1e-6) ** (-5.0)
-    Hc = top / (np.exp(c2 / (lam * tveg)) - 1.0)  # Shade leaves
-    Hh = top / (np.exp(c2 / (lam * tveg_sunlit)) - 1.0)  # Sunlit leaves
-    Hd = top / (np.exp(c2 / (lam * tsoil)) - 1.0)  # shade soil
-    Hs = top / (np.exp(c2 / (lam * tsoil_sunlit)) - 1.0)  # Sunlit soil
-    Hsky = top / (np.exp(c2 / (lam * t_atm)) - 1.0)  # Sky emission
 
     # Emissivity calculations
     if refl is not None and emv is None:
@@ -584,29 +802,12 @@ def run_thermal_sail(
     if refl is None and emv is not None:
         refl = 1.0 - emv
 
-    [
-        tss,
-        too,
-        tsstoo,
-        rdd,
-        tdd,
-        rsd,
-        tsd,
-        rdo,
-        tdo,
-        rso,
-        rsos,
-        rsod,
-        rddt,
-        rsdt,
-        rdot,
-        rsodt,
-        rsost,
-        rsot,
-        gammasdf,
-        gammasdb,
-        gammaso,
-    ] = foursail(
+    # One SAIL run per wavelength and view, shared by all the temperatures
+    spectral_shape = np.broadcast(lam, refl, rsoil).shape
+    refl = np.broadcast_to(refl, spectral_shape)
+    rsoil = np.broadcast_to(rsoil, spectral_shape)
+    sail = _select_sail(lai, tto, psi)
+    result = sail(
         refl,
         np.zeros_like(refl),
         lidfa,
@@ -618,7 +819,11 @@ def run_thermal_sail(
         tto,
         psi,
         rsoil,
+        outputs=_THERMAL_OUTPUTS,
     )
+    tss, too, tsstoo, rdd, tdd, rdo, tdo, rdot, gammasdf, gammaso = [
+        result[name] for name in _THERMAL_OUTPUTS
+    ]
 
     gammad = 1.0 - rdd - tdd
     gammao = 1.0 - rdo - tdo - too
@@ -631,14 +836,25 @@ def run_thermal_sail(
 
     aeev = gammaot
     aees = ttot * ems
+    gammasot_emv = gammasot * emv
+    tso_ems = tso * ems
+
+    # Calculate the thermal emission from the different
+    # components using Planck's Law
+    top = (1.0e-6) * c1 * (lam * 1e-6) ** (-5.0)
+    Hc = top / (np.exp(c2 / (lam * tveg)) - 1.0)  # Shade leaves
+    Hh = top / (np.exp(c2 / (lam * tveg_sunlit)) - 1.0)  # Sunlit leaves
+    Hd = top / (np.exp(c2 / (lam * tsoil)) - 1.0)  # shade soil
+    Hs = top / (np.exp(c2 / (lam * tsoil_sunlit)) - 1.0)  # Sunlit soil
+    Hsky = top / (np.exp(c2 / (lam * t_atm)) - 1.0)  # Sky emission
 
     Lw = (
         (rdot * Hsky) / np.pi
         + (
             aeev * Hc
-            + gammasot * emv * (Hh - Hc)
+            + gammasot_emv * (Hh - Hc)
             + aees * Hd
-            + tso * ems * (Hs - Hd)
+            + tso_ems * (Hs - Hd)
         )
     ) / np.pi
 
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""Simulation of the bands of multispectral sensors. The spectral response
+functions (SRFs) of a sensor are stored as a sparse ``(n_bands, n_wl)``
+matrix, with rows normalised to one, so that the band reflectances of many
+spectra are one sparse matrix product away."""
+
+import os
+from collections import namedtuple
+
+try:
+    from functools import lru_cache
+except ImportError:
+    from backports.functools_lru_cache import lru_cache
+
+import numpy as np
+import scipy.sparse
+
+from .spectral_library import LIBRARY_WAVELENGTHS, get_wavelength_grid
+
+# The wavelengths of the models (nm)
+WAVELENGTHS = LIBRARY_WAVELENGTHS
+
+# SRFs below this fraction of their peak are set to zero
+SRF_THRESHOLD = 1e-3
+
+Sensor = namedtuple("Sensor", "name bands centres srf")
+
+# Band names, centres and full widths at half maximum (nm) of the sensors
+# that are simulated with Gaussian SRFs.
+SENSORS = {
+    "sentinel2a": (
+        ("B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B8A", "B9",
+         "B10", "B11", "B12"),
+        (442.7, 492.4, 559.8, 664.6, 704.1, 740.5, 782.8, 832.8, 864.7,
+         945.1, 1373.5, 1613.7, 2202.4),
+        (21.0, 66.0, 36.0, 31.0, 15.0, 15.0, 20.0, 106.0, 21.0, 20.0,
+         31.0, 91.0, 175.0),
+    ),
+    "sentinel2b": (
+        ("B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B8A", "B9",
+         "B10", "B11", "B12"),
+        (442.2, 492.1, 559.0, 664.9, 703.8, 739.1, 779.7, 832.9, 864.0,
+         943.2, 1376.9, 1610.4, 2185.7),
+        (21.0, 66.0, 36.0, 31.0, 16.0, 15.0, 20.0, 106.0, 22.0, 21.0,
+         30.0, 94.0, 185.0),
+    ),
+    "landsat8": (
+        ("B1", "B2", "B3", "B4", "B5", "B6", "B7", "B9"),
+        (443.0, 482.0, 561.4, 654.6, 864.6, 1608.9, 2200.7, 1373.4),
+        (16.0, 60.0, 57.0, 37.0, 28.0, 85.0, 187.0, 20.0),
+    ),
+}
+
+
+def _to_srf_matrix(responses):
+    """Sparse SRF matrix from dense ``(n_bands, n_wl)`` responses."""
+    responses = np.where(
+        responses >= SRF_THRESHOLD * responses.max(axis=1, keepdims=True),
+        responses,
+        0.0,
+    )
+    total = responses.sum(axis=1, keepdims=True)
+    if np.any(total <= 0):
+        raise ValueError("Some bands are outside of the wavelengths")
+    return scipy.sparse.csr_matrix(responses / total)
+
+
+def gaussian_srf(centres, fwhm, wavelengths=WAVELENGTHS):
+    """SRF matrix of bands with Gaussian responses.
+
+    Parameters
+    ----------
+    centres : array
+        Centre wavelengths of the bands (nm).
+    fwhm : array
+        Full widths at half maximum of the bands (nm).
+    wavelengths : array, optional
+        The wavelengths of the spectra (nm).
+
+    Returns
+    -------
+    A sparse ``(n_bands, n_wl)`` matrix.
+    """
+    centres = np.asarray(centres, dtype=np.float64)[:, None]
+    sigma = np.asarray(fwhm, dtype=np.float64)[:, None] / (
+        2.0 * np.sqrt(2.0 * np.log(2.0))
+    )
+    return _to_srf_matrix(
+        np.exp(-0.5 * ((wavelengths - centres) / sigma) ** 2)
+    )
+
+
+def read_srf(fname, wavelengths=WAVELENGTHS):
+    """Reads the SRFs of a sensor from a text file. The first column has the
+    wavelengths (nm) and the others the response of each band, separated by
+    commas or blanks. If the first line is not numeric, it has the names of
+    the columns. The responses are interpolated to ``wavelengths``.
+
+    Returns
+    -------
+    The names of the bands, their centres (nm) and the sparse SRF matrix.
+    """
+    with open(fname) as fp:
+        header = fp.readline()
+    delimiter = "," if "," in header else None
+    columns = [column.strip() for column in header.split(delimiter)]
+    try:
+        [float(column) for column in columns]
+        skiprows = 0
+        bands = None
+    except ValueError:
+        skiprows = 1
+        bands = tuple(columns[1:])
+    table = np.loadtxt(fname, delimiter=delimiter, skiprows=skiprows, ndmin=2)
+    wavelength, responses = table[:, 0], table[:, 1:].T
+    if bands is None:
+        bands = tuple("B%d" % (i + 1) for i in range(responses.shape[0]))
+    srf = _to_srf_matrix(
+        np.array(
+            [
+                np.interp(wavelengths, wavelength, response, 0.0, 0.0)
+                for response in responses
+            ]
+        )
+    )
+    return bands, srf @ wavelengths, srf
+
+
+@lru_cache(maxsize=32)
+def _load_sensor(sensor, mtime=None):
+    # mtime (of SRF files) is only part of the cache key, so that files
+    # are read again when they are modified
+    if sensor in SENSORS:
+        bands, centres, fwhm = SENSORS[sensor]
+        srf = gaussian_srf(centres, fwhm)
+        centres = np.array(centres)
+        name = sensor
+    elif os.path.exists(sensor):
+        bands, centres, srf = read_srf(sensor)
+        name = os.path.splitext(os.path.basename(sensor))[0]
+    else:
+        raise ValueError(
+            "Unknown sensor %s, use one of %s or an SRF file"
+            % (sensor, ", ".join(SENSORS))
+        )
+    centres.flags.writeable = False
+    return Sensor(name, bands, centres, srf)
+
+
+def get_sensor(sensor):
+    """The :class:`Sensor` called ``sensor``: one of :data:`SENSORS`, or the
+    name of an SRF file (see :func:`read_srf`). The SRF matrices are built
+    once and cached (SRF files are read again if they are modified).
+    :class:`Sensor` instances are returned as they are."""
+    if isinstance(sensor, Sensor):
+        return sensor
+    return _load_sensor(*_sensor_key(sensor))
+
+
+def _sensor_key(sensor):
+    """Cache key of a sensor name: built-in names are case-insensitive, and
+    SRF files are keyed by their path and modification time."""
+    if sensor.lower() in SENSORS:
+        return sensor.lower(), None
+    try:
+        return sensor, os.path.getmtime(sensor)
+    except OSError:
+        return sensor, None
+
+
+def _restrict_srf(srf, grid):
+    """The SRFs restricted to the wavelengths of ``grid``, renormalised."""
+    srf = srf[:, grid.index]
+    total = np.asarray(srf.sum(axis=1)).ravel()
+    if np.any(total <= 0):
+        raise ValueError("Some bands are outside of the wavelengths")
+    return scipy.sparse.csr_matrix(scipy.sparse.diags(1.0 / total) @ srf)
+
+
+@lru_cache(maxsize=64)
+def _grid_srf(sensor, grid):
+    return _restrict_srf(_load_sensor(*sensor).srf, grid)
+
+
+def sensor_grid(sensor):
+    """The :class:`~prosail.spectral_library.WavelengthGrid` of the band
+    centres of ``sensor`` (rounded to the nm), to simulate one wavelength
+    per band instead of the full SRFs."""
+    return get_wavelength_grid(np.round(get_sensor(sensor).centres))
+
+
+def apply_srf(spectra, sensor, wavelengths=None):
+    """Band reflectances of a sensor, as the SRF-weighted mean of the
+    ``spectra`` in each band.
+
+    Parameters
+    ----------
+    spectra : array
+        ``(..., n_wl)`` spectra.
+    sensor : str or Sensor
+        See :func:`get_sensor`.
+    wavelengths : array or WavelengthGrid, optional
+        The wavelengths of ``spectra``, if they are a subset of 400 to 2500
+        nm (see :func:`~prosail.spectral_library.get_wavelength_grid`). The
+        SRFs are then restricted to these wavelengths and renormalised,
+        once per sensor name and grid.
+
+    Returns
+    -------
+    A ``(..., n_bands)`` array.
+    """
+    grid = get_wavelength_grid(wavelengths)
+    if grid.full:
+        srf = get_sensor(sensor).srf
+    elif isinstance(sensor, Sensor):
+        srf = _restrict_srf(sensor.srf, grid)
+    else:
+        # The restricted SRFs of named sensors are cached per grid
+        srf = _grid_srf(_sensor_key(sensor), grid)
+    spectra = np.asarray(spectra)
+    if spectra.shape[-1] != srf.shape[1]:
+        raise ValueError(
+            "The spectra must have %d wavelengths" % srf.shape[1]
+        )
+    flat = spectra.reshape(-1, spectra.shape[-1])
+    bands = np.asarray(srf @ flat.T).T
+    return bands.reshape(spectra.shape[:-1] + (srf.shape[0],))
@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 """Spectral libraries for PROSPECT + SAIL
 """
+import hashlib
+import os
 import pkgutil
+import re
+import tempfile
 from collections import namedtuple
 from io import BytesIO
 
 import numpy as np
 
+try:
+    from functools import lru_cache
+except ImportError:
+    from backports.functools_lru_cache import lru_cache
+
 Spectra = namedtuple("Spectra", "prospect5 prospectd prospectpro soil light")
 Prospect5Spectra = namedtuple("Prospect5Spectra", "nr kab kcar kbrown kw km")
 ProspectDSpectra = namedtuple(
@@ -18,47 +27,364 @@ ProspectPROSpectra = namedtuple(
 SoilSpectra = namedtuple("SoilSpectra", "rsoil1 rsoil2")
 LightSpectra = namedtuple("LightSpectra", "es ed")
 
+# The wavelengths of the spectral tables (nm)
+LIBRARY_WAVELENGTHS = np.arange(400, 2501)
+LIBRARY_WAVELENGTHS.flags.writeable = False
+
+# Leaf constituent (run_prospect argument) that multiplies each of the
+# specific absorption coefficients.
+ABSORPTION_CONSTITUENTS = {
+    "kab": "cab",
+    "kcar": "car",
+    "kbrown": "cbrown",
+    "kw": "cw",
+    "km": "cm",
+    "kant": "ant",
+    "kprot": "prot",
+    "kcbc": "cbc",
+}
+
+# The packaged spectral tables, read through the binary cache
+SPECTRAL_TABLES = (
+    "prospect5_spectra",
+    "prospect_d_spectra",
+    "prospect_pro_spectra",
+    "soil_reflectance",
+    "light_spectra",
+)
+
+
+def get_cache_dir():
+    """Directory where the binary versions of the spectral tables are kept.
+    Set the ``PROSAIL_CACHE_DIR`` environment variable to change it."""
+    cache_dir = os.environ.get("PROSAIL_CACHE_DIR")
+    if cache_dir is None:
+        cache_home = os.environ.get(
+            "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+        )
+        cache_dir = os.path.join(cache_home, "prosail")
+    return cache_dir
 
-def get_spectra():
-    """Reads the spectral information and stores is for future use."""
 
-    # PROSPECT-D
-    prospect_d_spectraf = pkgutil.get_data(
-        "prosail", "prospect_d_spectra.txt"
+def cached_table(raw, name, cache_dir=None):
+    """Returns the ASCII table in ``raw`` as one contiguous, read-only
+    ``(n_columns, n_rows)`` float64 array memory-mapped from a binary
+    ``.npy`` file, so that all the processes on a machine share a single
+    copy of it in the page cache. The binary file is named after the
+    checksum of ``raw``, so it is rebuilt whenever the text file changes;
+    the files of other checksums are left alone (see :func:`clear_cache`).
+    If the cache directory can't be written to, the parsed table is
+    returned instead.
+
+    Parameters
+    ----------
+    raw : bytes
+        Contents of the text file, as read by ``np.loadtxt``.
+    name : str
+        Name of the table, used as a prefix for the binary file.
+    cache_dir : str, optional
+        Where to store the binary file. Defaults to :func:`get_cache_dir`.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    checksum = hashlib.sha1(raw).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, "%s-%s.npy" % (name, checksum))
+    try:
+        return np.asarray(np.load(cache_file, mmap_mode="r"))
+    except (IOError, OSError, ValueError):
+        pass
+
+    table = np.ascontiguousarray(
+        np.loadtxt(BytesIO(raw), unpack=True, ndmin=2)
     )
-    _, nr, kab, kcar, kant, kbrown, kw, km = np.loadtxt(
-        BytesIO(prospect_d_spectraf), unpack=True
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file and rename it, so that concurrent
+        # processes never see a half-written cache.
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    except (IOError, OSError):
+        table.flags.writeable = False
+        return table
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            np.save(fp, table)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        table.flags.writeable = False
+        return table
+    return np.asarray(np.load(cache_file, mmap_mode="r"))
+
+
+def clear_cache(name=None, cache_dir=None):
+    """Removes the binary tables written by :func:`cached_table`. Tables of
+    other checksums are never removed automatically, since several
+    installations may share the cache directory; they are rebuilt the next
+    time they are needed.
+
+    Only the ``<name>-<checksum>.npy`` files are removed, so that other
+    files in the directory are left alone.
+
+    Parameters
+    ----------
+    name : str, optional
+        Only remove the binary files of this table. Defaults to all the
+        packaged tables (``SPECTRAL_TABLES``).
+    cache_dir : str, optional
+        The cache directory. Defaults to :func:`get_cache_dir`.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    names = SPECTRAL_TABLES if name is None else (name,)
+    pattern = re.compile(
+        r"(%s)-[0-9a-f]{16}\.npy$" % "|".join(map(re.escape, names))
     )
-    prospect_d_spectra = ProspectDSpectra(nr, kab, kcar, kbrown, kw, km, kant)
-    # PROSPECT-PRO
-    prospect_pro_spectraf = pkgutil.get_data(
-        "prosail", "prospect_pro_spectra.txt"
+    try:
+        fnames = os.listdir(cache_dir)
+    except OSError:
+        return
+    for fname in fnames:
+        if pattern.match(fname):
+            try:
+                os.remove(os.path.join(cache_dir, fname))
+            except OSError:
+                pass
+
+
+def read_table(fname):
+    """Reads one of the packaged spectral tables through the binary cache
+    (see :func:`cached_table`)."""
+    raw = pkgutil.get_data("prosail", fname)
+    return cached_table(raw, os.path.splitext(fname)[0])
+
+
+def get_prospect5_spectra():
+    """Reads the PROSPECT-5 refractive index and absorption coefficients."""
+    nr, kab, kcar, kbrown, kw, km = read_table("prospect5_spectra.txt")
+    return Prospect5Spectra(nr, kab, kcar, kbrown, kw, km)
+
+
+def get_prospectd_spectra():
+    """Reads the PROSPECT-D refractive index and absorption coefficients."""
+    _, nr, kab, kcar, kant, kbrown, kw, km = read_table(
+        "prospect_d_spectra.txt"
     )
-    _, nr, kab, kcar, kant, kbrown, kw, km, kprot, kcbc = np.loadtxt(
-        BytesIO(prospect_pro_spectraf), unpack=True
+    return ProspectDSpectra(nr, kab, kcar, kbrown, kw, km, kant)
+
+
+def get_prospectpro_spectra():
+    """Reads the PROSPECT-PRO refractive index and absorption coefficients."""
+    _, nr, kab, kcar, kant, kbrown, kw, km, kprot, kcbc = read_table(
+        "prospect_pro_spectra.txt"
     )
-    prospect_pro_spectra = ProspectPROSpectra(
+    return ProspectPROSpectra(
         nr, kab, kcar, kbrown, kw, km, kant, kprot, kcbc
     )
-    # PROSPECT 5
-    prospect_5_spectraf = pkgutil.get_data("prosail", "prospect5_spectra.txt")
-    nr, kab, kcar, kbrown, kw, km = np.loadtxt(
-        BytesIO(prospect_5_spectraf), unpack=True
-    )
-    prospect_5_spectra = Prospect5Spectra(nr, kab, kcar, kbrown, kw, km)
-    # SOIL
-    soil_spectraf = pkgutil.get_data("prosail", "soil_reflectance.txt")
-    rsoil1, rsoil2 = np.loadtxt(BytesIO(soil_spectraf), unpack=True)
-    soil_spectra = SoilSpectra(rsoil1, rsoil2)
-    # LIGHT
-    light_spectraf = pkgutil.get_data("prosail", "light_spectra.txt")
-    es, ed = np.loadtxt(BytesIO(light_spectraf), unpack=True)
-    light_spectra = LightSpectra(es, ed)
-    spectra = Spectra(
-        prospect_5_spectra,
-        prospect_d_spectra,
-        prospect_pro_spectra,
-        soil_spectra,
-        light_spectra,
+
+
+def get_soil_spectra():
+    """Reads the default dry and wet soil spectra."""
+    rsoil1, rsoil2 = read_table("soil_reflectance.txt")
+    return SoilSpectra(rsoil1, rsoil2)
+
+
+def get_light_spectra():
+    """Reads the direct and diffuse illumination spectra."""
+    es, ed = read_table("light_spectra.txt")
+    return LightSpectra(es, ed)
+
+
+_SPECTRA_LOADERS = {
+    "prospect5": get_prospect5_spectra,
+    "prospectd": get_prospectd_spectra,
+    "prospectpro": get_prospectpro_spectra,
+    "soil": get_soil_spectra,
+    "light": get_light_spectra,
+}
+
+
+def absorption_matrix(spectra):
+    """Stacks the specific absorption coefficients of a PROSPECT version
+    (e.g. ``spectral_lib.prospectd``) into one ``(n_constituents, n_wl)``
+    matrix, so that the absorption of many leaves is a single matrix
+    product with an ``(n_samples, n_constituents)`` concentration matrix.
+
+    Returns
+    -------
+    kmat: array
+        The absorption coefficients, in the order of the fields of
+        ``spectra`` (i.e. skipping ``nr``).
+    constituents: tuple
+        The names of the leaf constituents for each row of ``kmat``.
+    """
+    fields = [field for field in spectra._fields if field != "nr"]
+    kmat = np.vstack([getattr(spectra, field) for field in fields])
+    constituents = tuple(ABSORPTION_CONSTITUENTS[field] for field in fields)
+    return kmat, constituents
+
+
+def get_spectra():
+    """Reads the spectral information and stores is for future use."""
+    return Spectra(*[_SPECTRA_LOADERS[field]() for field in Spectra._fields])
+
+
+class LazySpectra(object):
+    """Drop-in replacement for the :class:`Spectra` tuple returned by
+    :func:`get_spectra`, where each of the sub-libraries (``prospect5``,
+    ``prospectd``, ``prospectpro``, ``soil`` and ``light``) is only read
+    from disk the first time it is accessed, and kept afterwards."""
+
+    _fields = Spectra._fields
+
+    def __getattr__(self, name):
+        try:
+            loader = _SPECTRA_LOADERS[name]
+        except KeyError:
+            raise AttributeError(
+                "'%s' object has no attribute '%s'"
+                % (type(self).__name__, name)
+            )
+        spectra = loader()
+        setattr(self, name, spectra)
+        return spectra
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        for field in self._fields:
+            yield getattr(self, field)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return tuple(getattr(self, field) for field in self._fields[key])
+        return getattr(self, self._fields[key])
+
+    def _asdict(self):
+        return {field: getattr(self, field) for field in self._fields}
+
+    def __dir__(self):
+        return sorted(set(object.__dir__(self)) | set(self._fields))
+
+    def __repr__(self):
+        loaded = [field for field in self._fields if field in self.__dict__]
+        return "%s(loaded=%s)" % (type(self).__name__, loaded)
+
+
+class WavelengthGrid(object):
+    """A subset of the wavelengths of the spectral library, e.g. the band
+    centres of a sensor or a coarser regular grid. The models only compute
+    the wavelengths of the grid: :meth:`spectra` gives the spectral tables
+    sliced to the grid, which are sliced once and kept. Grids with the same
+    wavelengths compare (and hash) equal.
+
+    Parameters
+    ----------
+    wavelengths : array, optional
+        Wavelengths of the grid [nm], integers between 400 and 2500. By
+        default, all of them.
+    """
+
+    def __init__(self, wavelengths=None):
+        if wavelengths is None:
+            wavelengths = LIBRARY_WAVELENGTHS
+        wavelengths = np.atleast_1d(wavelengths)
+        index = np.round(wavelengths).astype(np.int64) - LIBRARY_WAVELENGTHS[0]
+        if (
+            wavelengths.ndim != 1
+            or np.any(index != wavelengths - LIBRARY_WAVELENGTHS[0])
+            or np.any(index < 0)
+            or np.any(index >= LIBRARY_WAVELENGTHS.size)
+        ):
+            raise ValueError(
+                "The wavelengths must be integers between 400 and 2500 nm"
+            )
+        self.index = index
+        self.index.flags.writeable = False
+        self.wavelengths = LIBRARY_WAVELENGTHS[index]
+        self.full = np.array_equal(self.wavelengths, LIBRARY_WAVELENGTHS)
+        self._spectra = {}
+
+    @classmethod
+    def regular(cls, step, start=400, stop=2500):
+        """Grid from ``start`` to ``stop`` nm, every ``step`` nm."""
+        return cls(np.arange(start, stop + 1, step))
+
+    def __len__(self):
+        return self.wavelengths.size
+
+    def __eq__(self, other):
+        return isinstance(other, WavelengthGrid) and np.array_equal(
+            self.wavelengths, other.wavelengths
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.wavelengths.tobytes())
+
+    def __repr__(self):
+        if self.full:
+            return "WavelengthGrid(400-2500 nm)"
+        return "WavelengthGrid(%d wavelengths, %g-%g nm)" % (
+            len(self),
+            self.wavelengths[0],
+            self.wavelengths[-1],
+        )
+
+    def take(self, spectrum):
+        """Slices a spectrum of the library wavelengths (along its last
+        axis) to the grid. Spectra that are already on the grid (and
+        scalars) are returned as they are."""
+        spectrum = np.asarray(spectrum)
+        if spectrum.ndim == 0 or spectrum.shape[-1:] == (len(self),):
+            return spectrum
+        if spectrum.shape[-1:] != LIBRARY_WAVELENGTHS.shape:
+            raise ValueError(
+                "Spectra must have %d or %d elements"
+                % (len(self), LIBRARY_WAVELENGTHS.size)
+            )
+        return spectrum[..., self.index]
+
+    def spectra(self, name):
+        """One of the sub-libraries of ``spectral_lib`` (e.g. "prospectd"
+        or "soil"), with all its spectra sliced to the grid."""
+        from prosail import spectral_lib
+
+        if self.full:
+            return getattr(spectral_lib, name)
+        try:
+            return self._spectra[name]
+        except KeyError:
+            pass
+        library = getattr(spectral_lib, name)
+        sliced = type(library)(
+            *[np.ascontiguousarray(self.take(field)) for field in library]
+        )
+        for field in sliced:
+            field.flags.writeable = False
+        self._spectra[name] = sliced
+        return sliced
+
+
+@lru_cache(maxsize=64)
+def _grid_from_bytes(wavelengths):
+    return WavelengthGrid(np.frombuffer(wavelengths, dtype=np.float64))
+
+
+def get_wavelength_grid(wavelengths=None):
+    """The :class:`WavelengthGrid` of ``wavelengths``: ``None`` (all the
+    library wavelengths), an array of wavelengths [nm], or a grid. Grids
+    are cached, so that passing the same wavelengths to many model runs
+    only slices the spectral tables once."""
+    if isinstance(wavelengths, WavelengthGrid):
+        return wavelengths
+    if wavelengths is None:
+        wavelengths = LIBRARY_WAVELENGTHS
+    return _grid_from_bytes(
+        np.ascontiguousarray(wavelengths, dtype=np.float64).tobytes()
     )
-    return spectra
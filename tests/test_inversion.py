@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from prosail.inversion import LUTIndex
+from prosail.lut import (
+    generate_lut,
+    parameter_table,
+    run_lut_chunk,
+    sample_parameters,
+)
+
+from test_lut import SPEC
+
+BANDS = [443, 490, 560, 665, 705, 740, 783, 842, 865, 1610, 2190]
+
+
+def test_lut_index_query():
+    params = parameter_table(sample_parameters(SPEC, 300, seed=3))
+    spectra = run_lut_chunk(params)
+    index = LUTIndex(spectra, params, bands=BANDS)
+    rng = np.random.default_rng(0)
+    observed = spectra[:40] + rng.normal(0.0, 0.01, (40, spectra.shape[1]))
+    distances, indices = index.query(observed, k=5, block_size=16,
+                                     entry_block_size=64)
+    x = observed[:, np.array(BANDS) - 400]
+    y = spectra[:, np.array(BANDS) - 400]
+    expected = np.sqrt(((x[:, None] - y[None]) ** 2).sum(axis=-1))
+    assert np.array_equal(indices, np.argsort(expected, axis=1)[:, :5])
+    assert np.allclose(
+        distances, np.sort(expected, axis=1)[:, :5], rtol=0, atol=1e-4
+    )
+    # Only the bands of the index can be passed too
+    assert np.array_equal(index.query(x, k=5)[1], indices)
+
+    estimates = index.estimate(spectra[:40], k=1)
+    assert np.allclose(estimates["lai"], params["lai"][:40])
+    estimates = index.estimate(observed, k=5, statistic="median",
+                               parameters=["cab"])
+    assert list(estimates) == ["cab"]
+    assert np.array_equal(
+        estimates["cab"], np.median(params["cab"][indices], axis=1)
+    )
+    with pytest.raises(ValueError):
+        index.estimate(observed, statistic="mode")
+    with pytest.raises(ValueError):
+        LUTIndex(spectra, params, bands=[400.5])
+
+
+def test_lut_index_pca(tmpdir):
+    params = sample_parameters(SPEC, 200, seed=4)
+    lut = generate_lut(params, str(tmpdir.join("lut")), n_workers=1)
+    full = LUTIndex.from_lut(lut, bands=BANDS)
+    pca = LUTIndex.from_lut(lut, bands=BANDS, n_components=len(BANDS),
+                            block_size=64)
+    spectra = np.asarray(lut.spectra[:20])
+    distances, indices = pca.query(spectra, k=3)
+    assert np.array_equal(indices, full.query(spectra, k=3)[1])
+    assert np.allclose(
+        distances, full.query(spectra, k=3)[0], rtol=0, atol=1e-3
+    )
+    reduced = LUTIndex.from_lut(lut, bands=BANDS, n_components=3)
+    assert reduced.features.shape == (200, 3)
+    assert np.all(np.diff(reduced.explained_variance) <= 0)
+
+
+def test_lut_index_sensor_bands():
+    from prosail.sensors import get_sensor
+
+    params = parameter_table(sample_parameters(SPEC, 50, seed=5))
+    spectra = run_lut_chunk(params, sensor="landsat8")
+    centres = get_sensor("landsat8").centres
+    # The band centres of the sensor are not sorted
+    assert np.any(np.diff(centres) < 0)
+    index = LUTIndex(spectra, params, wavelengths=centres,
+                     bands=[2200.7, 1373.4])
+    assert np.array_equal(index.bands, [2200.7, 1373.4])
+    assert np.array_equal(index.query(spectra[:5], k=1)[1][:, 0],
+                          np.arange(5))
+    with pytest.raises(ValueError):
+        LUTIndex(spectra, params, wavelengths=centres, bands=[1000.0])
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+import prosail
+from prosail.FourSAIL import leaf_angle_quadrature, lidf_table
+from prosail.lut import (
+    LookupTable,
+    generate_lut,
+    open_lut,
+    parameter_table,
+    run_lut_chunk,
+    sample_parameters,
+)
+from prosail.sail_model import run_progeosail
+
+SPEC = dict(
+    n=(1.0, 2.5),
+    cab=(10.0, 80.0),
+    car=(2.0, 15.0),
+    cbrown=0.0,
+    cw=(0.005, 0.03),
+    cm=(0.005, 0.015),
+    lai=(0.0, 6.0),
+    lidfa=(30.0, 70.0),
+    hspot=0.01,
+    tts=30.0,
+    tto=(0.0, 40.0),
+    psi=(0.0, 180.0),
+    rsoil=(0.5, 1.5),
+    psoil=(0.0, 1.0),
+)
+NAMES = ["n", "cab", "car", "cbrown", "cw", "cm", "lai", "lidfa", "hspot",
+         "tts", "tto", "psi"]
+
+
+def test_lut_chunk_matches_models():
+    params = sample_parameters(SPEC, 20, seed=1)
+    params["lai"][:2] = [0.0, -1.0]
+    table = parameter_table(params)
+    spectra = run_lut_chunk(table, factor="HDR", block_size=8)
+    for i in range(20):
+        expected = prosail.run_prosail(
+            *[table[name][i] for name in NAMES],
+            rsoil=table["rsoil"][i],
+            psoil=table["psoil"][i],
+            factor="HDR"
+        )
+        assert np.allclose(spectra[i], expected, rtol=0, atol=1e-7)
+
+    params["chw"] = np.linspace(0.2, 3.0, 20)
+    params["ccover"] = np.linspace(0.05, 0.95, 20)
+    table = parameter_table(params, model="progeosail")
+    spectra = run_lut_chunk(table, model="progeosail", cshp="cylinder")
+    for i in range(20):
+        expected, _ = run_progeosail(
+            table["chw"][i],
+            table["ccover"][i],
+            "cylinder",
+            *[table[name][i] for name in NAMES],
+            rsoil=table["rsoil"][i],
+            psoil=table["psoil"][i]
+        )
+        assert np.allclose(spectra[i], expected, rtol=0, atol=1e-7)
+
+    with pytest.raises(ValueError):
+        parameter_table(dict(params, cabb=1.0))
+    del params["cab"]
+    with pytest.raises(ValueError):
+        parameter_table(params)
+
+
+def test_generate_lut(tmpdir):
+    params = sample_parameters(SPEC, 50, seed=2)
+    path = str(tmpdir.join("lut"))
+    lut = generate_lut(params, path, chunk_size=16, n_workers=2)
+    assert lut.complete and len(lut) == 50
+    assert isinstance(lut.spectra, np.memmap)
+    assert lut.spectra.dtype == np.float32
+    assert lut.spectra.shape == (50, 2101)
+    assert np.array_equal(lut.wavelengths, np.arange(400, 2501))
+    assert lut.metadata["factor"] == "SDR"
+    assert lut.metadata["quadrature"] == ["midpoint", 18]
+    assert np.array_equal(lut.parameter("cab"), params["cab"])
+    expected = run_lut_chunk(parameter_table(params)).astype(np.float32)
+    assert np.array_equal(lut.spectra, expected)
+    blocks = list(lut.blocks(20))
+    assert [rows for rows, _, _ in blocks] == [
+        slice(0, 20), slice(20, 40), slice(40, 50)
+    ]
+    assert np.array_equal(np.concatenate([b[2] for b in blocks]), expected)
+
+    # Only the unfinished chunks are simulated again
+    lut = open_lut(path, mode="r+")
+    lut.spectra[:] = 0.0
+    lut.progress[-1] = False
+    del lut
+    lut = generate_lut(params, path, chunk_size=16, n_workers=1)
+    assert np.all(lut.spectra[:48] == 0.0)
+    assert np.array_equal(lut.spectra[48:], expected[48:])
+    assert isinstance(LookupTable(path).params, np.memmap)
+    # A different LUT in the same place is an error
+    with pytest.raises(ValueError):
+        generate_lut(params, path, chunk_size=16, factor="BHR")
+    # Including one with another default quadrature
+    default = lidf_table.quadrature
+    lidf_table.quadrature = leaf_angle_quadrature(6, "gauss")
+    try:
+        with pytest.raises(ValueError):
+            generate_lut(params, path, chunk_size=16)
+    finally:
+        lidf_table.quadrature = default
+
+
+def test_sensor_lut(tmpdir):
+    from prosail.sensors import apply_srf, get_sensor
+
+    params = sample_parameters(SPEC, 30, seed=5)
+    lut = generate_lut(params, str(tmpdir.join("lut")), n_workers=1,
+                       sensor="landsat8")
+    assert lut.spectra.shape == (30, 8)
+    assert lut.metadata["sensor"] == "landsat8"
+    assert np.array_equal(lut.wavelengths, get_sensor("landsat8").centres)
+    expected = apply_srf(run_lut_chunk(parameter_table(params)), "landsat8")
+    assert np.allclose(lut.spectra, expected, rtol=1e-6, atol=0)
@@ -1,6 +1,7 @@
 import numpy as np
 import os
 import prosail
+import pytest
 from pytest import fixture
 from distutils import dir_util
 
@@ -124,3 +125,529 @@ def test_rsdt_prosail5(datadir):
         factor="DHR",
     )
     assert np.allclose(rsdt, rr, atol=0.01)
+
+
+def test_foursail_batch_matches_loop():
+    from prosail.FourSAIL import foursail, foursail_batch
+
+    w, refl, trans = prosail.run_prospect(
+        np.array([1.5, 1.5, 2.0, 1.2]),
+        np.array([40.0, 40.0, 20.0, 60.0]),
+        8.0,
+        0.0,
+        0.01,
+        0.009,
+    )
+    rsoil = prosail.spectral_lib.soil.rsoil1
+    lidfa = np.array([-0.35, 57.0, 30.0, 57.0])
+    lidfb = np.array([-0.15, 0.0, 0.0, 0.0])
+    lidftype = np.array([1, 2, 2, 2])
+    lai = np.array([3.0, 2.0, 0.0, 1.0])
+    hotspot = np.array([0.01, 0.2, 0.1, 0.0])
+    tts = np.array([30.0, 40.0, 20.0, 35.0])
+    tto = np.array([10.0, 20.0, 0.0, 5.0])
+    psi = np.array([0.0, 90.0, 0.0, 120.0])
+    batch = foursail_batch(
+        refl, trans, lidfa, lidfb, lidftype, lai, hotspot, tts, tto, psi,
+        rsoil,
+    )
+    assert len(batch) == 21
+    for i in range(4):
+        single = foursail(
+            refl[i], trans[i], lidfa[i], lidfb[i], lidftype[i], lai[i],
+            hotspot[i], tts[i], tto[i], psi[i], rsoil,
+        )
+        for term_batch, term in zip(batch, single):
+            assert term_batch.shape == (4, 2101)
+            assert np.allclose(term_batch[i], term, rtol=0, atol=1e-12)
+
+
+def test_foursail_fused_matches_foursail():
+    from prosail.FourSAIL import foursail, foursail_fused
+
+    w, refl, trans = prosail.run_prospect(1.5, 40.0, 8.0, 0.0, 0.01, 0.009)
+    rsoil = prosail.spectral_lib.soil.rsoil1
+    out = np.empty((21, 2101))
+    for lidfa, lidfb, lidftype, lai, hotspot, tts, tto, psi in [
+        (-0.35, -0.15, 1, 3.0, 0.01, 30.0, 10.0, 0.0),
+        (57.0, 0.0, 2, 2.0, 0.2, 40.0, 20.0, 90.0),
+        (57.0, 0.0, 2, 1.0, 0.1, 30.0, 30.0, 0.0),
+        (57.0, 0.0, 2, 0.0, 0.1, 30.0, 30.0, 0.0),
+    ]:
+        expected = foursail(
+            refl, trans, lidfa, lidfb, lidftype, lai, hotspot, tts, tto,
+            psi, rsoil,
+        )
+        fused = foursail_fused(
+            refl, trans, lidfa, lidfb, lidftype, lai, hotspot, tts, tto,
+            psi, rsoil, out=out,
+        )
+        for term_fused, term in zip(fused, expected):
+            assert np.allclose(term_fused, term, rtol=0, atol=1e-10)
+    args = (refl, trans, 57.0, 0.0, 2, 2.0, 0.2, 40.0, 20.0, 90.0, rsoil)
+    for bad in [np.empty((21, 2100)), np.empty((21, 2101), np.float32),
+                np.empty((2101, 21)).T, np.empty((42, 2101))[::2]]:
+        with pytest.raises(ValueError):
+            foursail_fused(*args, out=bad)
+
+
+def test_geometry_cache():
+    from prosail.FourSAIL import GeometryCache, geometric_coefficients
+
+    cache = GeometryCache(maxsize=2)
+    first = cache(2, 57.0, 0.0, 30.0, 10.0, 0.0)
+    assert first == geometric_coefficients(2, 57.0, 0.0, 30.0, 10.0, 0.0)
+    assert cache(2, 57.0, 0.3, 30.0, 10.0, 0.0) is first
+    cache(1, -0.35, -0.15, 30.0, 10.0, 0.0)
+    cache(2, 57.0, 0.0, 30.0, 10.0, 0.0)
+    cache(2, 45.0, 0.0, 30.0, 10.0, 0.0)
+    info = cache.info()
+    assert (info.hits, info.misses, info.evictions) == (2, 3, 1)
+    assert info.currsize == 2
+    # LRU: the bimodal LIDF was evicted, the Campbell one wasn't
+    cache(2, 57.0, 0.0, 30.0, 10.0, 0.0)
+    assert cache.info().hits == 3
+    cache.configure(maxsize=1, policy="fifo")
+    assert cache.info().currsize == 1
+    assert cache.info().evictions == 2
+    cache.clear()
+    assert cache.info()[:5] == (0, 0, 0, 1, 0)
+    with pytest.raises(ValueError, match=r"1 \(bimodal\) or 2"):
+        geometric_coefficients(3, 57.0, 0.0, 30.0, 10.0, 0.0)
+
+
+def test_multiview_matches_single_views():
+    w, refl, trans = prosail.run_prospect(1.5, 40.0, 8.0, 0.0, 0.01, 0.009)
+    tto = np.array([0.0, 10.0, 30.0, 60.0])
+    psi = np.array([0.0, 90.0, 180.0, 30.0])
+    sdr, bhr, dhr, hdr = prosail.run_sail(
+        refl, trans, 2.0, 57.0, 0.1, 30.0, tto, psi, rsoil=1.0, psoil=0.5,
+        factor="ALL",
+    )
+    assert sdr.shape == (4, 2101)
+    for i in range(4):
+        sdr_i, bhr_i, dhr_i, hdr_i = prosail.run_sail(
+            refl, trans, 2.0, 57.0, 0.1, 30.0, tto[i], psi[i], rsoil=1.0,
+            psoil=0.5, factor="ALL",
+        )
+        assert np.allclose(sdr[i], sdr_i, rtol=0, atol=1e-12)
+        assert np.allclose(hdr[i], hdr_i, rtol=0, atol=1e-12)
+        assert np.allclose(bhr[i], bhr_i, rtol=0, atol=1e-12)
+
+
+def test_multilai_matches_single_lai():
+    w, refl, trans = prosail.run_prospect(1.5, 40.0, 8.0, 0.0, 0.01, 0.009)
+    lai = np.array([0.0, 0.5, 2.0, 6.0])
+    sdr, bhr, dhr, hdr = prosail.run_sail(
+        refl, trans, lai, 57.0, 0.1, 30.0, 10.0, 90.0, rsoil=1.0, psoil=0.5,
+        factor="ALL",
+    )
+    assert sdr.shape == (4, 2101)
+    for i in range(4):
+        sdr_i, bhr_i, dhr_i, hdr_i = prosail.run_sail(
+            refl, trans, lai[i], 57.0, 0.1, 30.0, 10.0, 90.0, rsoil=1.0,
+            psoil=0.5, factor="ALL",
+        )
+        assert np.allclose(sdr[i], sdr_i, rtol=0, atol=1e-12)
+        assert np.allclose(hdr[i], hdr_i, rtol=0, atol=1e-12)
+        assert np.allclose(bhr[i], bhr_i, rtol=0, atol=1e-12)
+        assert np.allclose(dhr[i], dhr_i, rtol=0, atol=1e-12)
+    with pytest.raises(ValueError):
+        prosail.run_sail(
+            refl, trans, lai, 57.0, 0.1, 30.0, np.array([0.0, 10.0]), 0.0,
+            rsoil=1.0, psoil=0.5,
+        )
+
+
+def test_foursail_outputs():
+    from prosail.FourSAIL import SAIL_TERMS, foursail
+
+    w, refl, trans = prosail.run_prospect(1.5, 40.0, 8.0, 0.0, 0.01, 0.009)
+    rsoil = prosail.spectral_lib.soil.rsoil1
+    args = (refl, trans, -0.35, -0.15, 1, 3.0, 0.01, 30.0, 10.0, 0.0, rsoil)
+    full = foursail(*args)
+    for i, name in enumerate(SAIL_TERMS):
+        terms = foursail(*args, outputs=[name])
+        assert np.array_equal(terms[i], full[i])
+        assert sum(term is not None for term in terms) == 1
+    with pytest.raises(ValueError):
+        foursail(*args, outputs=["rsot", "sdr"])
+
+
+def test_sail_result_buffer():
+    from prosail.FourSAIL import SAIL_TERMS, SailResult, foursail
+
+    w, refl, trans = prosail.run_prospect(1.5, 40.0, 8.0, 0.0, 0.01, 0.009)
+    rsoil = prosail.spectral_lib.soil.rsoil1
+    out = np.empty((21, 2101))
+    for lai in [3.0, 0.0]:
+        args = (refl, trans, 57.0, 0.0, 2, lai, 0.01, 30.0, 10.0, 0.0, rsoil)
+        result = foursail(*args, out=out)
+        assert isinstance(result, SailResult)
+        assert result.data is out
+        assert result.shape == (2101,)
+        assert len(list(result)) == len(SAIL_TERMS)
+        for i, name in enumerate(SAIL_TERMS):
+            assert result[name].shape == (2101,)
+            assert np.shares_memory(getattr(result, name), out)
+            assert np.array_equal(result[i], result.as_dict()[name])
+    assert np.array_equal(result.rsot, rsoil)
+    assert np.all(result.tss == 1.0)
+    # Slices behave as on the list of terms
+    assert len(result[:3]) == 3
+    for term, expected in zip(result[:3], list(result)[:3]):
+        assert np.array_equal(term, expected)
+    assert [term is None for term in result[-2:]] == [False, False]
+    partial = foursail(*args, outputs=["rdot"])
+    assert partial[::-1][0] is None
+    with pytest.raises(ValueError):
+        foursail(*args, out=np.empty((21, 10)))
+    allall = prosail.run_sail(
+        refl, trans, 3.0, 57.0, 0.01, 30.0, 10.0, 0.0, rsoil0=rsoil,
+        factor="ALLALL",
+    )
+    assert np.array_equal(
+        allall.rsot,
+        prosail.run_sail(
+            refl, trans, 3.0, 57.0, 0.01, 30.0, 10.0, 0.0, rsoil0=rsoil
+        ),
+    )
+
+
+def test_progeosail_two_stages():
+    from prosail.sail_model import (
+        _crown_optics, mix_crowns, run_crown_optics, run_progeosail,
+    )
+
+    params = (1.5, 40.0, 8.0, 0.0, 0.01, 0.009, 2.0, 57.0, 0.1, 30.0, 10.0, 0.0)
+    rsoil0 = prosail.spectral_lib.soil.rsoil1
+    chw = np.array([0.5, 1.0, 2.0])[:, None]
+    ccover = np.array([0.2, 0.5, 0.8, 0.95])
+    _crown_optics.cache_clear()
+    optics = run_crown_optics(*params)
+    for cshp in ["cone", "cylinder"]:
+        rsc, gsfr = mix_crowns(optics, chw, ccover, cshp, rsoil0)
+        assert rsc.shape == (3, 4, 2101)
+        for i, j in np.ndindex(3, 4):
+            expected, _ = run_progeosail(
+                chw[i, 0], ccover[j], cshp, *params, rsoil0=rsoil0
+            )
+            assert np.array_equal(rsc[i, j], expected)
+    assert _crown_optics.cache_info().misses == 1
+    shapes = np.array(["cone", "Cylinder"])[:, None, None]
+    rsc, gsfr = mix_crowns(optics, chw, ccover, shapes, rsoil0)
+    assert rsc.shape == (2, 3, 4, 2101)
+    with pytest.raises(ValueError):
+        mix_crowns(optics, chw, ccover, "sphere", rsoil0)
+
+
+def test_vectorized_crown_mixing():
+    from prosail.sail_model import geocone, geocyli
+
+    rng = np.random.default_rng(42)
+    n_samples = 50
+    chw = rng.uniform(0.0, 3.0, n_samples)
+    ccover = rng.uniform(0.0, 1.0, n_samples)
+    tts = rng.uniform(0.0, 80.0, n_samples)
+    tts[:2] = 0.0
+    rc, tc, rch, rsoil0 = rng.uniform(0.0, 0.5, (4, n_samples, 7))
+    for mixer in [geocone, geocyli]:
+        rsc, gsfr = mixer(chw, ccover, tts, rc, tc, rch, rsoil0)
+        assert rsc.shape == (n_samples, 7)
+        assert np.all(np.isfinite(rsc))
+        for i in range(n_samples):
+            expected, _ = mixer(
+                chw[i], ccover[i], tts[i], rc[i], tc[i], rch[i], rsoil0[i]
+            )
+            assert np.allclose(rsc[i], expected, rtol=0, atol=1e-14)
+        # Geometry only, shared spectra
+        rsc, gsfr = mixer(chw, ccover, tts, rc[0], tc[0], rch[0], rsoil0[0])
+        assert rsc.shape == (n_samples, 7)
+
+
+def test_thermal_sail_broadcasting():
+    tto = np.array([0.0, 20.0, 45.0, 70.0])
+    psi = np.array([0.0, 0.0, 180.0, 180.0])
+    tveg = np.array([290.0, 300.0, 310.0])[:, None]
+    kwargs = dict(emv=0.98, ems=0.94, typelidf=1, lidfb=0.0)
+    Lw, Tbright, dir_em = prosail.run_thermal_sail(
+        9.5, tveg, 315.0, tveg + 9.0, 331.0, 259.0, 2.0, -1.0, 0.05, 24.2,
+        tto, psi, **kwargs
+    )
+    assert Lw.shape == Tbright.shape == (3, 4)
+    assert dir_em.shape == (4,)
+    for i, j in np.ndindex(3, 4):
+        expected = prosail.run_thermal_sail(
+            9.5, tveg[i, 0], 315.0, tveg[i, 0] + 9.0, 331.0, 259.0, 2.0,
+            -1.0, 0.05, 24.2, tto[j], psi[j], **kwargs
+        )
+        assert np.isclose(Lw[i, j], expected[0], rtol=1e-12, atol=0)
+        assert np.isclose(Tbright[i, j], expected[1], rtol=1e-12, atol=0)
+        assert np.isclose(dir_em[j], expected[2], rtol=1e-12, atol=0)
+    lam = np.array([8.0, 9.5, 11.0])
+    Lw, Tbright, dir_em = prosail.run_thermal_sail(
+        lam, tveg[:, :, None], 315.0, 319.0, 331.0, 259.0, 2.0, -1.0, 0.05,
+        24.2, tto, psi, **kwargs
+    )
+    assert Tbright.shape == (3, 4, 3)
+    assert dir_em.shape == (4, 3)
+
+
+def test_sensor_bands(tmpdir):
+    from prosail.sensors import apply_srf, get_sensor, gaussian_srf
+
+    sensor = get_sensor("sentinel2a")
+    assert get_sensor("Sentinel2A") is sensor
+    assert sensor.srf.shape == (13, 2101)
+    assert np.allclose(sensor.srf.sum(axis=1), 1.0)
+    assert np.allclose(sensor.srf @ np.arange(400, 2501), sensor.centres,
+                       atol=0.5)
+
+    args = (2.1, 40.0, 10.0, 0.1, 0.015, 0.009, 3.0, -0.35, 0.01, 30.0,
+            np.array([0.0, 10.0]), 0.0)
+    rho = prosail.run_prosail(*args, typelidf=1, rsoil=1.0, psoil=1.0)
+    bands = prosail.run_prosail(*args, typelidf=1, rsoil=1.0, psoil=1.0,
+                                sensor="sentinel2a")
+    assert bands.shape == (2, 13)
+    assert np.allclose(bands, np.asarray(sensor.srf @ rho.T).T)
+    result = prosail.run_prosail(*args, typelidf=1, rsoil=1.0, psoil=1.0,
+                                 factor="ALLALL", sensor="sentinel2a")
+    assert np.allclose(result.rsot, bands)
+
+    # SRFs from a file, on a coarser grid than the models
+    fname = str(tmpdir.join("sensor.csv"))
+    wavelength = np.arange(400, 2501, 5.0)
+    responses = np.exp(
+        -0.5 * ((wavelength - np.array([[560.0], [865.0]])) / 10.0) ** 2
+    )
+    np.savetxt(fname, np.column_stack([wavelength, responses.T]),
+               delimiter=",", header="wavelength,green,nir", comments="")
+    sensor = get_sensor(fname)
+    assert sensor.bands == ("green", "nir")
+    assert np.allclose(sensor.centres, [560.0, 865.0])
+    assert np.allclose(
+        apply_srf(rho, fname),
+        apply_srf(rho, sensor._replace(
+            srf=gaussian_srf([560.0, 865.0], [23.548, 23.548]))),
+        atol=2e-4,
+    )
+    # Modified SRF files are read again
+    np.savetxt(fname, np.column_stack([wavelength, responses[:1].T]),
+               delimiter=",", header="wavelength,green", comments="")
+    os.utime(fname, (0, os.path.getmtime(fname) + 10))
+    assert get_sensor(fname).bands == ("green",)
+    with pytest.raises(ValueError):
+        get_sensor("sentinel3")
+
+    # The crown reflectance of ProGeoSAIL in the bands of a sensor
+    from prosail.sail_model import run_progeosail
+
+    crowns = (0.5, 0.4, "cone") + args[:10] + (0.0, 0.0)
+    rsc, gsfr = run_progeosail(*crowns, rsoil=1.0, psoil=1.0)
+    rsc_bands, gsfr_bands = run_progeosail(*crowns, rsoil=1.0, psoil=1.0,
+                                           sensor="sentinel2a")
+    assert rsc_bands.shape == (13,)
+    assert np.allclose(rsc_bands, apply_srf(rsc, "sentinel2a"))
+    assert np.array_equal(gsfr_bands, gsfr)
+
+
+def test_wavelength_subset():
+    from prosail.spectral_library import WavelengthGrid
+
+    grid = WavelengthGrid.regular(10)
+    args = (2.1, 40.0, 10.0, 0.1, 0.015, 0.009, 3.0, -0.35, 0.01, 30.0,
+            np.array([0.0, 10.0]), 0.0)
+    rho = prosail.run_prosail(*args, typelidf=1, rsoil=0.8, psoil=0.3,
+                              factor="ALL")
+    rho_grid = prosail.run_prosail(*args, typelidf=1, rsoil=0.8, psoil=0.3,
+                                   factor="ALL", wavelengths=grid)
+    for full, subset in zip(rho, rho_grid):
+        assert subset.shape == (2, 211)
+        assert np.allclose(subset, full[:, ::10], rtol=0, atol=1e-13)
+
+    from prosail.sail_model import run_progeosail
+
+    crowns = (0.5, 0.4, "cone") + args[:10] + (0.0, 0.0)
+    rsc, _ = run_progeosail(*crowns, rsoil=0.8, psoil=0.3)
+    rsc_grid, _ = run_progeosail(*crowns, rsoil=0.8, psoil=0.3,
+                                 wavelengths=grid)
+    assert rsc_grid.shape == (211,)
+    assert np.allclose(rsc_grid, rsc[::10], rtol=0, atol=1e-13)
+    # The bands of a sensor from the SRFs restricted to the grid, which are
+    # built once
+    from prosail.sensors import _grid_srf
+
+    _grid_srf.cache_clear()
+    bands = prosail.run_prosail(*args, typelidf=1, rsoil=0.8, psoil=0.3,
+                                wavelengths=grid, sensor="sentinel2a")
+    assert np.allclose(bands, prosail.run_prosail(
+        *args, typelidf=1, rsoil=0.8, psoil=0.3, sensor="sentinel2a"),
+        rtol=0, atol=2e-3)
+    prosail.run_prosail(*args, typelidf=1, rsoil=0.8, psoil=0.3,
+                        wavelengths=grid, sensor="Sentinel2A")
+    assert _grid_srf.cache_info().misses == 1
+    assert _grid_srf.cache_info().hits == 1
+
+
+def test_float32_mode(datadir):
+    from prosail.sail_model import run_progeosail
+
+    fname = datadir("REFL_CAN.txt")
+    w, resv, rdot, rsot, rddt, rsdt = np.loadtxt(fname, unpack=True)
+    args = (1.5, 40.0, 8.0, 0.0, 0.01, 0.009, 3.0, -0.35, 0.01, 30.0, 10.0,
+            0.0)
+    kwargs = dict(typelidf=1, lidfb=-0.15, rsoil=1.0, psoil=1.0)
+    rho = prosail.run_prosail(*args, factor="ALL", **kwargs)
+    rho32 = prosail.run_prosail(*args, factor="ALL", dtype=np.float32,
+                                **kwargs)
+    for term, term32 in zip(rho, rho32):
+        assert term32.dtype == np.float32
+        assert np.allclose(term32, term, rtol=0, atol=1e-5)
+    sdr, bhr, dhr, hdr = rho32
+    assert np.allclose(rdot, hdr, atol=0.01)
+    assert np.allclose(rddt, bhr, atol=0.01)
+    assert np.allclose(rsdt, dhr, atol=0.01)
+
+    w, refl, trans = prosail.run_prospect(*args[:6], dtype=np.float32)
+    assert refl.dtype == trans.dtype == np.float32
+    sdr = prosail.run_sail(refl, trans, 3.0, 57.0, 0.01, 30.0,
+                           np.array([0.0, 10.0]), 0.0, rsoil0=0.2,
+                           dtype=np.float32)
+    assert sdr.dtype == np.float32
+    assert sdr.shape == (2, 2101)
+    # Python scalars are double precision
+    from prosail.FourSAIL import foursail, foursail_multiview
+
+    scalars = (0.1, 0.05, -0.35, -0.15, 1, 3.0, 0.01, 30.0, 10.0, 0.0, 0.2)
+    assert foursail(*scalars).data.dtype == np.float64
+    multiview = scalars[:8] + (np.array([0.0, 10.0]),) + scalars[9:]
+    assert foursail_multiview(*multiview).data.dtype == np.float64
+    rsc, _ = run_progeosail(0.5, 0.4, "cone", *args, dtype=np.float32,
+                            **kwargs)
+    assert rsc.dtype == np.float32
+    assert np.allclose(rsc, run_progeosail(0.5, 0.4, "cone", *args,
+                                           **kwargs)[0], rtol=0, atol=1e-5)
+
+
+def test_lidf_table():
+    from prosail.FourSAIL import (
+        LIDFTable, geometric_coefficients, leaf_angle_quadrature,
+        lidf_batch, lidf_table, quadrature_lidf,
+    )
+
+    rng = np.random.default_rng(7)
+    lidftype = np.repeat([1, 2], 200)
+    lidfa = np.concatenate([
+        np.round(rng.uniform(-0.6, 0.6, 100), 2), rng.uniform(-0.6, 0.6, 100),
+        np.round(rng.uniform(0.0, 90.0, 100), 1), rng.uniform(0.0, 90.0, 100),
+    ])
+    lidfb = np.concatenate([
+        np.round(rng.uniform(-0.3, 0.3, 100), 2), rng.uniform(-0.3, 0.3, 100),
+        np.zeros(200),
+    ])
+    expected = lidf_batch(lidftype, lidfa, lidfb, 18)
+    table = LIDFTable()
+    # On the nodes, and recomputed between them
+    assert np.array_equal(table.batch(lidftype, lidfa, lidfb), expected)
+    assert np.array_equal(table(2, 57.0), table.batch([2], [57.0], [0.0])[0])
+    table.tolerance = 1e-5
+    lidf = table.batch(lidftype, lidfa, lidfb)
+    assert np.allclose(lidf, expected, rtol=0, atol=1e-5)
+    assert np.allclose(lidf.sum(axis=1), 1.0)
+    info = table.info()
+    assert info["bimodal", "midpoint", 18] > info["campbell", "midpoint", 18]
+    table.clear()
+    assert table.info() == {}
+    # Large quadratures are not tabulated
+    gauss = leaf_angle_quadrature(90, "gauss")
+    lidf = table.batch(lidftype[::50], lidfa[::50], lidfb[::50], gauss)
+    assert np.array_equal(lidf, quadrature_lidf(
+        lidftype[::50], lidfa[::50], lidfb[::50], gauss
+    ))
+    assert table.info() == {}
+    # Single canopies don't use the tables
+    lidf_table.clear()
+    geometric_coefficients(1, -0.35, -0.15, 30.0, 10.0, 0.0)
+    geometric_coefficients(2, 57.0, 0.0, 30.0, 10.0, 0.0)
+    assert lidf_table.info() == {}
+
+
+def test_volscatt_batch():
+    from prosail.FourSAIL import (
+        campbell, volscatt, volscatt_batch, weighted_sum_over_lidf,
+        weighted_sum_over_lidf_batch,
+    )
+
+    rng = np.random.default_rng(3)
+    tts = rng.uniform(0.0, 70.0, 20)
+    tto = rng.uniform(0.0, 60.0, 20)
+    psi = rng.uniform(0.0, 180.0, 20)
+    tto[:2] = 0.0
+    ttl = np.arange(18) * 5.0 + 2.5
+    terms = volscatt_batch(tts, tto, psi, ttl)
+    for term in terms:
+        assert term.shape == (20, 18)
+    for i, j in np.ndindex(20, 18):
+        expected = volscatt(tts[i], tto[i], psi[i], ttl[j])
+        assert tuple(term[i, j] for term in terms) == expected
+    lidf = np.array([campbell(angle, 18) for angle in rng.uniform(0, 90, 20)])
+    coefficients = weighted_sum_over_lidf_batch(lidf, tts, tto, psi)
+    for i in range(20):
+        expected = weighted_sum_over_lidf(lidf[i], tts[i], tto[i], psi[i])
+        assert tuple(term[i] for term in coefficients) == expected
+
+
+def test_leaf_angle_quadrature():
+    from prosail.FourSAIL import (
+        LIDFTable, geometric_coefficients, leaf_angle_quadrature,
+        quadrature_error, weighted_sum_over_lidf, lidf_batch,
+    )
+
+    quadrature = leaf_angle_quadrature()
+    assert quadrature.rule == "midpoint" and quadrature.n_nodes == 18
+    gauss = leaf_angle_quadrature(6, "gauss")
+    assert leaf_angle_quadrature(6, "Gauss") is gauss
+    assert np.isclose(gauss.weights.sum(), 90.0)
+    assert np.all(np.diff(gauss.angles) > 0)
+    with pytest.raises(ValueError):
+        leaf_angle_quadrature(6, "simpson")
+    # The default quadrature is the 4SAIL one
+    geometry = (30.0, 10.0, 0.0)
+    lidf = lidf_batch(np.array([2]), np.array([57.0]), np.array([0.0]), 18)
+    assert geometric_coefficients(2, 57.0, 0.0, *geometry)[:5] == (
+        weighted_sum_over_lidf(lidf[0], *geometry)
+    )
+    reference = leaf_angle_quadrature(1440)
+    table = LIDFTable(quadrature=leaf_angle_quadrature(12, "gauss"))
+    for lidftype, lidfa, lidfb in [(2, 57.0, 0.0), (2, 20.0, 0.0),
+                                   (1, -0.35, -0.15), (1, 0.5, -0.3)]:
+        lidf = table(lidftype, lidfa, lidfb)
+        assert lidf.shape == (12,)
+        assert np.isclose(lidf.sum(), 1.0)
+        expected = np.array(geometric_coefficients(
+            lidftype, lidfa, lidfb, *geometry, quadrature=reference
+        )[:5])
+        for n_nodes, rule, bound in [(18, "midpoint", 2e-3),
+                                     (6, "gauss", 1e-2), (90, "gauss", 1e-5)]:
+            quadrature = leaf_angle_quadrature(n_nodes, rule)
+            coefficients = np.array(geometric_coefficients(
+                lidftype, lidfa, lidfb, *geometry, quadrature=quadrature
+            )[:5])
+            error = quadrature_error(
+                lidftype, lidfa, lidfb, *geometry, quadrature=quadrature
+            )
+            # The reference itself is accurate to about 1e-7
+            assert np.all(
+                np.abs(coefficients - expected) <= 1.5 * error + 1e-7
+            )
+            assert np.all(error < bound)
+    # Singular bimodal densities fall back to the bin frequencies
+    for lidfa, lidfb in [(1.0, 0.0), (-1.0, 0.0), (0.0, -1.0), (0.0, 1.0)]:
+        expected = np.array(geometric_coefficients(
+            1, lidfa, lidfb, *geometry, quadrature=reference
+        )[:5])
+        coefficients = np.array(geometric_coefficients(
+            1, lidfa, lidfb, *geometry,
+            quadrature=leaf_angle_quadrature(90, "gauss"),
+        )[:5])
+        assert np.all(np.abs(coefficients - expected) < 1e-4)
@@ -2,6 +2,7 @@ import numpy as np
 from scipy.io import loadmat
 import os
 import prosail
+import pytest
 from pytest import fixture
 from distutils import dir_util
 
@@ -110,3 +111,181 @@ def test_transmittance_prospectpro(datadir):
         prospect_version="PRO",
     )
     assert np.allclose(trans_mtlab, trans, atol=1.0e-4)
+
+
+def test_batched_prospect_matches_loop():
+    n = np.array([1.2, 1.5, 2.1])
+    cab = np.array([30.0, 45.0, 60.0])
+    cw = np.array([0.015, 0.01, 0.02])
+    w, refl, trans = prosail.run_prospect(
+        n, cab, 10.0, 0.1, cw, 0.009, ant=1.0, prot=0.001, cbc=0.009,
+        prospect_version="PRO",
+    )
+    assert refl.shape == (3, 2101)
+    assert trans.shape == (3, 2101)
+    for i in range(3):
+        w, refl_i, trans_i = prosail.run_prospect(
+            n[i], cab[i], 10.0, 0.1, cw[i], 0.009, ant=1.0, prot=0.001,
+            cbc=0.009, prospect_version="PRO",
+        )
+        assert np.allclose(refl_i, refl[i], rtol=0, atol=1e-12)
+        assert np.allclose(trans_i, trans[i], rtol=0, atol=1e-12)
+
+
+def test_lazy_spectral_library():
+    from prosail.spectral_library import LazySpectra, get_spectra
+
+    lazy = LazySpectra()
+    assert "soil" not in vars(lazy)
+    eager = get_spectra()
+    assert np.array_equal(lazy.soil.rsoil1, eager.soil.rsoil1)
+    assert "soil" in vars(lazy)
+    assert "prospectpro" not in vars(lazy)
+    assert np.array_equal(lazy.prospectpro.kcbc, eager.prospectpro.kcbc)
+    # Unpacking, indexing and _asdict as with the Spectra tuple
+    prospect5, prospectd, prospectpro, soil, light = lazy
+    assert soil is lazy.soil and len(lazy) == len(eager)
+    assert lazy[1] is lazy.prospectd
+    assert lazy[-2:] == (lazy.soil, lazy.light)
+    assert list(lazy._asdict()) == list(eager._asdict())
+
+
+def test_binary_table_cache(tmpdir, monkeypatch):
+    from prosail.spectral_library import cached_table, clear_cache
+
+    cache_dir = str(tmpdir.join("cache"))
+    raw = b"1.0 2.0\n3.0 4.0\n5.0 6.0\n"
+    table = cached_table(raw, "test_table", cache_dir=cache_dir)
+    assert np.array_equal(table, [[1.0, 3.0, 5.0], [2.0, 4.0, 6.0]])
+    assert not table.flags.writeable
+    assert len(os.listdir(cache_dir)) == 1
+    # Same contents: the binary file is reused
+    table = cached_table(raw, "test_table", cache_dir=cache_dir)
+    assert isinstance(table.base, np.memmap)
+    # Changed contents: the binary file is rebuilt and the old one kept
+    table = cached_table(b"7.0 8.0\n", "test_table", cache_dir=cache_dir)
+    assert np.array_equal(table, [[7.0], [8.0]])
+    assert len(os.listdir(cache_dir)) == 2
+    clear_cache("test_table", cache_dir=cache_dir)
+    assert os.listdir(cache_dir) == []
+    # By default, only the binary files of the packaged tables are removed
+    cached_table(raw, "soil_reflectance", cache_dir=cache_dir)
+    cached_table(raw, "test_table", cache_dir=cache_dir)
+    open(os.path.join(cache_dir, "lut-2020.npy"), "wb").close()
+    clear_cache(cache_dir=cache_dir)
+    fnames = sorted(os.listdir(cache_dir))
+    assert len(fnames) == 2 and fnames[0] == "lut-2020.npy"
+    assert fnames[1].startswith("test_table-")
+    # A failed write leaves no temporary file behind
+    def failed_save(fp, table):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(np, "save", failed_save)
+    table = cached_table(b"9.0\n", "test_table", cache_dir=cache_dir)
+    assert np.array_equal(table, [[9.0]])
+    assert sorted(os.listdir(cache_dir)) == fnames
+
+
+def test_interface_terms_cache():
+    from prosail.prospect_d import interface_terms
+
+    nr = prosail.spectral_lib.prospectd.nr
+    talf, ralf, t12, r12, t21, r21 = interface_terms(40.0, nr)
+    assert np.array_equal(talf, calctav(40.0, nr))
+    assert np.array_equal(t12, calctav(90, nr))
+    assert interface_terms(40, nr)[0] is talf
+    assert interface_terms(30.0, nr)[0] is not talf
+    assert interface_terms(40.0, nr.copy())[0] is not talf
+
+
+def test_numba_tau_prospectd(datadir):
+    fname = datadir("prospect_d_test.mat")
+    lrt_mtlab = loadmat(fname)["LRT"]
+    w, refl, trans = prosail.run_prospect(
+        1.2, 30, 10.0, 0.0, 0.015, 0.009, ant=1.0, prospect_version="D",
+        tau_method="numba",
+    )
+    assert np.allclose(lrt_mtlab[:, 1], refl, atol=1.0e-4)
+    assert np.allclose(lrt_mtlab[:, 2], trans, atol=1.0e-4)
+    w, refl_scipy, trans_scipy = prosail.run_prospect(
+        1.2, 30, 10.0, 0.0, 0.015, 0.009, ant=1.0, prospect_version="D"
+    )
+    assert np.allclose(refl_scipy, refl, rtol=0, atol=1.0e-6)
+    assert np.allclose(trans_scipy, trans, rtol=0, atol=1.0e-6)
+
+
+def test_numba_tau_prospectpro(datadir):
+    fname = datadir("prospect_pro_test.txt")
+    w, refl_mtlab, trans_mtlab = np.loadtxt(fname, unpack=True)
+    w, refl, trans = prosail.run_prospect(
+        1.2, 30, 10.0, 0.0, 0.015, 0.009, ant=1.0, prot=0.001, cbc=0.009,
+        prospect_version="PRO", tau_method="numba",
+    )
+    assert np.allclose(refl_mtlab, refl, atol=1.0e-4)
+    assert np.allclose(trans_mtlab, trans, atol=1.0e-4)
+    w, refl_scipy, trans_scipy = prosail.run_prospect(
+        1.2, 30, 10.0, 0.0, 0.015, 0.009, ant=1.0, prot=0.001, cbc=0.009,
+        prospect_version="PRO",
+    )
+    assert np.allclose(refl_scipy, refl, rtol=0, atol=1.0e-6)
+    assert np.allclose(trans_scipy, trans, rtol=0, atol=1.0e-6)
+
+
+def test_absorption_matrix():
+    from prosail.spectral_library import absorption_matrix
+
+    spectra = prosail.spectral_lib.prospectpro
+    kmat, constituents = absorption_matrix(spectra)
+    assert kmat.shape == (8, 2101)
+    assert constituents == (
+        "cab", "car", "cbrown", "cw", "cm", "ant", "prot", "cbc"
+    )
+    leaf = dict(
+        cab=30.0, car=10.0, cbrown=0.1, cw=0.015, cm=0.009, ant=1.0,
+        prot=0.001, cbc=0.009,
+    )
+    kall = np.array([leaf[name] for name in constituents]) @ kmat
+    expected = (
+        30.0 * spectra.kab + 10.0 * spectra.kcar + 0.1 * spectra.kbrown
+        + 0.015 * spectra.kw + 0.009 * spectra.km + 1.0 * spectra.kant
+        + 0.001 * spectra.kprot + 0.009 * spectra.kcbc
+    )
+    assert np.allclose(kall, expected, rtol=1e-12, atol=0)
+
+
+def test_wavelength_grid():
+    from prosail.spectral_library import WavelengthGrid, get_wavelength_grid
+    from prosail.sensors import sensor_grid
+
+    grid = get_wavelength_grid(np.arange(400, 2501, 10))
+    assert grid == WavelengthGrid.regular(10)
+    assert get_wavelength_grid(np.arange(400, 2501, 10)) is grid
+    assert len(grid) == 211
+    assert np.array_equal(
+        grid.spectra("prospectd").kab, prosail.spectral_lib.prospectd.kab[::10]
+    )
+    assert grid.spectra("prospectd") is grid.spectra("prospectd")
+    for version in ["5", "D", "PRO"]:
+        w, refl, trans = prosail.run_prospect(
+            1.5, 40.0, 8.0, 0.1, 0.01, 0.009, ant=2.0, prot=0.001, cbc=0.009,
+            prospect_version=version,
+        )
+        w_grid, refl_grid, trans_grid = prosail.run_prospect(
+            1.5, 40.0, 8.0, 0.1, 0.01, 0.009, ant=2.0, prot=0.001, cbc=0.009,
+            prospect_version=version, wavelengths=grid,
+        )
+        assert np.array_equal(w_grid, w[::10])
+        assert np.allclose(refl_grid, refl[::10], rtol=0, atol=1e-14)
+        assert np.allclose(trans_grid, trans[::10], rtol=0, atol=1e-14)
+
+    s2 = sensor_grid("sentinel2a")
+    assert np.array_equal(s2.wavelengths[:3], [443, 492, 560])
+    w, refl, trans = prosail.run_prospect(
+        1.5, 40.0, 8.0, 0.1, 0.01, 0.009, kab=prosail.spectral_lib.prospect5.kab,
+        prospect_version="5", wavelengths=s2,
+    )
+    assert refl.shape == (13,)
+    with pytest.raises(ValueError):
+        WavelengthGrid([350, 500])
+    with pytest.raises(ValueError):
+        WavelengthGrid([500.5])
@@ -16,31 +16,28 @@ if __name__ == "__main__":
     tsoil_sunlit = 58.0
     hspot = 0.05
     tts = 24.2
+    angs = np.arange(-90, 90, 1)
+    # Negative angles are in the backward direction
+    psi = np.where(angs <= 0, 0.0, 180.0)
     for lai in [0.5, 1, 2, 4]:
-        BT = []
-        angs = list(range(-90, 90, 1))
-        for tto in angs:
-            if tto <= 0:
-                psi = 0.0
-            else:
-                psi = 180.0
-            retval = prosail.run_thermal_sail(
-                lam,
-                tveg + 273.15,
-                tsoil + 273.15,
-                tveg_sunlit + 273.15,
-                tsoil_sunlit + 273.15,
-                t_atm + 273.15,
-                lai,
-                lidfa,
-                hspot,
-                tts,
-                np.abs(tto),
-                psi,
-                emv=emv,
-                ems=ems,
-                lidfb=0.0,
-                typelidf=1,
-            )
-            BT.append(retval[1] - 273.15)
+        # All the view angles in one go
+        retval = prosail.run_thermal_sail(
+            lam,
+            tveg + 273.15,
+            tsoil + 273.15,
+            tveg_sunlit + 273.15,
+            tsoil_sunlit + 273.15,
+            t_atm + 273.15,
+            lai,
+            lidfa,
+            hspot,
+            tts,
+            np.abs(angs),
+            psi,
+            emv=emv,
+            ems=ems,
+            lidfb=0.0,
+            typelidf=1,
+        )
+        BT = retval[1] - 273.15
         plt.plot(angs, BT, "-", label=f"LAI={lai}")